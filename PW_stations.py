@@ -1116,16 +1116,19 @@ def parameter_study_ts_tm_TELA_bet_dagan(tel_aviv_IMS_file, path=work_yuval,
 
 def read_stations_to_dataset(path, group_name='israeli', save=False,
                              names=None):
+    """merge the garner trop stations files, use names to open only some
+    stations, files are opened lazily with dask chunks"""
     import xarray as xr
-    if names is None:
-        stations = []
-        for filename in sorted(path.glob('garner_trop_[!all_stations]*.nc')):
-            st_name = filename.as_posix().split('/')[-1].split('.')[0].split('_')[-1]
-            print('Reading station {}'.format(st_name))
-            da = xr.open_dataarray(filename)
-            da = da.dropna('time')
-            stations.append(da)
-        ds = xr.merge(stations)
+    stations = []
+    for filename in sorted(path.glob('garner_trop_[!all_stations]*.nc')):
+        st_name = filename.as_posix().split('/')[-1].split('.')[0].split('_')[-1]
+        if names is not None and st_name not in names:
+            continue
+        print('Reading station {}'.format(st_name))
+        da = xr.open_dataarray(filename, chunks={'time': 'auto'})
+        da = da.dropna('time')
+        stations.append(da)
+    ds = xr.merge(stations)
     if save:
         savefile = 'garner_' + group_name + '_stations.nc'
         print('saving {} to {}'.format(savefile, path))
@@ -1303,29 +1306,23 @@ def produce_geo_gnss_solved_stations(path=gis_path,
 def add_UERRA_xy_to_israeli_gps_coords(path=work_yuval, era5_path=era5_path):
     import xarray as xr
     from aux_gps import path_glob
-    from aux_gps import get_nearest_lat_lon_for_xy
+    from aux_gps import get_geo_spatial_index
     import pandas as pd
-    from aux_gps import calculate_distance_between_two_lat_lon_points
     file = path_glob(era5_path, 'UERRA*.nc')[0]
     uerra = xr.open_dataset(file)
     ulat = uerra['latitude']
     ulon = uerra['longitude']
     df = produce_geo_gnss_solved_stations(
         plot=False, add_distance_to_coast=True)
-    points = df[['lat', 'lon']].values
-    xy = get_nearest_lat_lon_for_xy(ulat, ulon, points)
-    udf = pd.DataFrame(xy, index=df.index, columns=['y', 'x'])
-    udf['lat'] = [ulat.isel(y=xi, x=yi).item() for (xi, yi) in xy]
-    udf['lon'] = [ulon.isel(y=xi, x=yi).item() for (xi, yi) in xy]
-    ddf = calculate_distance_between_two_lat_lon_points(
-        df['lat'],
-        df['lon'],
-        udf['lat'],
-        udf['lon'],
-        orig_epsg='4326',
-        meter_epsg='2039')
-    ddf /= 1000  # distance in km
-    udf['distance_to_orig'] = ddf
+    index = get_geo_spatial_index(ulat.values, ulon.values, name='UERRA',
+                                  savepath=era5_path, grid=True)
+    dist, inds = index.query(df['lat'].values, df['lon'].values)
+    y, x = index.unravel(inds)
+    udf = pd.DataFrame({'y': y, 'x': x}, index=df.index)
+    udf['lat'] = ulat.values[y, x]
+    udf['lon'] = ulon.values[y, x]
+    # geodesic distance in km:
+    udf['distance_to_orig'] = dist
     return udf
 
 
@@ -1383,20 +1380,16 @@ def produce_geo_gps_stations(path=gis_path, file='All_gps_stations.txt',
 
 
 def get_minimum_distance(geo_ims, geo_gps, path, plot=True):
-    def min_dist(point, gpd2):
-        gpd2['Dist'] = gpd2.apply(
-            lambda row: point.distance(
-                row.geometry), axis=1)
-        geoseries = gpd2.iloc[gpd2['Dist'].values.argmin()]
-        geoseries.loc['distance'] = gpd2['Dist'].values.min()
-        return geoseries
-    min_list = []
-    for gps_rows in geo_gps.iterrows():
-        ims_min_series = min_dist(gps_rows[1]['geometry'], geo_ims)
-        min_list.append(ims_min_series[['ID', 'name_hebrew', 'name_english',
-                                        'lon', 'lat', 'alt', 'starting_date',
-                                        'distance']])
-    geo_df = pd.concat(min_list, axis=1).T
+    """get the closest IMS station to each GPS station, distance is the
+    geodesic distance in km"""
+    from aux_gps import get_geo_spatial_index
+    index = get_geo_spatial_index(geo_ims['lat'].values.astype(float),
+                                  geo_ims['lon'].values.astype(float))
+    dist, inds = index.query(geo_gps['lat'].values.astype(float),
+                             geo_gps['lon'].values.astype(float))
+    geo_df = geo_ims.iloc[inds][['ID', 'name_hebrew', 'name_english',
+                                 'lon', 'lat', 'alt', 'starting_date']].copy()
+    geo_df['distance'] = dist
     geo_df['lat'] = geo_df['lat'].astype(float)
     geo_df['lon'] = geo_df['lon'].astype(float)
     geo_df['alt'] = geo_df['alt'].astype(float)
@@ -1752,6 +1745,16 @@ def produce_kappa_ml_with_cats(Tds, mda=None, model_name='LR'):
         kappa_ds, kappa_err = kappa_ml(Tds, model=None)
         return kappa_ds, kappa_err
     time_dim = mda.attrs['time_dim']
+    # linear models: gather the coefs of all times from a lookup table:
+    table = get_kappa_ml_coef_table(mda, model_name=model_name)
+    if table is not None:
+        cats = [x for x in table['coef'].dims]
+        print('Found {} Ts-Tm relationship lookup table.'.format(
+            ' and '.join(cats) if cats else 'whole data'))
+        slope_err = None if cats else mda.attrs['LR_whole_stderr_slope']
+        kappa_ds, kappa_err = kappa_ml_from_coef_table(
+            Tds, table, time_dim=time_dim, slope_err=slope_err)
+        return kappa_ds, kappa_err
     hours = None
     seasons = None
     if 'season' in [x.split('.')[-1] for x in list(mda.dims)]:
@@ -1864,7 +1867,17 @@ def produce_single_station_IPW(zwd, Tds, mda=None, model_name='LR'):
         hours = {key: val}
     if 'any_cld' in mda.dims:
         any_clds = mda.any_cld.values.tolist()
-    if len(mda.dims) == 1 and 'name' in mda.dims:
+    table = get_kappa_ml_coef_table(mda, model_name=model_name)
+    if table is not None and table['coef'].dims:
+        # linear models: gather the coefs of all times from a lookup table:
+        cats = [x for x in ['hour', 'season'] if x in table['coef'].dims]
+        print('Found {} Ts-Tm relationship lookup table.'.format(
+            ' and '.join(cats)))
+        kappa_ds, kappa_err_ds = kappa_ml_from_coef_table(
+            Tds, table, time_dim=time_dim)
+        des_attrs = '{} data Tm formulation using {} model'.format(
+            ' and '.join([x + 'ly' for x in cats]), model_name)
+    elif len(mda.dims) == 1 and 'name' in mda.dims:
         print('Found whole data Ts-Tm relationship.')
 #        Tmul = mda.sel(parameter='slope').values.item()
 #        Toff = mda.sel(parameter='intercept').values.item()
@@ -1962,8 +1975,9 @@ def produce_single_station_IPW(zwd, Tds, mda=None, model_name='LR'):
                 kappa_list.append(kappa_part)
                 kappa_err_list.append(kappa_err)
         des_attrs = 'hourly and seasonly data Tm formulation using {} model'.format(model_name)
-    kappa_ds = xr.concat(kappa_list, time_dim)
-    kappa_err_ds = xr.concat(kappa_err_list, time_dim)
+    if table is None or not table['coef'].dims:
+        kappa_ds = xr.concat(kappa_list, time_dim)
+        kappa_err_ds = xr.concat(kappa_err_list, time_dim)
     ipw = kappa_ds * zwd
     ipw_error = kappa_ds * zwd_error + zwd * kappa_err_ds
     ipw_error.name = 'PW_error'
@@ -2106,10 +2120,8 @@ def kappa_ml(T, model=None, k2=22.1, k3=3.776e5, dk3=0.004e5, dk2=2.2,
         print('using model arg as 2d np array with dims: [coef, intercept]')
         coef = model[0, :]
         intercept = model[1, :]
-        tm = np.empty((T.values.shape[0], coef.shape[0], intercept.shape[0]))
-        for i in range(coef.shape[0]):
-            for j in range(intercept.shape[0]):
-                tm[:, i, j] = (273.15 + T.values) * coef[i] + intercept[j]
+        tm = ((273.15 + T.values)[:, None, None] * coef[None, :, None] +
+              intercept[None, None, :])
         Tm = xr.DataArray(tm, dims=[time_dim, 'coef', 'intercept'])
         Tm['time'] = T[time_dim]
         Tm['coef'] = coef
@@ -2148,6 +2160,70 @@ def kappa_ml(T, model=None, k2=22.1, k3=3.776e5, dk3=0.004e5, dk2=2.2,
         return k, dk
 
 
+def get_kappa_ml_coef_table(mda, model_name='LR'):
+    """precompute the lookup table of the Ts-Tm linear models in mda, i.e., a
+    Dataset of coef and intercept with the categories of mda as dims (e.g.,
+    season, hour or none for the whole data). return None if the models are
+    not linear (no coef_)"""
+    import numpy as np
+    import xarray as xr
+    m = mda.sel(name=model_name)
+    models = np.ravel(m.values)
+    if not all(hasattr(x, 'coef_') for x in models):
+        return None
+    dims = [x.split('.')[-1] for x in m.dims]
+    coords = dict(zip(dims, [m[x].values for x in m.dims]))
+    coef = np.array([np.ravel(x.coef_)[0] for x in models])
+    intercept = np.array([np.ravel(x.intercept_)[0] for x in models])
+    table = xr.Dataset(coords=coords)
+    table['coef'] = xr.DataArray(coef.reshape(m.shape), dims=dims)
+    table['intercept'] = xr.DataArray(intercept.reshape(m.shape), dims=dims)
+    table.attrs['model_name'] = model_name
+    return table
+
+
+def kappa_ml_from_coef_table(T, table, time_dim='time', slope_err=None,
+                             k2=22.1, k3=3.776e5, dk3=0.004e5, dk2=2.2):
+    """compute kappa and its error for the whole T (in celsious, time or
+    (time, station)) at once by gathering the coef and intercept of each time
+    from the (season, hour) table of get_kappa_ml_coef_table. times whose
+    category is not in the table are NaN"""
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    from aux_gps import get_time_group_keys
+    dT = 0.5  # deg_C
+    seasons = np.array(['DJF', 'DJF', 'MAM', 'MAM', 'MAM', 'JJA', 'JJA',
+                        'JJA', 'SON', 'SON', 'SON', 'DJF'])
+    cats = [x for x in table['coef'].dims]
+    times = T[time_dim].values
+    inds = []
+    for cat in cats:
+        if cat == 'season':
+            keys = seasons[get_time_group_keys(times, 'month') - 1]
+        else:
+            keys = get_time_group_keys(times, cat)
+        inds.append(pd.Index(table[cat].values).get_indexer(keys))
+    inds = np.array(inds).reshape(len(cats), times.size)
+    ok = (inds >= 0).all(axis=0)
+    flat = np.ravel_multi_index(np.where(ok, inds, 0),
+                                table['coef'].shape)
+    coef = np.where(ok, table['coef'].values.ravel()[flat], np.nan)
+    intercept = np.where(ok, table['intercept'].values.ravel()[flat], np.nan)
+    coef = xr.DataArray(coef, dims=[time_dim], coords={time_dim: times})
+    intercept = xr.DataArray(intercept, dims=[time_dim],
+                             coords={time_dim: times})
+    Tm = (273.15 + T) * coef + intercept
+    dTm = coef * dT
+    if slope_err is not None:
+        dTm = dTm + slope_err * Tm
+    Rv = 461.52  # [Rv] = J / (kg * K) = (Pa * m^3) / (kg * K)
+    k = 1.0 / (1e-6 * (k3 / Tm + k2) * Rv)
+    dk = k * (k3 / Tm + k2)**-1 * np.sqrt((dk3 / Tm) **
+                                          2.0 + (dTm * k3 / Tm**2.0)**2.0 + dk2**2.0)
+    return k, dk
+
+
 def kappa(T, Tmul=0.72, T_offset=70.2, k2=22.1, k3=3.776e5, Tm_input=False):
     """T in celsious, or in K when Tm_input is True"""
     # original k2=17.0 bevis 1992 etal.
@@ -4026,27 +4102,120 @@ def combine_PPP_stations(zwd, name, stations, thresh=None,
     return combined_station
 
 
-def load_gipsyx_PWV_time_series(station='tela', gnss_path=GNSS_path):
+def get_gnss_files_index(gnss_path=GNSS_path, kind='PWV', rebuild=False):
+    """return (and keep on disk) a small index of station -> file -> time range
+    for the gipsyx solutions of kind PWV or PPP, only new or modified files are
+    re-read (and only their time coord)"""
     from aux_gps import path_glob
+    import xarray as xr
+    import os
+    index_file = gnss_path / 'gnss_{}_files_index.csv'.format(kind)
+    cols = ['station', 'file', 'start', 'end', 'variables', 'mtime']
+    if index_file.is_file() and not rebuild:
+        old = pd.read_csv(index_file, parse_dates=['start', 'end'])
+        old = old.set_index('file')
+    else:
+        old = pd.DataFrame(columns=cols).set_index('file')
+    try:
+        st_paths = path_glob(gnss_path, '*/')
+    except FileNotFoundError:
+        st_paths = []
+    rows = []
+    for st_path in [x for x in st_paths if x.is_dir()]:
+        station = st_path.as_posix().split('/')[-1]
+        glob = '{}_{}*.nc'.format(station.upper(), kind)
+        try:
+            files = sorted(path_glob(st_path / 'gipsyx_solutions', glob))
+        except FileNotFoundError:
+            continue
+        for file in files:
+            mtime = os.path.getmtime(file)
+            key = file.as_posix()
+            if key in old.index and old.loc[key, 'mtime'] == mtime:
+                row = old.loc[key].to_dict()
+            else:
+                with xr.open_dataset(file) as ds:
+                    time = ds['time']
+                    row = dict(station=station,
+                               start=pd.Timestamp(time.min().values),
+                               end=pd.Timestamp(time.max().values),
+                               variables=' '.join([x for x in ds.data_vars]),
+                               mtime=mtime)
+                print('indexed {}.'.format(file))
+            row['file'] = key
+            rows.append(row)
+    df = pd.DataFrame(rows, columns=cols)
+    tmp = index_file.with_suffix('.csv.tmp')
+    try:
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, index_file)
+    except OSError as e:
+        print('could not save index: {}'.format(e))
+    return df
+
+
+def open_gnss_stations(stations=None, times=None, variables=None, kind='PWV',
+                       gnss_path=GNSS_path, chunks={'time': 'auto'}):
+    """lazily open (dask chunks) only the gipsyx solutions needed: stations is
+    a list of station names (None for all), times is a (start, end) window and
+    variables are the fields to keep. for PWV files the fields are 'PWV' and
+    'PWV_error' (named <station> and <station>_error as in the files), for PPP
+    the fields are e.g., WetZ, WetZ_error and they are named <station> if only
+    one is asked for and <station>_<field> otherwise"""
+    import xarray as xr
+    df = get_gnss_files_index(gnss_path, kind=kind)
+    if stations is not None:
+        if isinstance(stations, str):
+            stations = [stations]
+        stations = [x.lower() for x in stations]
+        df = df[df['station'].str.lower().isin(stations)]
+    if times is not None:
+        start = pd.Timestamp(times[0]) if times[0] is not None else None
+        end = pd.Timestamp(times[1]) if times[1] is not None else None
+        if start is not None:
+            df = df[df['end'] >= start]
+        if end is not None:
+            df = df[df['start'] <= end]
+    if isinstance(variables, str):
+        variables = [variables]
+    dsl = []
+    # prefer the all_years file, else the last one (as load_gipsyx_results):
+    for station, st_df in df.groupby('station', sort=True):
+        files = sorted(st_df['file'])
+        all_years = [x for x in files if x.endswith('_{}_all_years.nc'.format(kind))]
+        file = all_years[0] if all_years else files[-1]
+        ds = xr.open_dataset(file, chunks=chunks)
+        if kind == 'PWV':
+            names = {station: 'PWV', '{}_error'.format(station): 'PWV_error'}
+            to_keep = [x for x in ds.data_vars if variables is None or
+                       names.get(x, x) in variables]
+            ds = ds[to_keep]
+        else:
+            to_keep = [x for x in ds.data_vars if variables is None or
+                       x in variables]
+            ds = ds[to_keep].squeeze(drop=True)
+            if len(to_keep) == 1:
+                ds = ds.rename({to_keep[0]: station})
+            else:
+                ds = ds.rename({x: '{}_{}'.format(station, x) for x in to_keep})
+        if times is not None:
+            ds = ds.sortby('time').sel(time=slice(times[0], times[1]))
+        print('opened {} {} for {} station.'.format(kind, to_keep, station))
+        dsl.append(ds)
+    if not dsl:
+        raise FileNotFoundError('no {} files found in {} for the query.'.format(kind, gnss_path))
+    ds = xr.merge(dsl)
+    return ds
+
+
+def load_gipsyx_PWV_time_series(station='tela', gnss_path=GNSS_path):
     import xarray as xr
     if station is not None:
         path = gnss_path / station / 'gipsyx_solutions'
         pwv_file = path / '{}_PWV_all_years.nc'.format(station.upper())
         ds = xr.load_dataset(pwv_file)
     else:
-        st_paths = path_glob(gnss_path, '*/')
-        dsl = []
-        for st_path in st_paths:
-            station = st_path.as_posix().split('/')[-1]
-            pwv_file = st_path /'gipsyx_solutions/{}_PWV_all_years.nc'.format(station.upper())
-            try:
-                ds = xr.open_dataset(pwv_file)
-                dsl.append(ds)
-                print('Loading PWV for {} station.'.format(station))
-            except FileNotFoundError:
-                print('No PWV in {} was found for {} station.'.format(st_path, station))
-                pass
-        ds = xr.merge(dsl)
+        ds = open_gnss_stations(kind='PWV', gnss_path=gnss_path)
     return ds
 
 
@@ -4165,19 +4334,9 @@ def load_gipsyx_results(station='tela', gnss_path=GNSS_path, sample_rate=None,
         df = pd.read_csv(cwd / 'israeli_gnss_coords.txt', header=0,
                          delim_whitespace=True)
         stations = df.index.tolist()
-        da_list = []
-        stations_to_put = []
-        for sta in stations:
-            da = load_one_results_ds(sta, sample_rate=None, plot_fields=None)
-            if da is not None:
-                da = da[field_all]
-                da.name = sta
-                da_list.append(da)
-                stations_to_put.append(sta)
-            else:
-                print('skipping station {}'.format(sta))
-                continue
-        ds = xr.merge(da_list)
+        # only the stations' files are opened (lazily) via the files index:
+        ds = open_gnss_stations(stations, variables=[field_all], kind='PPP',
+                                gnss_path=gnss_path)
         # ds['station'] = stations_to_put
         # ds = ds.to_dataset(dim='station')
     return ds
@@ -56,6 +56,164 @@ def transform_time_series_groups_agg_to_time_series(da, da_stats, time_dim='time
     df = df.set_index(time_dim)
     return df
 
+
+def get_time_group_keys(time, grp='hour'):
+    """return the integer group keys (e.g., hour, month, dayofyear,
+    weekofyear) of a datetime array as numpy array"""
+    import numpy as np
+    import pandas as pd
+    times = pd.DatetimeIndex(time)
+    if grp == 'weekofyear':
+        return times.isocalendar().week.values.astype(int)
+    return np.asarray(getattr(times, grp)).astype(int)
+
+
+def compute_climatology_table(da, grp=['month', 'hour'], time_dim='time',
+                              dim='station'):
+    """compute the (grp..., dim) mean table of a (time, dim) DataArray or a
+    Dataset (data vars become dim) e.g., a (month, hour, station) climatology
+    to be used with fill_na_with_climatology_table"""
+    import pandas as pd
+    import xarray as xr
+    if isinstance(da, xr.Dataset):
+        da = da.to_array(dim)
+    if isinstance(grp, str):
+        grp = [grp]
+    squeeze = dim not in da.dims
+    if squeeze:
+        da = da.expand_dims({dim: [da.name]})
+    da = da.transpose(time_dim, dim)
+    df = pd.DataFrame(da.values, columns=[str(x) for x in da[dim].values])
+    keys = [get_time_group_keys(da[time_dim].values, g) for g in grp]
+    df = df.groupby(keys).mean()
+    df.index.names = grp
+    clim = df.to_xarray().to_array(dim).transpose(*grp, dim)
+    clim[dim] = da[dim].values
+    if squeeze:
+        clim = clim.squeeze(dim, drop=True)
+        clim.name = da.name
+    return clim
+
+
+def gather_climatology_table(da, clim, time_dim='time', dim='station'):
+    """return the values of a (group keys..., dim) climatology table, e.g.,
+    (month, hour, station) means, at every time record of a (time, dim)
+    DataArray in one indexed gather (time, dim). stations missing in clim or
+    group keys missing in the table are NaN"""
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    if isinstance(clim, xr.Dataset):
+        clim = clim.to_array(dim)
+    if dim not in clim.dims:
+        clim = clim.expand_dims({dim: da[dim].values})
+    grps = [x for x in clim.dims if x != dim]
+    clim = clim.reindex({dim: da[dim].values}).transpose(*grps, dim)
+    # gather the clim rows of every time record with a flat key:
+    inds = []
+    for g in grps:
+        keys = get_time_group_keys(da[time_dim].values, g)
+        inds.append(pd.Index(clim[g].values).get_indexer(keys))
+    inds = np.array(inds)
+    ok = (inds >= 0).all(axis=0)
+    flat = np.ravel_multi_index(np.where(ok, inds, 0),
+                                [clim[g].size for g in grps])
+    table = clim.values.reshape(-1, clim[dim].size)
+    gathered = table[flat]
+    gathered[~ok] = np.nan
+    gathered = xr.DataArray(gathered, dims=[time_dim, dim])
+    gathered[time_dim] = da[time_dim].values
+    gathered[dim] = da[dim].values
+    gathered.attrs['groups'] = '-'.join(grps)
+    return gathered
+
+
+def fill_na_with_climatology_table(da, clim, time_dim='time', dim='station',
+                                   smooth=False, window=11, order=3):
+    """fill the NaNs of a (time, dim) DataArray or a Dataset of stations with
+    a precomputed (group keys..., dim) climatology table, e.g., the
+    (month, hour) means, in one indexed gather for all stations. if smooth,
+    a savgol filter is applied only around the filled gaps (window/2 records
+    on each side). stations missing in clim are not filled"""
+    import numpy as np
+    import xarray as xr
+    is_ds = isinstance(da, xr.Dataset)
+    if is_ds:
+        attrs = {x: da[x].attrs for x in da}
+        ds_attrs = da.attrs
+        da = da.to_array(dim)
+    squeeze = dim not in da.dims
+    if squeeze:
+        da = da.expand_dims({dim: [da.name]})
+    da = da.transpose(time_dim, dim)
+    gathered = gather_climatology_table(da, clim, time_dim=time_dim, dim=dim)
+    values = da.values
+    gaps = np.isnan(values)
+    filled = np.where(gaps, gathered.values, values)
+    if smooth:
+        filled = savgol_filter_around_gaps(filled, gaps, window=window,
+                                           order=order)
+    da = da.copy(data=filled)
+    if smooth:
+        da.attrs['smoothing'] = 'savgol filter around gaps, window {}, order {}.'.format(window, order)
+    da.attrs['NaN filling'] = 'mean {} values'.format(gathered.attrs['groups'])
+    if squeeze:
+        da = da.squeeze(dim, drop=True)
+    if is_ds:
+        ds = da.to_dataset(dim)
+        for var in ds:
+            ds[var].attrs = attrs[var]
+            ds[var].attrs.update(da.attrs)
+        ds.attrs = ds_attrs
+        return ds
+    return da
+
+
+def savgol_filter_around_gaps(values, gaps, window=11, order=3):
+    """apply the savgol filter along the first axis of values, but replace
+    only the records within window/2 of gaps (bool array of the same shape)"""
+    import numpy as np
+    from scipy.signal import savgol_filter
+    from scipy.ndimage import binary_dilation
+    if values.shape[0] < window or not gaps.any():
+        return values
+    smoothed = savgol_filter(values, window, order, axis=0)
+    structure = np.ones((window,) + (1,) * (values.ndim - 1), dtype=bool)
+    near = binary_dilation(gaps, structure=structure) & np.isfinite(smoothed)
+    return np.where(near, smoothed, values)
+
+
+def benchmark_fill_na_with_climatology_table(hours=30, stations=100,
+                                             freq='10min', repeat=20, seed=0):
+    """time fill_na_with_climatology_table on a real-time like window of
+    (hours, stations) with a (month, hour) table, return mean seconds"""
+    import time
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    rng = np.random.default_rng(seed)
+    dts = pd.date_range('2020-01-01', periods=hours * 6, freq=freq)
+    values = rng.normal(20, 5, size=(dts.size, stations))
+    values[rng.random(size=values.shape) < 0.1] = np.nan
+    da = xr.DataArray(values, dims=['time', 'station'])
+    da['time'] = dts
+    da['station'] = ['st{}'.format(x) for x in range(stations)]
+    clim = xr.DataArray(rng.normal(20, 5, size=(12, 24, stations)),
+                        dims=['month', 'hour', 'station'])
+    clim['month'] = np.arange(1, 13)
+    clim['hour'] = np.arange(24)
+    clim['station'] = da['station']
+    # warm up (imports) before timing:
+    fill_na_with_climatology_table(da, clim, smooth=True)
+    tic = time.perf_counter()
+    for i in range(repeat):
+        fill_na_with_climatology_table(da, clim, smooth=True)
+    elapsed = (time.perf_counter() - tic) / repeat
+    print('filled ({}, {}) in {:.2f} ms.'.format(dts.size, stations,
+                                                  elapsed * 1000))
+    return elapsed
+
+
 def convert_lat_lon_deg_to_decimal(d=32,m=3,s=5):
     # Formula: DEC = (DEG + (MIN * 1/60) + (SEC * 1/60 * 1/60))
     return d + m/60 + s/3600
@@ -96,35 +254,23 @@ def fill_na_xarray_time_series_with_its_group(xarray, grp='month', time_dim='tim
                                               smooth=True, window=11, order=3,
                                               plot=False):
     """ fill the NaNs of a Dataset or DataArray with mean grp cycle
-    (hourly, monthly, etc) and smooth using savgol filter"""
-    from scipy.signal import savgol_filter
-    import xarray as xr
-    def fill_na_dataarray(da, grp=grp, time_dim=time_dim, smooth=smooth,
-                          window=window, order=order, plot=plot):
-        print('selected {}ly NaN filling for {}.'.format(grp, da.name))
-        da_old = da.copy()
-        mean_signal = da.groupby('{}.{}'.format(time_dim, grp)).mean()
-        da = da.groupby('{}.{}'.format(time_dim, grp)).fillna(mean_signal)
-        da = da.reset_coords(drop=True)
-        if smooth:
-            print('smoothing.')
-            da = da.copy(data=savgol_filter(da, window, order))
-            da.attrs['smoothing'] = 'savgol filter, window {}, order {}.'.format(window, order)
-        da.attrs['NaN filling'] = 'mean {}ly values'.format(grp)
-        if plot:
-            da.plot()
-            da_old.plot()
-        return da
-
-    if isinstance(xarray, xr.DataArray):
-        xarray = fill_na_dataarray(xarray)
-    elif isinstance(xarray, xr.Dataset):
-        dal = []
-        attrs = xarray.attrs
-        for da in xarray:
-            dal.append(fill_na_dataarray(xarray[da]))
-        xarray = xr.merge(dal)
-        xarray.attrs = attrs
+    (hourly, monthly, etc) and smooth around the filled gaps using savgol
+    filter, all the data vars are filled at once"""
+    print('selected {}ly NaN filling.'.format(grp))
+    xarray_old = xarray
+    clim = compute_climatology_table(xarray, grp=grp, time_dim=time_dim)
+    xarray = fill_na_with_climatology_table(xarray, clim, time_dim=time_dim,
+                                            smooth=smooth, window=window,
+                                            order=order)
+    if plot:
+        import xarray as xr
+        if isinstance(xarray, xr.DataArray):
+            xarray.plot()
+            xarray_old.plot()
+        else:
+            for da in xarray:
+                xarray[da].plot()
+                xarray_old[da].plot()
     return xarray
 
 
@@ -1310,18 +1456,34 @@ def remove_duplicate_spaces_in_string(line):
 
 
 def save_ncfile(xarray, savepath, filename='temp.nc', engine=None, dtype=None,
-                fillvalue=None):
+                fillvalue=None, atomic=False, chunks=None):
+    """save with best compression, use atomic=True to write to a temp file
+    and rename it so readers never see a partial file, chunks is a dict of
+    dim: chunksize for the on-disk (netcdf4) chunking of the variables"""
     import xarray as xr
+    import os
     print('saving {} to {}'.format(filename, savepath))
     if dtype is None:
         comp = dict(zlib=True, complevel=9, _FillValue=fillvalue)  # best compression
     else:
         comp = dict(zlib=True, complevel=9, dtype=dtype, _FillValue=fillvalue)  # best compression
     if isinstance(xarray, xr.Dataset):
-        encoding = {var: comp for var in xarray}
+        ds = xarray
     elif isinstance(xarray, xr.DataArray):
-        encoding = {var: comp for var in xarray.to_dataset()}
-    xarray.to_netcdf(savepath / filename, 'w', encoding=encoding, engine=engine)
+        ds = xarray.to_dataset()
+    encoding = {var: comp for var in ds}
+    if chunks is not None:
+        for var in ds:
+            dims = ds[var].dims
+            if dims and all(x in chunks for x in dims):
+                sizes = tuple(min(chunks[x], ds[x].size) for x in dims)
+                encoding[var] = dict(comp, chunksizes=sizes)
+    if atomic:
+        tmp = savepath / '{}.{}.tmp'.format(filename, os.getpid())
+        xarray.to_netcdf(tmp, 'w', encoding=encoding, engine=engine)
+        os.replace(tmp, savepath / filename)
+    else:
+        xarray.to_netcdf(savepath / filename, 'w', encoding=encoding, engine=engine)
     print('File saved!')
     return
 
@@ -3288,37 +3450,255 @@ def calculate_distance_between_two_lat_lon_points(
     return ddf
 
 
+_geo_spatial_index_cache = {}
+
+
+class GeoSpatialIndex(object):
+    """geodesic (great circle, spherical earth) spatial index of points,
+    e.g., GNSS sites, IMS stations or the nodes of a DEM/ERA5 grid. the
+    points are put on the unit sphere and indexed by a cKDTree, since the
+    chord length is monotonic with the great circle distance the k-nearest
+    and radius queries are exact. distances are in km"""
+    earth_radius = 6371.0088
+
+    def __init__(self, lats, lons, labels=None, shape=None, name=None):
+        import numpy as np
+        from scipy.spatial import cKDTree
+        self.lats = np.asarray(lats, dtype=float).ravel()
+        self.lons = np.asarray(lons, dtype=float).ravel()
+        if labels is not None:
+            labels = np.asarray(labels)
+        self.labels = labels
+        self.shape = shape
+        self.name = name
+        self.fingerprint = get_geo_points_fingerprint(self.lats, self.lons)
+        self.tree = cKDTree(self.to_unit_sphere(self.lats, self.lons))
+
+    @classmethod
+    def from_grid(cls, lat, lon, name=None):
+        """index the nodes of a grid, lat and lon are 1D coords or 2D
+        arrays (e.g., UERRA/WRF XLAT, XLONG)"""
+        import numpy as np
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if lat.ndim == 1:
+            lon, lat = np.meshgrid(lon, lat)
+        return cls(lat, lon, shape=lat.shape, name=name)
+
+    @staticmethod
+    def to_unit_sphere(lats, lons):
+        import numpy as np
+        lat = np.radians(lats)
+        lon = np.radians(lons)
+        return np.column_stack([np.cos(lat) * np.cos(lon),
+                                np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+    def chord_to_km(self, chord):
+        import numpy as np
+        return 2 * self.earth_radius * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    def km_to_chord(self, km):
+        import numpy as np
+        return 2 * np.sin(np.minimum(km / (2 * self.earth_radius), np.pi / 2))
+
+    def query(self, lats, lons, k=1, max_distance=None):
+        """k nearest points of each (lat, lon), returns distances (km) and
+        indices like cKDTree.query (missing neighbors have inf distance and
+        index equal to the number of points)"""
+        import numpy as np
+        xyz = self.to_unit_sphere(np.atleast_1d(lats), np.atleast_1d(lons))
+        ub = np.inf if max_distance is None else self.km_to_chord(max_distance)
+        chord, inds = self.tree.query(xyz, k=k, distance_upper_bound=ub)
+        return np.where(np.isinf(chord), np.inf, self.chord_to_km(chord)), inds
+
+    def query_radius(self, lats, lons, radius):
+        """indices of all the points within radius (km) of each (lat, lon),
+        sorted by distance, returns a list of (distances, indices)"""
+        import numpy as np
+        xyz = self.to_unit_sphere(np.atleast_1d(lats), np.atleast_1d(lons))
+        results = []
+        for p, inds in zip(xyz, self.tree.query_ball_point(xyz, self.km_to_chord(radius))):
+            inds = np.asarray(inds, dtype=int)
+            dist = self.chord_to_km(np.linalg.norm(self.tree.data[inds] - p, axis=1))
+            order = np.argsort(dist, kind='stable')
+            results.append((dist[order], inds[order]))
+        return results
+
+    def unravel(self, inds):
+        """grid (y, x) indices of flat indices for grid indexes"""
+        import numpy as np
+        return np.unravel_index(inds, self.shape)
+
+    def save(self, savepath, filename=None):
+        import joblib
+        import os
+        if filename is None:
+            filename = '{}_geo_index.pkl'.format(self.name)
+        tmp = savepath / (filename + '.tmp')
+        joblib.dump(self, tmp)
+        os.replace(tmp, savepath / filename)
+        print('{} was saved to {}.'.format(filename, savepath))
+
+
+def get_geo_points_fingerprint(lats, lons):
+    """md5 of the points coords"""
+    import hashlib
+    import numpy as np
+    m = hashlib.md5()
+    m.update(np.ascontiguousarray(lats, dtype=float).tobytes())
+    m.update(np.ascontiguousarray(lons, dtype=float).tobytes())
+    return m.hexdigest()
+
+
+def get_geo_spatial_index(lats, lons, labels=None, name=None, savepath=None,
+                          grid=False):
+    """return the GeoSpatialIndex of the points, cached in memory for the
+    process and, if savepath and name are given, on disk. the cached index
+    is rebuilt if the points coords changed. use grid=True for 1D/2D grid
+    coords"""
+    import joblib
+    import numpy as np
+    if grid:
+        lat = np.asarray(lats, dtype=float)
+        lon = np.asarray(lons, dtype=float)
+        if lat.ndim == 1:
+            lon, lat = np.meshgrid(lon, lat)
+        fp = get_geo_points_fingerprint(lat.ravel(), lon.ravel())
+    else:
+        fp = get_geo_points_fingerprint(np.ravel(lats), np.ravel(lons))
+    if fp in _geo_spatial_index_cache:
+        return _geo_spatial_index_cache[fp]
+    index = None
+    if savepath is not None and name is not None:
+        file = savepath / '{}_geo_index.pkl'.format(name)
+        if file.is_file():
+            index = joblib.load(file)
+            if index.fingerprint != fp:
+                print('{} is outdated, rebuilding.'.format(file.name))
+                index = None
+    if index is None:
+        if grid:
+            index = GeoSpatialIndex.from_grid(lats, lons, name=name)
+        else:
+            index = GeoSpatialIndex(lats, lons, labels=labels, name=name)
+        if savepath is not None and name is not None:
+            index.save(savepath)
+    _geo_spatial_index_cache[fp] = index
+    return index
+
+
 def get_nearest_lat_lon_for_xy(lat_da, lon_da, points):
     """used to access UERRA reanalysis, where the variable has x,y as coords"""
     import numpy as np
-    from scipy.spatial import cKDTree
-    if isinstance(points, np.ndarray):
-        points = list(points)
-    combined_x_y_arrays = np.dstack(
-        [lat_da.values.ravel(), lon_da.values.ravel()])[0]
-    mytree = cKDTree(combined_x_y_arrays)
+    index = get_geo_spatial_index(lat_da.values, lon_da.values, grid=True)
     points = np.atleast_2d(points)
-    dist, inds = mytree.query(points)
-    yx = []
-    for ind in inds:
-        y, x = np.unravel_index(ind, lat_da.shape)
-        yx.append([y, x])
-    return yx
+    dist, inds = index.query(points[:, 0], points[:, 1])
+    y, x = index.unravel(inds)
+    return [[yi, xi] for yi, xi in zip(y, x)]
+
+
+_dem_cache = {}
+_coarse_dem_cache = {}
+
+
+def load_dem(dem_path=work_yuval / 'AW3D30', filename='israel_dem.tif'):
+    """return the full resolution DEM as a memory-mapped DataArray (lat, lon),
+    the tif is converted once to a raw .npy file next to it and then memory
+    mapped once per process"""
+    import os
+    import numpy as np
+    import xarray as xr
+    tif = dem_path / filename
+    key = str(tif)
+    if key in _dem_cache:
+        return _dem_cache[key]
+    npy = tif.with_suffix('.npy')
+    npz = tif.with_name(tif.stem + '_coords.npz')
+    if (not npy.is_file() or not npz.is_file()
+            or npy.stat().st_mtime < tif.stat().st_mtime):
+        awd = xr.open_rasterio(tif).squeeze(drop=True)
+        values = awd.values.astype('float32')
+        nodata = awd.attrs.get('nodatavals', (None, ))[0]
+        if nodata is not None:
+            values[values == nodata] = np.nan
+        tmp = npy.with_suffix('.tmp.npy')
+        np.save(tmp, values)
+        os.replace(tmp, npy)
+        np.savez(npz, lat=awd['y'].values, lon=awd['x'].values)
+        print('{} was cached to {}.'.format(filename, npy.name))
+    coords = np.load(npz)
+    values = np.load(npy, mmap_mode='r')
+    awd = xr.DataArray(values, dims=['lat', 'lon'],
+                       coords={'lat': coords['lat'], 'lon': coords['lon']})
+    awd.name = 'alt'
+    awd.attrs['units'] = 'm'
+    _dem_cache[key] = awd
+    return awd
+
+
+def get_altitudes_of_points_using_dem(lats, lons, dem_path=work_yuval / 'AW3D30',
+                                      method='nearest', dem=None):
+    """batched elevation query on the full resolution DEM (or on the dem
+    DataArray grid if given), method is nearest (the DEM pixel, like sel) or
+    bilinear. returns NaN outside the DEM"""
+    import numpy as np
+    if dem is None:
+        awd = load_dem(dem_path)
+    else:
+        awd = dem
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    lat0 = awd['lat'].values[0]
+    lon0 = awd['lon'].values[0]
+    dlat = awd['lat'].values[1] - lat0
+    dlon = awd['lon'].values[1] - lon0
+    ny, nx = awd.shape
+    # fractional pixel indices (the lat axis is usually descending):
+    fy = (lats - lat0) / dlat
+    fx = (lons - lon0) / dlon
+    outside = (fy < -0.5) | (fy > ny - 0.5) | (fx < -0.5) | (fx > nx - 0.5)
+    outside |= np.isnan(fy) | np.isnan(fx)
+    fy = np.where(outside, 0, fy)
+    fx = np.where(outside, 0, fx)
+    if method == 'nearest':
+        iy = np.clip(np.round(fy).astype(int), 0, ny - 1)
+        ix = np.clip(np.round(fx).astype(int), 0, nx - 1)
+        alt = np.asarray(awd.values[iy, ix], dtype=float)
+    elif method == 'bilinear':
+        iy = np.clip(np.floor(fy).astype(int), 0, ny - 2)
+        ix = np.clip(np.floor(fx).astype(int), 0, nx - 2)
+        wy = np.clip(fy - iy, 0, 1)
+        wx = np.clip(fx - ix, 0, 1)
+        v = awd.values
+        alt = ((1 - wy) * (1 - wx) * v[iy, ix] + (1 - wy) * wx * v[iy, ix + 1]
+               + wy * (1 - wx) * v[iy + 1, ix] + wy * wx * v[iy + 1, ix + 1])
+    else:
+        raise ValueError('method should be bilinear or nearest')
+    return np.where(outside, np.nan, alt)
 
 
-def get_altitude_of_point_using_dem(lat, lon, dem_path=work_yuval / 'AW3D30'):
+def get_altitude_of_point_using_dem(lat, lon, dem_path=work_yuval / 'AW3D30',
+                                    method='nearest'):
+    """elevation of points from the first israel_dem*.nc grid in dem_path
+    (kept in memory for the process), lat and lon can be scalars or arrays"""
+    import numpy as np
     import xarray as xr
-    file = sorted(path_glob(dem_path, 'israel_dem*.nc'))[0]
-    awd = xr.load_dataarray(file)
-    alt = awd.sel(lon=float(lon), lat=float(lat),
-                          method='nearest').values.item()
+    # keyed by dem_path so that a repeat query does no filesystem work:
+    key = (str(dem_path), 'israel_dem*.nc')
+    if key not in _dem_cache:
+        file = sorted(path_glob(dem_path, 'israel_dem*.nc'))[0]
+        _dem_cache[key] = xr.load_dataarray(file)
+    alt = get_altitudes_of_points_using_dem(lat, lon, method=method,
+                                            dem=_dem_cache[key])
+    if np.ndim(alt) == 0:
+        return alt.item()
     return alt
 
 
 def coarse_dem(data, dem_path=work_yuval / 'AW3D30'):
-    """coarsen to data coords"""
+    """coarsen to data coords, the coarsened DEM is cached on disk and in
+    memory for the process, keyed by the target grid"""
     # data is lower resolution than awd
-    import salem
     import xarray as xr
     # determine resulotion:
     try:
@@ -3327,18 +3707,27 @@ def coarse_dem(data, dem_path=work_yuval / 'AW3D30'):
     except AttributeError:
         print('data needs to have lat and lon coords..')
         return
+    lat = data['lat'].values
+    lon = data['lon'].values
+    key = (str(dem_path), lat_size, lon_size, round(float(lat[0]), 6),
+           round(float(lat[-1]), 6), round(float(lon[0]), 6),
+           round(float(lon[-1]), 6))
+    if key in _coarse_dem_cache:
+        return _coarse_dem_cache[key]
     # check for file exist:
     filename = 'israel_dem_' + str(lon_size) + '_' + str(lat_size) + '.nc'
     my_file = dem_path / filename
     if my_file.is_file():
-        awds = xr.open_dataarray(my_file)
+        awds = xr.load_dataarray(my_file)
         print('{} is found and loaded...'.format(filename))
     else:
+        import salem
         awd = salem.open_xr_dataset(dem_path / 'israel_dem.tif')
         awds = data.salem.lookup_transform(awd)
         awds = awds['data']
         awds.to_netcdf(dem_path / filename)
         print('{} is saved to {}'.format(filename, dem_path))
+    _coarse_dem_cache[key] = awds
     return awds
 
 
@@ -3381,6 +3381,73 @@ def prepare_X_y_for_holdout_test(features='pwv+doy', model_name='SVC',
     return X, y
 
 
+def get_flood_classifier_fingerprint(features='pwv+DOY', model_name='RF',
+                                     path=hydro_path, negative_samples=1,
+                                     hp=None):
+    """return a md5 fingerprint of the training data file (name, size and
+    modification time), the features, the negative samples and the
+    hyper-parameters of the flood classifier"""
+    import hashlib
+    import json
+    from aux_gps import path_glob
+    if hp is None:
+        hp = best_hp_models_dict[model_name]
+    file = path_glob(
+        path, 'hydro_tides_hourly_features_with_positives_negatives_std*.nc')[-1]
+    stat = file.stat()
+    key = {'file': file.name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+           'features': features, 'model_name': model_name,
+           'negative_samples': negative_samples, 'hp': hp}
+    key = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def load_or_train_flood_classifier(features='pwv+DOY', model_name='RF',
+                                   path=hydro_path, savepath=None,
+                                   negative_samples=1, n_jobs=4,
+                                   retrain=False, verbose=True):
+    """return the flood classifier with the best hp trained on X, y of
+    prepare_X_y_for_holdout_test. the fitted model is saved to savepath
+    (default path/models) with the fingerprint of its training data and hp,
+    and reloaded as long as the fingerprint matches (training happens only
+    once)"""
+    import os
+    import joblib
+    if savepath is None:
+        savepath = path / 'models'
+    if not savepath.is_dir():
+        os.makedirs(savepath)
+    hp = best_hp_models_dict[model_name]
+    fp = get_flood_classifier_fingerprint(features=features,
+                                          model_name=model_name, path=path,
+                                          negative_samples=negative_samples,
+                                          hp=hp)
+    file = savepath / '{}_{}_{}.pkl'.format(model_name, features, fp)
+    if file.is_file() and not retrain:
+        model = joblib.load(file)
+        if verbose:
+            print('loaded {} from {}.'.format(file.name, savepath))
+        return model
+    if verbose:
+        print('training {} with {} features (fingerprint {}).'.format(
+            model_name, features, fp))
+    X, y = prepare_X_y_for_holdout_test(features=features,
+                                        model_name=model_name, path=path,
+                                        negative_samples=negative_samples)
+    ml = ML_Classifier_Switcher()
+    model = ml.pick_model(model_name)
+    model.set_params(**hp)
+    if 'n_jobs' in model.get_params():
+        model.set_params(n_jobs=n_jobs)
+    model.fit(X, y)
+    # write to a temp file first so a crash won't leave a broken model:
+    joblib.dump(model, savepath / (file.name + '.tmp'))
+    os.replace(savepath / (file.name + '.tmp'), file)
+    if verbose:
+        print('{} was saved to {}'.format(file.name, savepath))
+    return model
+
+
 def run_holdout_shuffled_tests_on_all_models_and_features(path=hydro_path, samples=1, test_size=0.33):
     """fit model with best HP on balanced set and test it on imbalanced set for
     each model, feature group"""
@@ -5430,30 +5497,23 @@ def check_if_tide_events_from_stations_are_within_time_window(df_list, rounding=
 
 
 def standertize_pwv_using_long_term_stat(axis_ds, hydro_path=hydro_path, filename='axis_southern_stations_stats.nc'):
-    from aux_gps import transform_time_series_groups_agg_to_time_series
+    from aux_gps import gather_climatology_table
     import xarray as xr
-    import pandas as pd
     stats = xr.load_dataset(hydro_path/filename)
     # makes sure that axis_ds has only pwv and not error
     axis_ds = axis_ds[[x for x in axis_ds if 'error' not in x]]
-    da_list = []
-    for da in axis_ds:
-        df_mean = transform_time_series_groups_agg_to_time_series(axis_ds[da], stats, stat='mean')
-        df_std = transform_time_series_groups_agg_to_time_series(axis_ds[da], stats, stat='std')
-        if df_mean is None or df_std is None:
-            print('No stats for {}, skipping...'.format(da))
-            continue
-        else:
-            print('Standertizing for {} station.'.format(da))
-        df = pd.concat([df_mean, df_std], axis=1)
-        df = df.loc[:, ~df.columns.duplicated()]
-        df['anomalies'] = (df[da] - df['mean'])/df['std']
-        da_anom = df['anomalies'].to_xarray()
-        da_anom.name = da
-        da_anom.attrs = axis_ds[da].attrs
-        da_anom.attrs['action'] = 'standertized by hour and day of year'
-        da_list.append(da_anom)
-    ds = xr.merge(da_list)
+    stations = [x for x in axis_ds if x in stats]
+    for da in set(axis_ds).difference(stations):
+        print('No stats for {}, skipping...'.format(da))
+    print('Standertizing for {} stations.'.format(', '.join(stations)))
+    # gather the mean and std of all stations at once:
+    da = axis_ds[stations].to_array('station').transpose('time', 'station')
+    mean = gather_climatology_table(da, stats[stations].sel(agg='mean', drop=True))
+    std = gather_climatology_table(da, stats[stations].sel(agg='std', drop=True))
+    ds = ((da - mean) / std).to_dataset('station')
+    for station in stations:
+        ds[station].attrs = axis_ds[station].attrs
+        ds[station].attrs['action'] = 'standertized by hour and day of year'
     return ds
 
 
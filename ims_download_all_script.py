@@ -196,27 +196,33 @@ def download_ims_single_station(stationid, savepath=None,
         """gets ims station raw data, i.e., r.json()['data'] and returns
         a pandas dataframe"""
         import pandas as pd
-        from pytz import timezone
+        from ims_procedures import parse_envista_data_to_arrays
+        # flatten all records at once and convert local time to UTC:
+        arrays = parse_envista_data_to_arrays(raw_data)
+        index = pd.DatetimeIndex(arrays['time']).tz_localize('UTC')
         if ch_name is not None:
-            datetimes = [x['datetime'] for x in raw_data]
-            # Local datetimes:
-            dts = [x.split('+')[0] for x in datetimes]
-            # bool mask for DST:
-            dts_dst = [x.split('+')[-1] for x in datetimes]
-            dst_bool = [True if x == '03:00' else False for x in dts_dst]
-            jer = timezone('Asia/Jerusalem')
-            data = [x['channels'][0] for x in raw_data]
-            df = pd.DataFrame.from_records(data, index=pd.to_datetime(dts))
-            df.drop(['alias', 'description'], axis=1, inplace=True)
-            cols = [ch_name + '_' + x for x in df.columns]
-            df.columns = cols
-            df = df.tz_localize(jer, ambiguous=dst_bool, nonexistent='shift_forward')
-            df = df.tz_convert('UTC')
+            channels = list(arrays['channel'])
+            if ch_name in channels:
+                j = channels.index(ch_name)
+            elif len(channels) == 1:
+                # a single channel is the one asked for, whatever its name:
+                j = 0
+            else:
+                raise ValueError('station {} has no {} channel, got {}.'.format(
+                    stationid, ch_name, ', '.join(channels)))
+            df = pd.DataFrame(index=index)
+            df[ch_name + '_id'] = arrays['channel_id'][j]
+            df[ch_name + '_name'] = ch_name
+            df[ch_name + '_value'] = arrays['value'][:, j]
+            df[ch_name + '_status'] = arrays['status'][:, j]
+            df[ch_name + '_valid'] = arrays['valid'][:, j]
         elif ch_name is None:
             # add all channels d/l here:
-            datetimes = [x['datetime'] for x in raw_data]
-            names = [x['name'] for x in data['channels']]
-            keys = [*data['channels'][0].keys()]
+            df = pd.DataFrame(index=index)
+            for j, name in enumerate(arrays['channel']):
+                df[name + '_value'] = arrays['value'][:, j]
+                df[name + '_status'] = arrays['status'][:, j]
+                df[name + '_valid'] = arrays['valid'][:, j]
         return df
 
     def to_dataarray(df, meta):
@@ -343,7 +349,7 @@ def download_ims_single_station(stationid, savepath=None,
             df_all[value_name] = new_vals
             df_all.index.name = 'time'
             da = to_dataarray(df_all, meta)
-            if update is not None:
+            if update is not None or savepath is None:
                 return da
             else:
                 filename = '_'.join(['-'.join(meta['name'].split(' ')), str(meta['id']), channel_name,
@@ -377,59 +383,48 @@ def download_ims_single_station(stationid, savepath=None,
 
 def download_all_10mins_ims(savepath, channel_name='TD'):
     """download all 10mins stations per specified channel, updateing fields is
-    automatic"""
-    # from aux_gps import path_glob
-    import xarray as xr
+    automatic. stations are kept in an append-only store of monthly chunks
+    (savepath/store/channel_name), updates write only the new chunks and the
+    last datetimes are read from the store index"""
+    from ims_procedures import get_ims_store_last_datetimes
+    from ims_procedures import write_ims_station_to_store
+    from ims_procedures import migrate_ims_station_files_to_store
     import logging
     logger = logging.getLogger('ims_downloader')
-    glob = '*_{}_10mins.nc'.format(channel_name)
-    files = sorted(path_glob(savepath, glob, return_empty_list=True))
-    files = [x for x in files if x.is_file()]
-    if files:
-        time_dim = list(set(xr.open_dataarray(files[0]).dims))[0]
-    last_dates = [check_ds_last_datetime(xr.open_dataarray(x)) for x in files]
-    st_id_downloaded = [int(x.as_posix().split('/')[-1].split('_')[1]) for x in files]
-    d = dict(zip(st_id_downloaded, last_dates))
+    store_path = savepath / 'store' / channel_name
+    # split the old single file stations into the store (only once):
+    migrate_ims_station_files_to_store(savepath, channel_name=channel_name,
+                                       store_path=store_path)
+    # resume from the last valid record, later records that were NaN are
+    # downloaded again and fill the store:
+    d = get_ims_store_last_datetimes(store_path, valid=True).to_dict()
     stations = ims_api_get_meta(active_only=True, channel_name=channel_name)
     for index, row in stations.iterrows():
         st_id = row['stationId']
         if st_id not in d.keys():
-            download_ims_single_station(savepath=savepath,
-                                        channel_name=channel_name,
-                                        stationid=st_id, update=None)
+            da = download_ims_single_station(savepath=None,
+                                             channel_name=channel_name,
+                                             stationid=st_id, update=None)
         elif st_id in d.keys():
             logger.info('updating station {}...'.format(st_id))
-            da = download_ims_single_station(savepath=savepath,
+            da = download_ims_single_station(savepath=None,
                                              channel_name=channel_name,
                                              stationid=st_id, update=d[st_id])
-            if da is not None:
-                file = path_glob(savepath, '*_{}_{}_10mins.nc'.format(st_id, channel_name))[0]
-                da_old = xr.load_dataarray(file)
-                da = xr.concat([da, da_old], time_dim)
-                da = da.sortby(time_dim)
-                filename = '_'.join(['-'.join(row['name'].split(' ')), str(st_id), channel_name,
-                                     '10mins']) + '.nc'
-                comp = dict(zlib=True, complevel=9)  # best compression
-                encoding = {var: comp for var in da.to_dataset().data_vars}
-                logger.info('saving to {} to {}'.format(filename, savepath))
-                try:
-                    da.to_netcdf(savepath / filename, 'w', encoding=encoding)
-                except PermissionError:
-                    (savepath / filename).unlink()
-                    da.to_netcdf(savepath / filename, 'w', encoding=encoding)
-            # print('done!')
-        else:
-            logger.warning('station {} is already in {}, skipping...'.format(st_id,
-                                                                             savepath))
+        if da is not None:
+            logger.info('appending station {} to {}'.format(st_id, store_path))
+            write_ims_station_to_store(da, store_path)
     return
 
 def merge_stations_and_divide_to_yearly_monthly_files(savepath, channel_name='TD',
                                                       year_months=None):
-    import xarray as xr
+    """build the year-month mosaics of all stations from the store
+    (savepath/store/channel_name), each month reads only its own chunks
+    lazily and is computed while saving"""
     import logging
-    # import numpy as np
     import os
-    from aux_gps import get_unique_index
+    import pandas as pd
+    from ims_procedures import read_ims_store_index
+    from ims_procedures import open_ims_store_month_mosaic
 
     def save_yearly_monthly_file(ds_ym, month_savepath, filename):
         comp = dict(zlib=True, complevel=9)  # best compression
@@ -442,12 +437,10 @@ def merge_stations_and_divide_to_yearly_monthly_files(savepath, channel_name='TD
             ds_ym.to_netcdf(month_savepath / filename, 'w', encoding=encoding)
 
     logger = logging.getLogger('ims_downloader')
-    glob = '*_{}_10mins.nc'.format(channel_name)
-    files = sorted(path_glob(savepath, glob, return_empty_list=True))
-    files = [x for x in files if x.is_file()]
-    if files:
-        time_dim = list(set(xr.open_dataarray(files[0]).dims))[0]
-    logger.info('Reading all {} stations, merging them and saving as monthly files.'.format(len(files)))
+    store_path = savepath / 'store' / channel_name
+    index = read_ims_store_index(store_path)
+    logger.info('Merging {} stations from {} and saving as monthly files.'.format(
+        index['station_id'].nunique(), store_path))
     # create year savepath:
     month_savepath = savepath / 'monthly'
     if not month_savepath.is_dir():
@@ -455,52 +448,20 @@ def merge_stations_and_divide_to_yearly_monthly_files(savepath, channel_name='TD
         logger.info('created {}.'.format(month_savepath))
     else:
         logger.info('{} already exist.'.format(month_savepath))
-    # load stations list:
-    dsl = [xr.open_dataset(x) for x in files]
-    dsl = [x.sortby(time_dim) for x in dsl]
     if year_months is None:
-        # this merge over the years is very slow, run it only once:
-        # ds = xr.merge(dsl)
-        yr_min = min([x[time_dim].min().dt.year.item() for x in dsl])
-        mnth_min = min([x[time_dim].min().dt.month.item() for x in dsl])
-        yr_max = max([x[time_dim].max().dt.year.item() for x in dsl])
-        mnth_max = max([x[time_dim].max().dt.month.item() for x in dsl])
-        start = pd.to_datetime('{}-{}'.format(yr_min, mnth_min), format='%Y-%m')
-        end = pd.to_datetime('{}-{}'.format(yr_max, mnth_max), format='%Y-%m')
-        # years = np.arange(yr_min, yr_max + 1)
-        dts = pd.date_range(start=start, end=end, freq='m')
-        dts=[x.strftime('%Y-%m') for x in dts]
-        logger.info('Found {}-{} as years.'.format(yr_min, yr_max))
-        for dt in dts:
-            ds_dt_list = []
-            for ds in dsl:
-                try:
-                    ds_ym = ds.sel({time_dim: dt})
-                    ds_ym = get_unique_index(ds_ym, dim=time_dim)
-                except KeyError:
-                    continue
-                ds_dt_list.append(ds_ym)
-            # ds_year = [x.load() for x in ds_year]
-            ds_yms = xr.merge(ds_dt_list)
-            # ds_year = ds.sel({time_dim: str(year)})
-            filename = 'IMS_ALL_{}_{}.nc'.format(channel_name, dt)
-            save_yearly_monthly_file(ds_yms, month_savepath, filename)
+        # all the months in the store, straight from the index:
+        dts = sorted(index['month'].unique())
+        logger.info('Found {} to {} as year-months.'.format(dts[0], dts[-1]))
     else:
         logger.info('Using user supplied dts {}.'.format(year_months))
-        for dt in year_months:
-            ds_dt_list = []
-            for ds in dsl:
-                try:
-                    ds_ym = ds.sel({time_dim: dt})
-                    ds_ym = get_unique_index(ds_ym, dim=time_dim)
-                except KeyError:
-                    continue
-                ds_dt_list.append(ds_ym)
-            # ds_year = [x.load() for x in ds_year]
-            ds_yms = xr.merge(ds_dt_list)
-            # ds_year = ds.sel({time_dim: str(year)})
-            filename = 'IMS_ALL_{}_{}.nc'.format(channel_name, dt)
-            save_yearly_monthly_file(ds_yms, month_savepath, filename)
+        dts = [pd.to_datetime(x).strftime('%Y-%m') for x in year_months]
+    for dt in dts:
+        ds_yms = open_ims_store_month_mosaic(dt, store_path)
+        if not ds_yms.data_vars:
+            logger.warning('no stations found for {}, skipping...'.format(dt))
+            continue
+        filename = 'IMS_ALL_{}_{}.nc'.format(channel_name, dt)
+        save_yearly_monthly_file(ds_yms, month_savepath, filename)
     logger.info('Done saving IMS yearly {} files.'.format(channel_name))
 
 
@@ -508,20 +469,20 @@ def post_process_ims_stations(month_savepath, gis_path, dem_path,
                               stats_path, pw_path, year_months=None):
     """fill TD with hourly mean if NaN and smooth, then fill in station_lat
     and lon and alt from DEM, finally interpolate to SOI coords and save"""
-    # from aux_gps import fill_na_xarray_time_series_with_its_group
-    from aux_gps import transform_time_series_groups_agg_to_time_series
+    from aux_gps import fill_na_with_climatology_table
     from ims_procedures import analyse_10mins_ims_field
     # from axis_process import produce_rinex_filenames_at_time_window
     from ims_procedures import IMS_interpolating_to_GNSS_stations_israel
     from aux_gps import save_ncfile
     from aux_gps import path_glob
-    # import pandas as pd
+    import pandas as pd
     import xarray as xr
     # load IMS stats data for the stations:
     ds_stats = xr.load_dataset(stats_path/'IMS_TD_month_hour_stats.nc')
     # first select all or some years of IMS data from month_savepath
     files = sorted(path_glob(month_savepath, 'IMS_ALL_TD_*.nc'))
     if year_months is not None:
+        year_months = [pd.to_datetime(x).strftime('%Y-%m') for x in year_months]
         new_files = []
         for file in files:
             year_month = file.as_posix().split('/')[-1].split('.')[0].split('_')[-1]
@@ -533,17 +494,12 @@ def post_process_ims_stations(month_savepath, gis_path, dem_path,
         year = int(year_month.split('-')[0])
         logger.info('Performing post proccess on IMS TD for {}.'.format(year_month))
         ds = xr.load_dataset(file)
-        das = []
-        for da in ds:
-            df_trans = transform_time_series_groups_agg_to_time_series(ds[da], ds_stats, stat='mean')
-            df_trans[da] = df_trans[da].fillna(df_trans['mean'])
-            da_filled = df_trans[da].to_xarray()
-            da_filled.attrs = ds[da].attrs
-            if da_filled is None:
-                logger.warning('could not find {} station in stats, skipping...'.format(da))
-                continue
-            das.append(da_filled)
-        ds = xr.merge(das)
+        stations = [x for x in ds if x in ds_stats]
+        for da in set(ds).difference(stations):
+            logger.warning('could not find {} station in stats, skipping...'.format(da))
+        # fill all stations at once with their (month, hour) mean:
+        ds = fill_na_with_climatology_table(
+            ds[stations], ds_stats[stations].sel(agg='mean', drop=True))
         ds = analyse_10mins_ims_field(ds=ds, var='TD', gis_path=gis_path,
                                       dem_path=dem_path)
         if int(year) >= 1996:
@@ -563,13 +519,86 @@ def post_process_ims_stations(month_savepath, gis_path, dem_path,
     return ds
 
 
-def produce_pwv_all_stations(td_month_path, rinex_path, mda_path):
-    from PW_stations import load_mda
+_pwv_worker_inputs = {}
+
+
+def _init_pwv_worker(td_npy, times, stations, mda):
+    """load the shared inputs once per worker, TD values are memory mapped"""
+    import numpy as np
+    _pwv_worker_inputs['td'] = np.load(td_npy, mmap_mode='r')
+    _pwv_worker_inputs['time'] = times
+    _pwv_worker_inputs['stations'] = stations
+    _pwv_worker_inputs['mda'] = mda
+    return
+
+
+def _produce_pwv_one_station(st_dir):
+    """produce and save the PWV of a single station, returns the station name
+    and a (level, message) list for the parent to log"""
     from PW_stations import produce_GNSS_station_PW
     from aux_gps import fill_na_xarray_time_series_with_its_group
-    from aux_gps import path_glob
     from aux_gps import save_ncfile
     import xarray as xr
+    station = st_dir.as_posix().split('/')[-1]
+    stations = _pwv_worker_inputs['stations']
+    msgs = []
+    if station not in stations:
+        msgs.append(('error', '{} not found in temperature database, skipping...'.format(station)))
+        return station, msgs
+    file = st_dir/'gipsyx_solutions/{}_PPP_all_years.nc'.format(station.upper())
+    if not file.is_file():
+        msgs.append(('error', '{} not found in PPP gipsyx solutions, skipping...'.format(station)))
+        return station, msgs
+    with xr.open_dataset(file) as ds:
+        ds = ds[['WetZ', 'WetZ_error']].squeeze(drop=True).load()
+    msgs.append(('info', 'loaded {}.'.format(file)))
+    wet = ds['WetZ']
+    wet_error = ds['WetZ_error']
+    wet.name = station
+    wet_error.name = station
+    # only this station's column is read from the memory mapped TD:
+    j = stations.index(station)
+    t = xr.DataArray(_pwv_worker_inputs['td'][:, j],
+                     dims=['time'], coords={'time': _pwv_worker_inputs['time']})
+    t.name = station
+    # resample temp to 5 mins and reindex to wet delay time:
+    t = t.resample(time='5T').ffill().reindex_like(wet.time)
+    # fill in NaNs with mean hourly signal:
+    try:
+        t_new = fill_na_xarray_time_series_with_its_group(t, grp='hour')
+    except ValueError as e:
+        msgs.append(('warning', 'encountered error: {}, skipping {}'.format(e, file)))
+        return station, msgs
+    try:
+        mda = _pwv_worker_inputs['mda']
+        pwv = produce_GNSS_station_PW(wet, t_new, mda=mda,
+                                      model_name='LR', plot=False)
+        pwv_error = produce_GNSS_station_PW(wet_error, t_new, mda=mda,
+                                            model_name='LR', plot=False)
+        pwv_error.name = '{}_error'.format(pwv.name)
+        pwv_ds = xr.merge([pwv, pwv_error])
+        filename = '{}_PWV_all_years.nc'.format(station.upper())
+        # write to a temp file and rename so a crashed worker never leaves a
+        # truncated PWV file behind:
+        save_ncfile(pwv_ds, st_dir/'gipsyx_solutions', filename, atomic=True)
+    except ValueError as e:
+        msgs.append(('warning', 'encountered error: {}, skipping {}'.format(e, file)))
+    return station, msgs
+
+
+def produce_pwv_all_stations(td_month_path, rinex_path, mda_path, n_jobs=4):
+    """produce PWV for all GNSS stations in rinex_path, the TD and mda model
+    are loaded once and shared with n_jobs worker processes, the TD is written
+    once to a temp .npy file that the workers memory map"""
+    from PW_stations import load_mda
+    from aux_gps import path_glob
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import as_completed
+    import xarray as xr
+    import numpy as np
+    import tempfile
+    import shutil
+    import os
     # first load mda:
     mda = load_mda(mda_path)
     # now load and concat all TD with GNSS - SOI stations:
@@ -577,47 +606,41 @@ def produce_pwv_all_stations(td_month_path, rinex_path, mda_path):
     td_list = [xr.load_dataset(x) for x in td_files]
     td = xr.concat(td_list, 'time')
     td = td.sortby('time')
+    stations = [x for x in td.data_vars]
     # now loop over each station path, produce pwv and save:
     st_dirs = path_glob(rinex_path, '*/')
     st_dirs = [x for x in st_dirs if x.is_dir()]
     # st_dirs = [x for x in st_dirs if not x.as_posix().split('/')[-1].isnumeric()]
     # assert len(st_dirs) == 27
-    pwv_list = []
-    for st_dir in st_dirs:
-        station = st_dir.as_posix().split('/')[-1]
-        if station not in td:
-            logger.error('{} not found in temperature database, skipping...'.format(station))
-            continue
-        file = st_dir/'gipsyx_solutions/{}_PPP_all_years.nc'.format(station.upper())
-        if not file.is_file():
-            logger.error('{} not found in PPP gipsyx solutions, skipping...'.format(station))
-            continue
-        wet = xr.open_dataset(file)['WetZ'].squeeze(drop=True)
-        logger.info('loaded {}.'.format(file))
-        wet_error = xr.open_dataset(file)['WetZ_error'].squeeze(drop=True)
-        wet.name = station
-        wet_error.name = station
-        # resample temp to 5 mins and reindex to wet delay time:
-        t = td[station].resample(time='5T').ffill().reindex_like(wet.time)
-        # fill in NaNs with mean hourly signal:
-        try:
-            t_new = fill_na_xarray_time_series_with_its_group(t, grp='hour')
-        except ValueError as e:
-            logger.warning('encountered error: {}, skipping {}'.format(e, file))
-            continue
-        try:
-            pwv = produce_GNSS_station_PW(wet, t_new, mda=mda,
-                                          model_name='LR', plot=False)
-            pwv_error = produce_GNSS_station_PW(wet_error, t_new, mda=mda,
-                                                model_name='LR', plot=False)
-            pwv_error.name = '{}_error'.format(pwv.name)
-            pwv_ds = xr.merge([pwv, pwv_error])
-            filename = '{}_PWV_all_years.nc'.format(station.upper())
-            save_ncfile(pwv_ds, st_dir/'gipsyx_solutions', filename)
-            pwv_list.append(pwv_ds)
-        except ValueError as e:
-            logger.warning('encountered error: {}, skipping {}'.format(e, file))
-            continue
+    tmpdir = tempfile.mkdtemp(prefix='pwv_td_')
+    try:
+        td_npy = os.path.join(tmpdir, 'td.npy')
+        np.save(td_npy, np.stack([td[x].values for x in stations], axis=1))
+        initargs = (td_npy, td['time'].values, stations, mda)
+        del td, td_list
+        n_jobs = max(1, min(n_jobs, len(st_dirs)))
+        if n_jobs == 1:
+            _init_pwv_worker(*initargs)
+            results = (_produce_pwv_one_station(x) for x in st_dirs)
+            _log_pwv_results(results)
+        else:
+            logger.info('producing PWV for {} stations with {} workers.'.format(len(st_dirs), n_jobs))
+            with ProcessPoolExecutor(max_workers=n_jobs,
+                                     initializer=_init_pwv_worker,
+                                     initargs=initargs) as executor:
+                futures = [executor.submit(_produce_pwv_one_station, x)
+                           for x in st_dirs]
+                _log_pwv_results(x.result() for x in as_completed(futures))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return
+
+
+def _log_pwv_results(results):
+    for station, msgs in results:
+        for level, msg in msgs:
+            getattr(logger, level)(msg)
+    return
 
 
 if __name__ == '__main__':
@@ -658,6 +681,8 @@ if __name__ == '__main__':
 #                          e.g, 1 or 2', type=int, choices=[1, 2],
 #                          metavar='1 or 2')
     required.add_argument('--last_2_months', action='store_true')
+    optional.add_argument('--n_jobs', help='number of worker processes for PWV production',
+                          type=int, default=4)
     optional.add_argument('--datetimes', help="select the year-months that the IMS stations are saved as yearly files",
                           type=str,
                           nargs='+')
@@ -688,7 +713,8 @@ if __name__ == '__main__':
         post_process_ims_stations(args.savepath/'monthly', args.gis_path, args.dem_path,
                                   args.savepath, args.pw_path, year_months=args.datetimes)
         # now use ts-tm model to convert WetZ into PWV and save:
-        produce_pwv_all_stations(args.savepath/'monthly', work_yuval/'GNSS_stations', args.mda_path)
+        produce_pwv_all_stations(args.savepath/'monthly', work_yuval/'GNSS_stations', args.mda_path,
+                                 n_jobs=args.n_jobs)
         logger.info('Done!')
     elif args.delete:
         generate_delete(args.savepath, args.channel)
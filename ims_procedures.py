@@ -687,6 +687,67 @@ def parse_cv_results(grid_search_cv):
     return cds
 
 
+def interpolate_ims_to_gnss_sites(tdf, T_geo, gnss_df, lapse_rate='auto',
+                                  method='okrig', variogram='spherical',
+                                  n_neighbors=3, lr_bounds=[5.0, 10.0],
+                                  weights_cache=None, verbose=False):
+    """batched temperature at the GNSS sites from the IMS stations.
+    tdf is a (time, IMS station) dataframe, T_geo has station_lat,
+    station_lon and station_alt for its columns and gnss_df has lat, lon and
+    alt. the lapse rate regression is solved for all the times at once
+    ('auto' is clipped to lr_bounds degC/km), the lapse rate neutral field
+    is interpolated (okrig or knn) with the weights cached per availability
+    pattern of the IMS stations and the lapse rate is restored at the GNSS
+    sites altitudes. returns Ts(time, station) and the lapse rate(time)"""
+    import numpy as np
+    import xarray as xr
+    from interpolation_routines import batched_linear_fit
+    from interpolation_routines import batched_ordinary_kriging
+    from interpolation_routines import batched_knn_interpolation
+    values = tdf[T_geo.index].values.astype(float)
+    alts = T_geo['station_alt'].values.astype(float)
+    lats = T_geo['station_lat'].values.astype(float)
+    lons = T_geo['station_lon'].values.astype(float)
+    if lapse_rate == 'auto':
+        slope, _, _ = batched_linear_fit(alts, values)
+        lr = np.clip(np.abs(slope) * 1000, lr_bounds[0], lr_bounds[1])
+    else:
+        lr = np.full(values.shape[0], float(lapse_rate))
+    # neutrilize the lapse rate effect:
+    neutral = values + lr[:, None] * alts[None, :] / 1000.0
+    if method == 'okrig':
+        if variogram is None:
+            variogram = 'linear'
+        Ts = batched_ordinary_kriging(lons, lats, neutral,
+                                      gnss_df['lon'].values,
+                                      gnss_df['lat'].values,
+                                      variogram_model=variogram,
+                                      coordinates_type='euclidean',
+                                      weights_cache=weights_cache,
+                                      verbose=verbose)
+    elif method == 'knn':
+        if n_neighbors is None:
+            n_neighbors = 5
+        Ts = batched_knn_interpolation(lons, lats, neutral,
+                                       gnss_df['lon'].values,
+                                       gnss_df['lat'].values,
+                                       n_neighbors=n_neighbors,
+                                       weights_cache=weights_cache,
+                                       verbose=verbose)
+    else:
+        raise Exception('{} is not supported yet...'.format(method))
+    # fix for lapse rate:
+    Ts -= lr[:, None] * gnss_df['alt'].values[None, :] / 1000.0
+    da = xr.DataArray(Ts, dims=['time', 'station'])
+    da['time'] = tdf.index.values
+    da['station'] = gnss_df.index.values
+    da.attrs['units'] = 'degC'
+    lr_da = xr.DataArray(lr, dims=['time'])
+    lr_da['time'] = tdf.index.values
+    lr_da.attrs['units'] = 'degC/km'
+    return da, lr_da
+
+
 def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
                                               stations=None,
                                               lapse_rate='auto',
@@ -707,88 +768,13 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
     of the GNSS sites in ISRAEL(use dt=None for this). other dt is treated
     as datetime str and will give the "snapshot" for the field for just this
     datetime"""
-    from pykrige.rk import Krige
     import pandas as pd
     from aux_gps import path_glob
     import xarray as xr
-    import numpy as np
     import seaborn as sns
     import matplotlib.pyplot as plt
     import geopandas as gpd
-    from sklearn.neighbors import KNeighborsRegressor
     from axis_process import read_axis_stations
-    # import time
-
-    def pick_model(method, variogram, n_neighbors):
-        if method == 'okrig':
-            if variogram is not None:
-                model = Krige(method='ordinary', variogram_model=variogram,
-                              verbose=False)
-            else:
-                model = Krige(method='ordinary', variogram_model='linear',
-                              verbose=False)
-        elif method == 'knn':
-            if n_neighbors is None:
-                model = KNeighborsRegressor(n_neighbors=5, weights='distance')
-            else:
-                model = KNeighborsRegressor(
-                    n_neighbors=n_neighbors, weights='distance')
-        else:
-            raise Exception('{} is not supported yet...'.format(method))
-        return model
-
-    def prepare_Xy(ts_lr_neutral, T_lats, T_lons):
-        import numpy as np
-        df = ts_lr_neutral.to_frame()
-        df['lat'] = T_lats
-        df['lon'] = T_lons
-        # df = df.dropna(axis=0)
-        c = np.linspace(
-            df['lat'].min(),
-            df['lat'].max(),
-            df['lat'].shape[0])
-        r = np.linspace(
-            df['lon'].min(),
-            df['lon'].max(),
-            df['lon'].shape[0])
-        rr, cc = np.meshgrid(r, c)
-        vals = ~np.isnan(ts_lr_neutral)
-        X = np.column_stack([rr[vals, vals], cc[vals, vals]])
-        # rr_cc_as_cols = np.column_stack([rr.flatten(), cc.flatten()])
-        # y = da_scaled/home/shlomi/geo_ariel_home/Python_Projects/PW_from_GPS/*.*.values[vals]
-        y = ts_lr_neutral[vals]
-        return X, y
-
-    def neutrilize_t(ts_vs_alt, lapse_rate):
-        ts_lr_neutral = (ts_vs_alt +
-                         lapse_rate *
-                         ts_vs_alt.index /
-                         1000.0)
-        return ts_lr_neutral
-
-    def choose_dt_and_lapse_rate(tdf, dt, T_alts, lapse_rate):
-        ts = tdf.loc[dt, :]
-        # dt_col = dt.strftime('%Y-%m-%d %H:%M')
-        # ts.name = dt_col
-        # Tloc_df = Tloc_df.join(ts, how='right')
-        # Tloc_df = Tloc_df.dropna(axis=0)
-        ts_vs_alt = pd.Series(ts.values, index=T_alts)
-        ts_vs_alt_for_fit = ts_vs_alt.dropna()
-#        try:
-        [a, b] = np.polyfit(ts_vs_alt_for_fit.index.values,
-                            ts_vs_alt_for_fit.values, 1)
-#        except TypeError as e:
-#            print('{}, dt: {}'.format(e, dt))
-#            print(ts_vs_alt)
-#            return
-        if lapse_rate == 'auto':
-            lapse_rate = np.abs(a) * 1000
-            if lapse_rate < 5.0:
-                lapse_rate = 5.0
-            elif lapse_rate > 10.0:
-                lapse_rate = 10.0
-        return ts_vs_alt, lapse_rate
-#    import time
     dt = pd.to_datetime(dt)
     # read Israeli GNSS sites coords:
     if network == 'soi-apn':
@@ -809,10 +795,6 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
         print('selected only {} stations'.format(stations))
     else:
         print('selected all {} stations.'.format(network))
-    # prepare lats and lons of gnss sites:
-    gps_lats = np.linspace(df.lat.min(), df.lat.max(), df.lat.values.shape[0])
-    gps_lons = np.linspace(df.lon.min(), df.lon.max(), df.lon.values.shape[0])
-    gps_lons_lats_as_cols = np.column_stack([gps_lons, gps_lats])
     # load IMS temp data:
     if ds_td is None:
         glob_str = 'IMS_TD_israeli_10mins*.nc'
@@ -851,10 +833,12 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
     # use this to solve for a specific datetime:
     if dt is not None:
         dt_col = dt.strftime('%Y-%m-%d %H:%M')
-#        t0 = time.time()
-        # prepare the ims coords and temp df(Tloc_df) and the lapse rate:
-        ts_vs_alt, lapse_rate = choose_dt_and_lapse_rate(
-            tdf, dt, T_alts, lapse_rate)
+        # interpolate with the lapse rate of this datetime:
+        Ts, lapse_rates = interpolate_ims_to_gnss_sites(
+            tdf.loc[[dt]], T_geo, df, lapse_rate=lapse_rate, method=method,
+            variogram=variogram, n_neighbors=n_neighbors, verbose=verbose)
+        lapse_rate = lapse_rates.item()
+        ts_vs_alt = pd.Series(tdf.loc[dt, :].values, index=T_alts)
         if plot:
             fig, ax_lapse = plt.subplots(figsize=(10, 6))
             sns.regplot(x=ts_vs_alt.index, y=ts_vs_alt.values, color='r',
@@ -868,45 +852,24 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
                           fontweight='bold')
             ax_lapse.grid()
             ax_lapse.set_title(suptitle, fontsize=14, fontweight='bold')
-        # neutrilize the lapse rate effect:
-        ts_lr_neutral = neutrilize_t(ts_vs_alt, lapse_rate)
-        # prepare the regressors(IMS stations coords) and the
-        # target(IMS temperature at the coords):
-        X, y = prepare_Xy(ts_lr_neutral, T_lats, T_lons)
-        # pick the model and params:
-        model = pick_model(method, variogram, n_neighbors)
-        # fit the model:
-        model.fit(X, y)
-        # predict at the GNSS stations coords:
-        interpolated = model.predict(
-            gps_lons_lats_as_cols).reshape((gps_lats.shape))
-        # add prediction to df:
+        interpolated = Ts.isel(time=0).values
+        # add prediction (with the lapse rate fix) to df:
         df[dt_col] = interpolated
-        # fix for lapse rate:
-        df[dt_col] -= lapse_rate * df['alt'] / 1000.0
         # concat gnss stations and Tloc DataFrames:
         Tloc_df = pd.DataFrame(T_lats, index=tdf.columns)
         Tloc_df.columns = ['lat']
         Tloc_df['lon'] = T_lons
         Tloc_df['alt'] = T_alts
         all_df = pd.concat([df, Tloc_df], axis=0)
-        # fname = gis_path / 'ne_10m_admin_0_sovereignty.shp'
-        # fname = gis_path / 'gadm36_ISR_0.shp'
-        # ax = plt.axes(projection=ccrs.PlateCarree())
         da = xr.DataArray(interpolated, dims='station')
         da['station'] = df.index
-        # da = da.expand_dims('time')
         da['time'] = pd.to_datetime(dt)
-        # da = da.sortby('time')
         ds = da.to_dataset(dim='station')
         for da in ds:
             ds[da].attrs['units'] = 'degC'
         if plot:
             fig, ax = plt.subplots(figsize=(6, 10))
-            # shdf = salem.read_shapefile(salem.get_demo_file('world_borders.shp'))
-            # shdf = salem.read_shapefile(gis_path / 'Israel_and_Yosh.shp')
             isr = gpd.read_file(gis_path / 'Israel_and_Yosh.shp')
-            # shdf = shdf.loc[shdf['CNTRY_NAME'] == 'Israel']  # remove other countries
             isr.crs = {'init': 'epsg:4326'}
             time_snap = gpd.GeoDataFrame(all_df, geometry=gpd.points_from_xy(all_df.lon,
                                                                              all_df.lat),
@@ -923,85 +886,18 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
             suptitle = dt.strftime('%Y-%m-%d %H:%M')
             fig.suptitle(suptitle, fontsize=14, fontweight='bold')
     else:
-        # do the above (except plotting) for the entire data, saving each year:
+        # do the above (except plotting) for the entire data in one pass,
+        # the weights are cached per availability pattern of IMS stations:
+        print('interpolating {} datetimes to {} GNSS sites.'.format(len(tdf), len(df)))
+        Ts, _ = interpolate_ims_to_gnss_sites(
+            tdf, T_geo, df, lapse_rate=lapse_rate, method=method,
+            variogram=variogram, n_neighbors=n_neighbors,
+            weights_cache={}, verbose=verbose)
+        # save each year:
         for year in years:
-            dts = tdf.index[tdf.index.year == year]
-            # read Israeli GNSS sites coords again:
-            if network == 'soi-apn':
-                df = pd.read_csv(
-                    soi_path /
-                    'israeli_gnss_coords.txt',
-                    delim_whitespace=True,
-                    header=0)
-            elif network == 'axis':
-                df = read_axis_stations(path=axis_path)
-            cnt = 1
-            dt_col_list = []
-            inter_list = []
-            # t0 = time.time()
-#            t1 = time.time()
-#            t2 = time.time()
-#            t3 = time.time()
-#            t4 = time.time()
-#            t5 = time.time()
-#            t6 = time.time()
-#            t7 = time.time()
-#            t8 = time.time()
-            for dt in dts:
-                dt_col = dt.strftime('%Y-%m-%d %H:%M')
-                if np.mod(cnt, 144) == 0:
-                    # t1 = time.time()
-                    print('working on {}'.format(dt_col))
-                    # print('time1:{:.2f} seconds'.format(t1-t0))
-                    # t0 = time.time()
-                # prepare the ims coords and temp df(Tloc_df) and
-                # the lapse rate:
-                ts_vs_alt, lapse_rate = choose_dt_and_lapse_rate(
-                    tdf, dt, T_alts, lapse_rate)
-#                if np.mod(cnt, 144) == 0:
-#                    t2 = time.time()
-#                    print('time2: {:.4f}'.format((t2-t1)*144))
-                # neutrilize the lapse rate effect:
-                ts_lr_neutral = neutrilize_t(ts_vs_alt, lapse_rate)
-                # prepare the regressors(IMS stations coords) and the
-                # target(IMS temperature at the coords):
-#                if np.mod(cnt, 144) == 0:
-#                    t3 = time.time()
-#                    print('time3: {:.4f}'.format((t3-t2)*144))
-                X, y = prepare_Xy(ts_lr_neutral, T_lats, T_lons)
-#                if np.mod(cnt, 144) == 0:
-#                    t4 = time.time()
-#                    print('time4: {:.4f}'.format((t4-t3)*144))
-                # pick model and params:
-                model = pick_model(method, variogram, n_neighbors)
-#                if np.mod(cnt, 144) == 0:
-#                    t5 = time.time()
-#                    print('time5: {:.4f}'.format((t5-t4)*144))
-                # fit the model:
-                model.fit(X, y)
-#                if np.mod(cnt, 144) == 0:
-#                    t6 = time.time()
-#                    print('time6: {:.4f}'.format((t6-t5)*144))
-                # predict at the GNSS stations coords:
-                interpolated = model.predict(
-                    gps_lons_lats_as_cols).reshape((gps_lats.shape))
-#                if np.mod(cnt, 144) == 0:
-#                    t7 = time.time()
-#                    print('time7: {:.4f}'.format((t7-t6)*144))
-                # fix for lapse rate:
-                interpolated -= lapse_rate * df['alt'].values / 1000.0
-#                if np.mod(cnt, 144) == 0:
-#                    t8 = time.time()
-#                    print('time8: {:.4f}'.format((t8-t7)*144))
-                # add to list:
-                dt_col_list.append(dt_col)
-                inter_list.append(interpolated)
-                cnt += 1
-            # convert to dataset:
-            # da = xr.DataArray(df.iloc[:, 3:].values, dims=['station', 'time'])
-            da = xr.DataArray(inter_list, dims=['time', 'station'])
-            da['station'] = df.index
-            da['time'] = pd.to_datetime(dt_col_list)
+            da = Ts.sel(time=Ts['time.year'] == year)
+            if da['time'].size == 0:
+                continue
             da = da.sortby('time')
             ds = da.to_dataset(dim='station')
             for da in ds:
@@ -1015,7 +911,6 @@ def IMS_interpolating_to_GNSS_stations_israel(dt='2013-10-19T22:00:00',
                     filename = 'GNSS_TD_{}.nc'.format(year)
                 ds.to_netcdf(savepath / filename, 'w')
                 print('saved {} to {}'.format(filename, savepath))
-            # return
         if concat_all_TD and savepath is not None:
             print('concatenating all TD years...')
             concat_GNSS_TD(savepath)
@@ -1138,6 +1033,7 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
     from scipy.interpolate import griddata
     from sklearn.metrics import mean_squared_error
     from aux_gps import coarse_dem
+    from interpolation_routines import MeshStationGrid
     import seaborn as sns
     import matplotlib.pyplot as plt
     import pyproj
@@ -1187,18 +1083,14 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
         ax_lapse.grid()
         ax_lapse.set_title(suptitle, fontsize=14, fontweight='bold')
 #     fig.suptitle(suptitle, fontsize=14, fontweight='bold')
-    alts = []
-    for i, row in geo_snap.iterrows():
-        lat = da.sel(lat=row['lat'], method='nearest').lat.values
-        lon = da.sel(lon=row['lon'], method='nearest').lon.values
-        alt = row['alt']
-        if lapse_rate is not None and var == 'TD':
-            da.loc[{'lat': lat, 'lon': lon}] = row[var] + \
-                lapse_rate * alt / 1000.0
-            alts.append(alt)
-        elif lapse_rate is None or var != 'TD':
-            da.loc[{'lat': lat, 'lon': lon}] = row[var]
-            alts.append(alt)
+    grid = MeshStationGrid(geo_snap['lat'].values, geo_snap['lon'].values,
+                           da['lat'].values, da['lon'].values)
+    if lapse_rate is not None and var == 'TD':
+        da.values = grid.scatter(geo_snap[var].values + lapse_rate *
+                                 geo_snap['alt'].values / 1000.0)[0]
+    else:
+        da.values = grid.scatter(geo_snap[var].values)[0]
+    alts = grid.scatter(geo_snap['alt'].values)[0][grid.mask]
     # da_scaled = scale_xr(da)
     c = np.linspace(min(da.lat.values), max(da.lat.values), da.shape[0])
     r = np.linspace(min(da.lon.values), max(da.lon.values), da.shape[1])
@@ -1354,17 +1246,8 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
     if lapse_rate is not None and var == 'TD':
         da_inter -= lapse_rate * awd / 1000.0
     if (rms is not None and cv is None):  # or (rms is not None and not u):
-        predicted = []
-        true_vals = []
-        for i, row in geo_snap.iterrows():
-            lat = da.sel(lat=row['lat'], method='nearest').lat.values
-            lon = da.sel(lon=row['lon'], method='nearest').lon.values
-            pred = da_inter.loc[{'lat': lat, 'lon': lon}].values.item()
-            true = row[var]
-            predicted.append(pred)
-            true_vals.append(true)
-        predicted = np.array(predicted)
-        true_vals = np.array(true_vals)
+        predicted = grid.unscatter(da_inter.values)
+        true_vals = geo_snap[var].values
         ms_error = mean_squared_error(true_vals, predicted)
         print("MSE: {:.5f}".format(ms_error))
     if plot:
@@ -1441,15 +1324,9 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
 
 def create_lat_lon_mesh(lats=[29.5, 33.5], lons=[34, 36],
                         points_per_degree=1000):
-    import xarray as xr
-    import numpy as np
-    lat = np.arange(lats[0], lats[1], 1.0 / points_per_degree)
-    lon = np.arange(lons[0], lons[1], 1.0 / points_per_degree)
-    nans = np.nan * np.ones((len(lat), len(lon)))
-    da = xr.DataArray(nans, dims=['lat', 'lon'])
-    da['lat'] = lat
-    da['lon'] = lon
-    return da
+    from interpolation_routines import create_lat_lon_mesh
+    return create_lat_lon_mesh(lats=lats, lons=lons,
+                               points_per_degree=points_per_degree)
 
 
 # def read_save_ims_10mins(path=ims_10mins_path, var='TD'):
@@ -1477,9 +1354,8 @@ def analyse_10mins_ims_field(path=ims_10mins_path, var='TD',
     import xarray as xr
     import collections
     import numpy as np
+    from aux_gps import get_altitudes_of_points_using_dem
     # TODO: make 2d histogram of stations by altitude and time...
-    awd = xr.open_rasterio(dem_path / 'israel_dem.tif')
-    awd = awd.squeeze(drop=True)
     if ds is None:
         filename = 'ims_' + var + '_10mins.nc'
         ds = xr.open_dataset(path / filename)
@@ -1503,6 +1379,7 @@ def analyse_10mins_ims_field(path=ims_10mins_path, var='TD',
                 dup_size,
                 replace_values))
         meta.loc[meta['alt'] == dup, 'alt'] = replace_values
+    geo = {}
     for da in ds.data_vars.keys():
         id_ = ds[da].attrs['station_id']
         try:
@@ -1518,14 +1395,19 @@ def analyse_10mins_ims_field(path=ims_10mins_path, var='TD',
                 lat = None
                 lon = None
             alt = 'None'
-        try:
-            alt = awd.sel(x=float(lon), y=float(lat),
-                          method='nearest').values.item()
-        except ValueError:
+        geo[da] = [lat, lon, alt]
+    # query the DEM for all the stations at once:
+    lats = np.array([np.nan if x[0] is None else float(x[0]) for x in geo.values()])
+    lons = np.array([np.nan if x[1] is None else float(x[1]) for x in geo.values()])
+    dem_alts = get_altitudes_of_points_using_dem(lats, lons, dem_path=dem_path)
+    for (da, (lat, lon, alt)), dem_alt in zip(geo.items(), dem_alts):
+        if lat is None or lon is None:
+            print('no lat or lon')
+        elif np.isnan(dem_alt):
             print('station {} has not known lat or lon...'.format(
                 ds[da].attrs['station_name']))
-        except TypeError:
-            print('no lat or lon')
+        else:
+            alt = dem_alt
         ds[da].attrs['station_lat'] = lat
         ds[da].attrs['station_lon'] = lon
         ds[da].attrs['station_alt'] = alt
@@ -1836,6 +1718,395 @@ def ims_api_get_meta(active_only=True, channel_name='TD'):
     return stations_10mins
 
 
+def convert_envista_datetimes_to_utc(datetimes, tz='Asia/Jerusalem'):
+    """convert the envista API datetime strings (local time with utc offset,
+    e.g., 2020-01-01T00:10:00+02:00) to naive UTC datetime64 in one go.
+    the offset of each record is used when present (it encodes the DST),
+    otherwise the local times are localized with tz"""
+    import numpy as np
+    import pandas as pd
+    local = np.array([x[:19] for x in datetimes], dtype='datetime64[s]')
+    offsets = np.array([x[19:] for x in datetimes])
+    uniq, inv = np.unique(offsets, return_inverse=True)
+    if (uniq == '').any():
+        dts = pd.DatetimeIndex(local).tz_localize(tz, ambiguous='infer',
+                                                  nonexistent='shift_forward')
+        dts = dts.tz_convert('UTC').tz_localize(None)
+        return dts.values.astype('datetime64[ns]')
+    # only a handful of unique offsets (+02:00, +03:00), parse them once:
+    secs = []
+    for off in uniq:
+        if off == 'Z':
+            secs.append(0)
+            continue
+        sign = -1 if off[0] == '-' else 1
+        hh, mm = off[1:].replace(':', '')[:2], off[1:].replace(':', '')[2:4]
+        secs.append(sign * (int(hh) * 3600 + int(mm or 0) * 60))
+    secs = np.array(secs, dtype='timedelta64[s]')[inv]
+    return (local - secs).astype('datetime64[ns]')
+
+
+def parse_envista_data_to_arrays(data, tz='Asia/Jerusalem'):
+    """flatten the nested envista records, i.e., r.json()['data'] into
+    columnar numpy arrays in a single pass. returns a dict with time (naive
+    UTC), channel (names), channel_id and the (time, channel) value, valid and
+    status arrays. missing channels in a record are NaN/False/-1"""
+    import numpy as np
+    n_ch = np.array([len(x['channels']) for x in data], dtype=int)
+    flat = [ch for x in data for ch in x['channels']]
+    names = np.array([ch['name'] for ch in flat])
+    values = np.array([ch['value'] for ch in flat], dtype=float)
+    valid = np.array([bool(ch['valid']) for ch in flat], dtype=bool)
+    # null status (None) gets the -1 fill value:
+    status = np.array([-1 if ch['status'] is None else ch['status']
+                       for ch in flat], dtype=int)
+    ids = np.array([ch['id'] for ch in flat], dtype=int)
+    channels, ch_ind = np.unique(names, return_inverse=True)
+    t_ind = np.repeat(np.arange(len(data)), n_ch)
+    shape = (len(data), channels.size)
+    arrays = {}
+    arrays['time'] = convert_envista_datetimes_to_utc(
+        [x['datetime'] for x in data], tz=tz)
+    arrays['channel'] = channels
+    channel_id = np.zeros(channels.size, dtype=int)
+    channel_id[ch_ind] = ids
+    arrays['channel_id'] = channel_id
+    arrays['value'] = np.full(shape, np.nan)
+    arrays['value'][t_ind, ch_ind] = values
+    arrays['valid'] = np.zeros(shape, dtype=bool)
+    arrays['valid'][t_ind, ch_ind] = valid
+    arrays['status'] = np.full(shape, -1, dtype=int)
+    arrays['status'][t_ind, ch_ind] = status
+    return arrays
+
+
+def envista_arrays_to_dataset(arrays, only_valid=True):
+    """transform the output of parse_envista_data_to_arrays into a Dataset of
+    channels with time dim, if only_valid, keep just valid and status == 1
+    values (the rest are NaN)"""
+    import numpy as np
+    import xarray as xr
+    values = arrays['value']
+    if only_valid:
+        ok = arrays['valid'] & (arrays['status'] == 1)
+        values = values.copy()
+        values[~ok] = float('nan')
+    # keep only channels that have some values (like the pd.concat parser):
+    has_values = ~np.isnan(values).all(axis=0)
+    ds = xr.Dataset(coords={'time': arrays['time']})
+    for j in np.flatnonzero(has_values):
+        ch = str(arrays['channel'][j])
+        ds[ch] = xr.DataArray(values[:, j], dims=['time'])
+        ds[ch].attrs['channel_id'] = int(arrays['channel_id'][j])
+    return ds
+
+
+def benchmark_envista_parser(days=365, legacy_days=7, seed=0):
+    """time parse_envista_data_to_arrays on synthetic envista records of all
+    the 10mins channels for <days> against the per-timestamp DataFrame parser
+    on <legacy_days> (extrapolated linearly to <days>)"""
+    import time
+    import numpy as np
+    import pandas as pd
+
+    def legacy_parse(data):
+        dfl = []
+        for rec in data:
+            df = pd.DataFrame(rec['channels'])
+            df = df[df['valid']]
+            df = df[df['status'] == 1]
+            df = df[['name', 'value']].T
+            df.columns = df.loc['name'].tolist()
+            df = df.drop('name', axis=0)
+            df.index = [pd.to_datetime(rec['datetime'])]
+            dfl.append(df)
+        df = pd.concat(dfl).astype(float)
+        df.index = df.index.tz_convert('UTC')
+        return df
+
+    channels = ['BP', 'DiffR', 'Grad', 'NIP', 'Rain', 'RH', 'STDwd', 'TD',
+                'TDmax', 'TDmin', 'TG', 'Time', 'WD', 'WDmax', 'WS', 'WS10mm',
+                'WS1mm', 'WSmax']
+    rng = np.random.default_rng(seed)
+    dts = pd.date_range('2019-01-01', periods=days * 144, freq='10min',
+                        tz='Asia/Jerusalem')
+    dts = [x.isoformat() for x in dts]
+    vals = rng.normal(20, 5, size=(len(dts), len(channels))).round(1)
+    valid = rng.random(size=vals.shape) > 0.01
+    data = [{'datetime': dt,
+             'channels': [{'id': j + 1, 'name': ch, 'alias': None,
+                           'value': vals[i, j], 'status': 1,
+                           'valid': bool(valid[i, j]), 'description': None}
+                          for j, ch in enumerate(channels)]}
+            for i, dt in enumerate(dts)]
+    tic = time.perf_counter()
+    arrays = parse_envista_data_to_arrays(data)
+    ds = envista_arrays_to_dataset(arrays)
+    new = time.perf_counter() - tic
+    print('vectorized parser: {} records x {} channels in {:.2f} s.'.format(
+        len(data), len(channels), new))
+    results = {'records': len(data), 'vectorized_seconds': new}
+    if legacy_days:
+        n = legacy_days * 144
+        tic = time.perf_counter()
+        df = legacy_parse(data[:n])
+        old = (time.perf_counter() - tic) * len(data) / n
+        # both parsers should agree on the common records:
+        df.index = df.index.tz_localize(None)
+        new_df = ds.isel(time=slice(0, n)).to_dataframe()[df.columns]
+        assert np.allclose(new_df.values, df.values, equal_nan=True)
+        assert (new_df.index == df.index).all()
+        print('legacy parser (extrapolated): {:.2f} s, speedup x{:.0f}.'.format(
+            old, old / new))
+        results['legacy_seconds'] = old
+    return results
+
+
+def read_ims_store_index(store_path=ims_10mins_path / 'store' / 'TD'):
+    """read the sidecar index of the append-only IMS station store, one row
+    per written chunk (station_id, station_name, month, part, rows,
+    valid_rows, first, last, last_valid, file)"""
+    import pandas as pd
+    index_file = store_path / 'index.csv'
+    cols = ['station_id', 'station_name', 'month', 'part', 'rows',
+            'valid_rows', 'first', 'last', 'last_valid', 'file']
+    if not index_file.is_file():
+        return pd.DataFrame(columns=cols)
+    df = pd.read_csv(index_file)
+    for col in ['first', 'last', 'last_valid']:
+        if col not in df:
+            # older indices: the last valid is approximated by the chunk's last
+            df[col] = df['last'].where(df['valid_rows'] > 0)
+        df[col] = pd.to_datetime(df[col], format='%Y-%m-%d %H:%M:%S')
+    return df[cols]
+
+
+def _write_ims_store_index(index, store_path):
+    """rewrite the whole store index atomically"""
+    import os
+    index_file = store_path / 'index.csv'
+    index.to_csv(store_path / 'index.csv.tmp', index=False,
+                 date_format='%Y-%m-%d %H:%M:%S')
+    os.replace(store_path / 'index.csv.tmp', index_file)
+    return
+
+
+def _ims_chunk_last_valid(chunk, time_dim='time'):
+    import pandas as pd
+    valid = chunk.dropna(time_dim)[time_dim]
+    if valid.size == 0:
+        return pd.NaT
+    return pd.to_datetime(valid.values[-1])
+
+
+def get_ims_store_last_datetimes(store_path=ims_10mins_path / 'store' / 'TD',
+                                 valid=True):
+    """return the last datetime of every station in the store (station_id as
+    index) from the index only, if valid, return the last non-NaN datetime
+    (stations with no valid data at all are left out)"""
+    df = read_ims_store_index(store_path)
+    if valid:
+        return df.dropna(subset=['last_valid']).groupby(
+            'station_id')['last_valid'].max()
+    return df.groupby('station_id')['last'].max()
+
+
+def write_ims_station_to_store(da, store_path=ims_10mins_path / 'store' / 'TD',
+                               time_dim='time'):
+    """append a single IMS station 10mins DataArray (with station_id attr) to
+    the store: records after the store's last datetime are written as new part
+    files per month, records already in the store only fill its NaN rows
+    (the few chunks that have such rows are rewritten)"""
+    import os
+    import pandas as pd
+    import xarray as xr
+    from aux_gps import get_unique_index
+    station_id = int(da.attrs['station_id'])
+    st_path = store_path / str(station_id)
+    if not st_path.is_dir():
+        os.makedirs(st_path)
+    full_index = read_ims_store_index(store_path)
+    is_station = full_index['station_id'] == station_id
+    index = full_index[is_station]
+    da = get_unique_index(da, dim=time_dim).sortby(time_dim)
+    comp = dict(zlib=True, complevel=9)  # best compression
+    filled = 0
+    if not index.empty:
+        last = index['last'].max()
+        old = da.sel({time_dim: slice(None, last)}).dropna(time_dim)
+        da = da.sel({time_dim: slice(last + pd.Timedelta(1, unit='s'), None)})
+        # backfill the NaN rows of the chunks that overlap the new valid data:
+        if old[time_dim].size > 0:
+            old_times = old[time_dim].values
+            for i, row in index[index['rows'] > index['valid_rows']].iterrows():
+                in_chunk = (old_times >= row['first'].to_datetime64()) & (
+                    old_times <= row['last'].to_datetime64())
+                if not in_chunk.any():
+                    continue
+                chunk = xr.load_dataarray(store_path / row['file'])
+                new = old.isel({time_dim: in_chunk}).reindex(
+                    {time_dim: chunk[time_dim]})
+                fill = chunk.isnull() & new.notnull()
+                if not fill.any():
+                    continue
+                chunk = chunk.where(~fill, new)
+                encoding = {var: comp for var in chunk.to_dataset().data_vars}
+                file = store_path / row['file']
+                chunk.to_netcdf(file.parent / (file.name + '.tmp'), 'w',
+                                encoding=encoding)
+                os.replace(file.parent / (file.name + '.tmp'), file)
+                full_index.loc[i, 'valid_rows'] = int(chunk.notnull().sum())
+                full_index.loc[i, 'last_valid'] = _ims_chunk_last_valid(
+                    chunk, time_dim)
+                filled += int(fill.sum())
+    if da[time_dim].size == 0 and filled == 0:
+        print('no new data for station {}.'.format(station_id))
+        return
+    months = da[time_dim].dt.strftime('%Y-%m').values
+    rows = []
+    for month in pd.unique(months):
+        chunk = da.isel({time_dim: months == month})
+        part = (index['month'] == month).sum()
+        filename = '{}_{}_{:03d}.nc'.format(station_id, month, part)
+        encoding = {var: comp for var in chunk.to_dataset().data_vars}
+        # write to a temp file first so a crash won't leave a broken chunk:
+        chunk.to_netcdf(st_path / (filename + '.tmp'), 'w', encoding=encoding)
+        os.replace(st_path / (filename + '.tmp'), st_path / filename)
+        rows.append({'station_id': station_id, 'station_name': da.name,
+                     'month': month, 'part': part,
+                     'rows': chunk[time_dim].size,
+                     'valid_rows': int(chunk.notnull().sum()),
+                     'first': pd.to_datetime(chunk[time_dim].values[0]),
+                     'last': pd.to_datetime(chunk[time_dim].values[-1]),
+                     'last_valid': _ims_chunk_last_valid(chunk, time_dim),
+                     'file': '{}/{}'.format(station_id, filename)})
+    df = pd.DataFrame(rows, columns=full_index.columns)
+    if filled > 0:
+        print('filled {} NaN records of station {}.'.format(filled,
+                                                            station_id))
+    if not df.empty:
+        full_index = pd.concat([full_index, df], ignore_index=True)
+    _write_ims_store_index(full_index, store_path)
+    print('appended {} chunks of station {} to {}.'.format(len(rows),
+                                                           station_id,
+                                                           store_path))
+    return df
+
+
+def load_ims_station_from_store(station_id,
+                                store_path=ims_10mins_path / 'store' / 'TD',
+                                months=None, lazy=True):
+    """open the chunks of one station (all or only year-months e.g.,
+    ['2019-12', '2020-01']) from the store as a single DataArray, if lazy,
+    the chunks are dask arrays"""
+    import xarray as xr
+    index = read_ims_store_index(store_path)
+    index = index[index['station_id'] == int(station_id)]
+    if months is not None:
+        index = index[index['month'].isin(months)]
+    if index.empty:
+        return None
+    index = index.sort_values(['month', 'part'])
+    files = [store_path / x for x in index['file']]
+    if lazy:
+        ds = xr.open_mfdataset(files, combine='nested', concat_dim='time')
+    else:
+        ds = xr.concat([xr.load_dataset(x) for x in files], 'time')
+    da = ds[[x for x in ds.data_vars][0]]
+    return da
+
+
+def open_ims_store_month_mosaic(month,
+                                store_path=ims_10mins_path / 'store' / 'TD',
+                                freq='10min', lazy=True):
+    """return a Dataset of all the stations (as data vars) for one year-month,
+    e.g., '2020-01' reading only that month's chunks of each station (found
+    in the index), if lazy, the stations are dask arrays and nothing is read
+    until the mosaic is computed or saved. the stations are put on the freq
+    grid of the month, times that are off it are discarded and where parts
+    overlap (e.g., after a backfill) the latest part wins"""
+    import pandas as pd
+    import xarray as xr
+    month = pd.to_datetime(month).strftime('%Y-%m')
+    index = read_ims_store_index(store_path)
+    index = index[index['month'] == month].sort_values(['station_id', 'part'])
+    start = pd.to_datetime(month)
+    end = start + pd.offsets.MonthBegin(1) - pd.Timedelta(freq)
+    time = pd.date_range(start, end, freq=freq)
+    das = []
+    for st_id, parts in index.groupby('station_id'):
+        files = [store_path / x for x in parts['file']]
+        if lazy:
+            ds = xr.open_mfdataset(files, combine='nested', concat_dim='time')
+        else:
+            ds = xr.concat([xr.load_dataset(x) for x in files], 'time')
+        da = ds[[x for x in ds.data_vars][0]]
+        da = da.isel(time=~da.indexes['time'].duplicated(keep='last'))
+        das.append(da.sortby('time').reindex(time=time))
+    ds = xr.Dataset({da.name: da for da in das})
+    for da in das:
+        ds[da.name].attrs = da.attrs
+    return ds
+
+
+def compact_ims_store_month(station_id, month,
+                            store_path=ims_10mins_path / 'store' / 'TD'):
+    """merge the part files of a closed station month into a single chunk and
+    rewrite the index accordingly"""
+    import os
+    import pandas as pd
+    index = read_ims_store_index(store_path)
+    where = (index['station_id'] == int(station_id)) & (index['month'] == month)
+    if where.sum() < 2:
+        return
+    da = load_ims_station_from_store(station_id, store_path, months=[month],
+                                     lazy=False)
+    parts = index[where]
+    filename = '{}_{}_{:03d}.nc'.format(station_id, month, 0)
+    st_path = store_path / str(station_id)
+    comp = dict(zlib=True, complevel=9)  # best compression
+    encoding = {var: comp for var in da.to_dataset().data_vars}
+    da.to_netcdf(st_path / (filename + '.tmp'), 'w', encoding=encoding)
+    row = parts.iloc[[0]].copy()
+    row['part'] = 0
+    row['rows'] = parts['rows'].sum()
+    row['valid_rows'] = parts['valid_rows'].sum()
+    row['first'] = parts['first'].min()
+    row['last'] = parts['last'].max()
+    row['last_valid'] = parts['last_valid'].max()
+    row['file'] = '{}/{}'.format(station_id, filename)
+    index = pd.concat([index[~where], row]).sort_values(['station_id', 'month'])
+    # replace first, then point the index to it and only then delete the
+    # old parts, so a crash never leaves the index without its data:
+    os.replace(st_path / (filename + '.tmp'), st_path / filename)
+    _write_ims_store_index(index, store_path)
+    for file in parts['file']:
+        if file != row['file'].item():
+            (store_path / file).unlink()
+    return
+
+
+def migrate_ims_station_files_to_store(path=ims_10mins_path, channel_name='TD',
+                                       store_path=None):
+    """split the legacy single file per station (*_TD_10mins.nc) into the
+    monthly chunks of the store, stations already in the store are skipped"""
+    from aux_gps import path_glob
+    import xarray as xr
+    if store_path is None:
+        store_path = path / 'store' / channel_name
+    files = path_glob(path, '*_{}_10mins.nc'.format(channel_name),
+                      return_empty_list=True)
+    in_store = get_ims_store_last_datetimes(store_path, valid=False).index
+    for file in sorted(files):
+        st_id = int(file.as_posix().split('/')[-1].split('_')[1])
+        if st_id in in_store:
+            continue
+        da = xr.load_dataarray(file)
+        da.attrs['station_id'] = st_id
+        write_ims_station_to_store(da, store_path)
+    return
+
+
 # def download_ims_data(geo_df, path, end_date='2019-04-15'):
 #    import requests
 #    import glob
@@ -2097,8 +2368,8 @@ def fill_missing_single_ims_station(da, unique_index=True,
     # da should be dattaarray and not dataset!
     import pandas as pd
     import numpy as np
-    import xarray as xr
     from aux_gps import get_unique_index
+    from aux_gps import fill_na_with_climatology_table
     print('filling in missing data for {}'.format(da.name))
     if unique_index:
         ind_diff = da.size - get_unique_index(da).size
@@ -2133,32 +2404,22 @@ def fill_missing_single_ims_station(da, unique_index=True,
     if verbose:
         print('computing diurnal change:')
     diurnal = anom.groupby('time.hour').mean('time')
-    # assemble old and new time and comupte the difference:
+    # assemble the (clim_period, hour) table and fill the new time at once:
     if verbose:
         print('assembeling missing data:')
-    old_time = pd.to_datetime(da_no_nans.time.values)
+    clim = (climatology + diurnal).reset_coords(drop=True)
     freq = pd.infer_freq(da.time.values)
+    if freq is None:
+        # gaps in the series, use the most common time step:
+        freq = pd.Series(np.diff(da_no_nans.time.values)).mode()[0]
     new_time = pd.date_range(da_no_nans.time.min().item(),
                              da_no_nans.time.max().item(), freq=freq)
-    missing_time = pd.to_datetime(
-        sorted(
-            set(new_time).difference(
-                set(old_time))))
-    missing_data = np.empty((missing_time.shape))
+    new_time = new_time.union(pd.to_datetime(da_no_nans.time.values))
     if verbose:
         print('proccessing missing data...')
-    for i in range(len(missing_data)):
-        # replace data as to monthly long term mean and diurnal hour:
-        # missing_data[i] = (climatology.sel(month=missing_time[i].month) +
-        missing_data[i] = (climatology.sel({clim_period: getattr(missing_time[i],
-                                                                 clim_period)}) +
-                           diurnal.sel(hour=missing_time[i].hour))
-    series = pd.Series(data=missing_data, index=missing_time)
-    series.index.name = 'time'
-    mda = series.to_xarray()
-    mda.name = da.name
-    new_data = xr.concat([mda, da_no_nans], 'time')
-    new_data = new_data.sortby('time')
+    new_data = fill_na_with_climatology_table(
+        da_no_nans.reindex(time=new_time), clim)
+    new_data.name = da.name
     # copy attrs:
     new_data.attrs = da.attrs
     new_data.attrs['description'] = 'missing data was '\
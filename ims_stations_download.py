@@ -35,24 +35,11 @@ ch_desc_dict = dict(zip(channels, ch_desc))
 
 def parse_single_station(data):
     import pandas as pd
-    datetimes = [x['datetime'] for x in data]
-    dfl = []
-    for i, dt in enumerate(datetimes):
-        # get all channels into dataframe for each datetime:
-        df = pd.DataFrame(data[i]['channels'])
-        df = df[df['valid']]
-        df = df[df['status'] == 1]
-        df = df[['name', 'value']]
-        df = df.T
-        df.columns = df.loc['name'].tolist()
-        df = df.drop('name', axis=0)
-        df.index = [pd.to_datetime(dt)]
-        dfl.append(df)
-    df = pd.concat(dfl)
-    df = df.astype(float)
-    df.index = df.index.tz_convert('UTC')
-    df.index.name = 'time'
-    ds = df.to_xarray()
+    from ims_procedures import parse_envista_data_to_arrays
+    from ims_procedures import envista_arrays_to_dataset
+    # flatten all records and channels at once (only valid, status == 1):
+    arrays = parse_envista_data_to_arrays(data)
+    ds = envista_arrays_to_dataset(arrays, only_valid=True)
     ds['time'] = pd.to_datetime(ds['time'].values)
     for da in ds:
         if da in channels:
@@ -96,10 +83,10 @@ def main_program(*args, **kwargs):
     ds = process_ims_stations(savepath, window, var='TD', ds=dsl)
     ds_axis = post_process_ims_stations(ds, window, savepath / 'TD', gis_path,
                                         awd_path, axis_path)
-    pwv_axis, fn = produce_pw_all_stations(
+    pwv_axis, _ = produce_pw_all_stations(
         ds_axis, axis_path, mda_path, hydro_path)
     produce_pwv_map_all_stations(
-        pwv_axis, fn, axis_path, awd_path, map_freq='1H', ppd=100)
+        pwv_axis, axis_path, awd_path, map_freq='1H', ppd=100)
     return
 
 
@@ -258,10 +245,7 @@ def produce_pw_all_stations(ds, axis_path, mda_path, hydro_path):
     import pandas as pd
     import numpy as np
     from hydro_procedures import standertize_pwv_using_long_term_stat
-    from hydro_procedures import prepare_X_y_for_holdout_test
-    # from hydro_procedures import axis_southern_stations
-    from hydro_procedures import best_hp_models_dict
-    from sklearn.ensemble import RandomForestClassifier
+    from hydro_procedures import load_or_train_flood_classifier
     import xarray as xr
     import os
     # first load mda:
@@ -333,33 +317,26 @@ def produce_pw_all_stations(ds, axis_path, mda_path, hydro_path):
     if ds['time'].size < 24:
         logger.warning('Could not make prediction since there are only {} hours of data.'.format(ds['time'].size))
     else:
-        # load X, y and train RFC:
-        X, y = prepare_X_y_for_holdout_test(
-            features='pwv+DOY', model_name='RF', path=hydro_path)
-        rfc = RandomForestClassifier(**best_hp_models_dict['RF'])
-        rfc.set_params(n_jobs=4)
-        rfc.fit(X, y)
-        # iterate over ds, add DOY and select 24 windows, and predict:
-        Xs = []
-        ys = []
-        for da in ds:
-            end = ds[da]['time'].max() - pd.Timedelta(1, unit='H')
-            start = end - pd.Timedelta(23, unit='H')
-            mean = ds[da].sel(time=slice(start, end)).mean('time')
-            sliced = ds[da].sel(time=slice(start, end)).fillna(mean)
-            doy = ds[da].time.dt.dayofyear[-1].item()
-            X_da = np.append(sliced.values, doy)
-            X_da = xr.DataArray(X_da, dims='feature')
-            X_da['feature'] = ['pwv_{}'.format(x+1) for x in range(24)] + ['DOY']
-            flood = rfc.predict(X_da.values.reshape(1, -1))
-            y = xr.DataArray(flood, dims='time')
-            y['time'] = [ds[da]['time'].max().values]
-            y.name = 'Flood'
-            Xs.append(X_da)
-            ys.append(y)
+        # load the trained RFC (trains and saves it only once):
+        rfc = load_or_train_flood_classifier(features='pwv+DOY',
+                                             model_name='RF', path=hydro_path)
+        # select the last 24 hours of all stations and add DOY, then predict
+        # all stations at once:
+        end = ds['time'].max() - pd.Timedelta(1, unit='H')
+        start = end - pd.Timedelta(23, unit='H')
+        sliced = ds.to_array('station').sel(time=slice(start, end))
+        sliced = sliced.fillna(sliced.mean('time')).transpose('station', 'time')
+        doy = ds.time.dt.dayofyear[-1].item()
+        X = np.column_stack([sliced.values,
+                             np.full(sliced['station'].size, doy)])
+        X = xr.DataArray(X, dims=['station', 'feature'])
+        X['feature'] = ['pwv_{}'.format(x+1) for x in range(24)] + ['DOY']
+        flood = rfc.predict(X.values)
         pred = xr.Dataset()
-        pred['features'] = xr.concat(Xs, 'station')
-        pred['flood'] = xr.concat(ys, 'station')
+        pred['features'] = X
+        pred['flood'] = xr.DataArray(flood.reshape(-1, 1),
+                                     dims=['station', 'time'])
+        pred['time'] = [ds['time'].max().values]
         pred['station'] = [x for x in ds]
         df_pred = pred['flood'].to_dataframe()
         df_pred['time'] = pred['flood']['time'].values[0]
@@ -370,11 +347,12 @@ def produce_pw_all_stations(ds, axis_path, mda_path, hydro_path):
     return dss, filename
 
 
-def produce_pwv_map_all_stations(pwv_axis, filename, axis_path, awd_path, map_freq='1H', ppd=100):
+def produce_pwv_map_all_stations(pwv_axis, axis_path, awd_path, map_freq='1H', ppd=100):
+    """update the AXIS PWV maps archive in axis_path/'PWV_maps' and return
+    the maps of the times of pwv_axis"""
     from axis_process import read_axis_stations
-    from interpolation_routines import produce_2D_PWV_map
-    import xarray as xr
-    from aux_gps import save_ncfile
+    from interpolation_routines import update_pwv_map_archive
+    from interpolation_routines import open_pwv_map_archive
 
     # first work without error fields in pwv:
     pwv_axis = pwv_axis[[x for x in pwv_axis if 'error' not in x]]
@@ -383,35 +361,18 @@ def produce_pwv_map_all_stations(pwv_axis, filename, axis_path, awd_path, map_fr
     # now set the frequenct of maps (1H) recommended
     pwv_axis = pwv_axis.resample(time=map_freq).mean()
     logger.info('Producing AXIS-PWV maps with {} frequency.'.format(map_freq))
-    maps = []
-    sclh = []
-    rmses = []
     total = pwv_axis['time'].size
-    for i, dtime in enumerate(pwv_axis['time']):
-        dt = dtime.dt.strftime('%Y-%m-%dT%H:%M:%S').item()
-        logger.info('Interpolating PWV record ({}/{})'.format(i+1, total))
-        pwv_map, _ = produce_2D_PWV_map(pwv_axis, df, dt=dt,
-                                        dem_path=awd_path, H_constant=None, ppd=ppd,
-                                        expand_time=True, verbose=False)
-        sclh.append(pwv_map.attrs['scale_height'])
-        rmses.append(pwv_map.attrs['RMSE'])
-        maps.append(pwv_map)
-    pwv_map_da = xr.concat(maps, 'time')
-    pwv_map_all = pwv_map_da.to_dataset()
-    pwv_map_all['scale_height'] = xr.DataArray(sclh, dims=['time'])
-    pwv_map_all['scale_height'].attrs['long_name'] = 'PWV scale height'
-    pwv_map_all['scale_height'].attrs['units'] = 'meters'
-    pwv_map_all['scale_height'].attrs['formula'] = 'PWV@surface * exp(-Height/H)'
-    pwv_map_all['RMSE'] = xr.DataArray(rmses, dims=['time'])
-    pwv_map_all['RMSE'].attrs['long_name'] = 'root mean squared error'
-    pwv_map_all['PWV'].attrs = {}
-    pwv_map_all['PWV'].attrs['long_name'] = 'Precipitable Water Vapor'
-    pwv_map_all['PWV'].attrs['units'] = 'mm'
-    pwv_map_all['PWV'].attrs['points_per_degree'] = ppd
-    pwv_map_all = pwv_map_all.sortby('time')
-    # save each filename:
-    filename = filename.split('.')[0] + '_map_{}_{}.nc'.format(map_freq, ppd)
-    save_ncfile(pwv_map_all, axis_path, filename)
+    # only hours that are new or whose stations inputs changed are computed:
+    name = 'AXIS_PWV_map_{}'.format(map_freq)
+    archive_path = axis_path / 'PWV_maps'
+    recomputed = update_pwv_map_archive(pwv_axis, df, archive_path, name=name,
+                                        dem_path=awd_path, H_constant=None,
+                                        ppd=ppd, verbose=False)
+    logger.info('Computed {} out of {} maps, the rest were up to date.'.format(
+        recomputed.size, total))
+    times = pwv_axis['time'].values
+    pwv_map_all = open_pwv_map_archive(archive_path, name=name, ppd=ppd,
+                                       times=(times[0], times[-1])).load()
     logger.info('Done producing AXIS-PWV maps.')
     return pwv_map_all
 
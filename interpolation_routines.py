@@ -91,14 +91,11 @@ def compare_stations_PWV_to_interpolated_map(df_inter, hdf, verbose=False):
     from sklearn.metrics import mean_squared_error
     df = hdf.copy()
     df.loc[:, 'datetime'] = [hdf.columns[0] for x in range(len(df))]
-    trues = []
-    preds = []
     df.columns = ['pwv', 'lat', 'lon', 'datetime']
-    for ind, row in df.iterrows():
-        true_pwv = row['pwv']
-        pred_pwv = df_inter.sel(lat=row['lat'], lon=row['lon'], method='nearest').values
-        trues.append(true_pwv)
-        preds.append(pred_pwv)
+    grid = MeshStationGrid(df['lat'].values, df['lon'].values,
+                           df_inter['lat'].values, df_inter['lon'].values)
+    trues = df['pwv'].values
+    preds = grid.unscatter(df_inter.values)
     df['pred'] = preds
     rmse = np.sqrt(mean_squared_error(trues, preds))
     if verbose:
@@ -173,26 +170,29 @@ def plot_2D_PWV_map(df_inter, gis_path=gis_path, fontsize=16, cmap='jet_r', pane
 def interpolate_var_ds_at_multiple_dts(var_ds, geo_var_df, predict_df,
                                        time_dim='time', dem_path=awd_path,
                                        H_constant=None, verbose=True):
+    """interpolate var_ds to predict_df locations (lat, lon and alt columns)
+    at all the times of var_ds, the kriging is done in one batch for all
+    the times that share the same valid stations"""
     import pandas as pd
-    times_df = var_ds[time_dim].to_pandas()
-    df = pd.DataFrame()
-    for dt in times_df:
-        print('interpolating on datetime: {}.'.format(dt))
-        hdf = slice_var_ds_at_dt_and_convert_to_dataframe(var_ds, geo_var_df,
-                                                          dt=dt.strftime('%Y-%m-%dT%H:%M:%S'))
-        # if H is None:
-        #     # estimate scale height H by using all stations' data:
-        if H_constant is not None:
-            H = H_constant
-        else:
-            H = get_var_lapse_rate(hdf, model='LR', plot=False)
-        print('scale height is: {} meters.'.format(H))
-        new_hdf = apply_lapse_rate_change(hdf, H)
-        df_inter = interpolate_at_one_dt(new_hdf, H, predict_df=predict_df,
-                                         dem_path=dem_path, ppd=50, verbose=verbose)
+    import numpy as np
+    da, lons, lats, values, H = prepare_var_ds_for_kriging(var_ds, geo_var_df,
+                                                           time_dim=time_dim,
+                                                           H_constant=H_constant,
+                                                           ppd=50)
+    times = var_ds[time_dim].to_index()
+    interpolated = batched_ordinary_kriging(lons, lats, values,
+                                            predict_df['lon'].values,
+                                            predict_df['lat'].values,
+                                            verbose=verbose)
+    dfs = []
+    for i, dt in enumerate(times):
+        df_inter = predict_df.copy()
+        df_inter['interpolated'] = interpolated[i]
+        df_inter['interpolated_lr_fixed'] = interpolated[i] * np.exp(-1.0 * df_inter['alt'] / H[i])
         df_inter['datetime'] = dt
-        df_inter['H'] = H
-        df = df.append(df_inter)
+        df_inter['H'] = H[i]
+        dfs.append(df_inter)
+    df = pd.concat(dfs)
     df['name'] = df.index
     df['datetime'] = pd.to_datetime(df['datetime'])
     df.set_index('datetime', inplace=True)
@@ -200,6 +200,193 @@ def interpolate_var_ds_at_multiple_dts(var_ds, geo_var_df, predict_df,
     return df
 
 
+def prepare_var_ds_for_kriging(var_ds, geo_df, time_dim='time',
+                               H_constant=None, ppd=50):
+    """get the stations of var_ds (that are in geo_df) snapped to the mesh
+    with ppd, their values after removing the scale height (time, station)
+    and the scale height H for each time"""
+    import numpy as np
+    da = create_lat_lon_mesh(points_per_degree=ppd)
+    stations = [x for x in var_ds.data_vars if x in geo_df.index]
+    geo = geo_df.loc[stations]
+    values = var_ds[stations].to_array('station').transpose(time_dim, 'station').values
+    if H_constant is not None:
+        H = np.full(values.shape[0], float(H_constant))
+    else:
+        H = fit_scale_height(values, geo['alt'].values)['H']
+    # make sure lapse rate is negative:
+    bad = ~(H > 0)
+    if bad.any():
+        raise ValueError('scale height is not positive (or NaN) at {}, use H_constant.'.format(
+            ', '.join(str(x) for x in var_ds[time_dim].values[bad])))
+    values = remove_scale_height(values, geo['alt'].values, H)
+    # snap the stations to the mesh, painting them by altitude order:
+    order = np.argsort(geo['alt'].values, kind='stable')
+    grid = get_mesh_station_grid(geo['lat'].values[order],
+                                 geo['lon'].values[order],
+                                 points_per_degree=ppd)
+    return da, grid.cell_lon, grid.cell_lat, grid.cell_values(values[:, order]), H
+
+
+def produce_2D_PWV_maps(pwv_ds, geo_df, time_dim='time', dem_path=awd_path,
+                        H_constant=None, ppd=250, pool_times=True,
+                        verbose=True):
+    """produce 2D PWV maps for all the times of pwv_ds in one batch, returns
+    a dataset with PWV(time, lat, lon), scale_height and RMSE vs. time,
+    pool_times is passed to batched_ordinary_kriging"""
+    import numpy as np
+    import xarray as xr
+    from aux_gps import coarse_dem
+    da, lons, lats, values, H = prepare_var_ds_for_kriging(pwv_ds, geo_df,
+                                                           time_dim=time_dim,
+                                                           H_constant=H_constant,
+                                                           ppd=ppd)
+    lon_mesh, lat_mesh = np.meshgrid(da['lon'].values, da['lat'].values)
+    interpolated = batched_ordinary_kriging(lons, lats, values, lon_mesh,
+                                            lat_mesh, pool_times=pool_times,
+                                            verbose=verbose)
+    interpolated = interpolated.reshape((-1, ) + da.shape)
+    awd = coarse_dem(da, dem_path=dem_path).values
+    interpolated *= np.exp(-1.0 * awd[None, :, :] / H[:, None, None])
+    # compare the map to the stations at their nearest mesh points:
+    stations = [x for x in pwv_ds.data_vars if x in geo_df.index]
+    geo = geo_df.loc[stations]
+    grid = get_mesh_station_grid(geo['lat'].values, geo['lon'].values,
+                                 points_per_degree=ppd)
+    trues = pwv_ds[stations].to_array('station').transpose(time_dim, 'station').values
+    preds = grid.unscatter(interpolated)
+    rmse = np.sqrt(np.nanmean((preds - trues)**2, axis=1))
+    ds = xr.Dataset()
+    ds['PWV'] = xr.DataArray(interpolated, dims=[time_dim, 'lat', 'lon'])
+    ds[time_dim] = pwv_ds[time_dim].values
+    ds['lat'] = da['lat'].values
+    ds['lon'] = da['lon'].values
+    ds['PWV'].attrs['long_name'] = 'Precipitable Water Vapor'
+    ds['PWV'].attrs['units'] = 'mm'
+    ds['PWV'].attrs['formula'] = 'PWV@surface * exp(-Height/H)'
+    ds['PWV'].attrs['points_per_degree'] = ppd
+    ds['scale_height'] = xr.DataArray(H.round(1), dims=[time_dim])
+    ds['scale_height'].attrs['long_name'] = 'PWV scale height'
+    ds['scale_height'].attrs['units'] = 'meters'
+    ds['scale_height'].attrs['formula'] = 'PWV@surface * exp(-Height/H)'
+    ds['RMSE'] = xr.DataArray(rmse.round(2), dims=[time_dim])
+    ds['RMSE'].attrs['long_name'] = 'root mean squared error'
+    return ds
+
+
+def get_pwv_map_input_hashes(pwv_ds, geo_df, time_dim='time', H_constant=None,
+                             ppd=250):
+    """return an int64 hash for each time of pwv_ds from everything its map
+    is computed from: the stations, their coords and alts, their values at
+    that time and the map settings"""
+    import numpy as np
+    import hashlib
+    stations = sorted([x for x in pwv_ds.data_vars if x in geo_df.index])
+    geo = geo_df.loc[stations, ['lat', 'lon', 'alt']].values.astype(float)
+    values = pwv_ds[stations].to_array('station').transpose(time_dim, 'station').values
+    values = np.where(np.isnan(values), -9999.0, np.round(values, 3))
+    head = hashlib.blake2b(digest_size=8)
+    head.update(' '.join(stations).encode())
+    head.update(np.round(geo, 6).tobytes())
+    head.update('{}_{}'.format(H_constant, ppd).encode())
+    hashes = np.empty(values.shape[0], dtype='int64')
+    for i, row in enumerate(values):
+        h = head.copy()
+        h.update(row.tobytes())
+        hashes[i] = np.frombuffer(h.digest(), dtype='<i8')[0]
+    return hashes
+
+
+def _pwv_map_archive_file(archive_path, name, ppd, time):
+    """the file of a single map in the archive, grouped in monthly folders"""
+    return (Path(archive_path) / time.strftime('%Y-%m') /
+            '{}_{}_{}.nc'.format(name, ppd, time.strftime('%Y-%m-%dT%H%M')))
+
+
+def read_pwv_map_archive_index(archive_path, name='PWV_map', ppd=250):
+    """read the index (time, input_hash) of the maps in the archive"""
+    import pandas as pd
+    file = Path(archive_path) / '{}_{}_index.csv'.format(name, ppd)
+    if not file.is_file():
+        return pd.Series([], index=pd.DatetimeIndex([], name='time'),
+                         dtype='int64', name='input_hash')
+    df = pd.read_csv(file, index_col='time', parse_dates=['time'])
+    return df['input_hash'].astype('int64')
+
+
+def update_pwv_map_archive(pwv_ds, geo_df, archive_path, name='PWV_map',
+                           time_dim='time', dem_path=awd_path, H_constant=None,
+                           ppd=250, tile=64, verbose=True):
+    """keep an archive of PWV maps with one file per map
+    (YYYY-MM/name_ppd_YYYY-MM-DDTHHMM.nc) chunked on disk to (tile, tile) so
+    spatial subsets are cheap to read. the hash of the inputs of each map is
+    kept in name_ppd_index.csv and only the times that are new or whose
+    station inputs changed are (re)computed and written, so an update never
+    rewrites older maps. the variogram is fit for each time on its own.
+    returns the recomputed times"""
+    import os
+    import pandas as pd
+    import xarray as xr
+    from aux_gps import save_ncfile
+    archive_path = Path(archive_path)
+    archive_path.mkdir(parents=True, exist_ok=True)
+    pwv_ds = pwv_ds.sortby(time_dim)
+    hashes = get_pwv_map_input_hashes(pwv_ds, geo_df, time_dim=time_dim,
+                                      H_constant=H_constant, ppd=ppd)
+    times = pd.DatetimeIndex(pwv_ds[time_dim].values)
+    index = read_pwv_map_archive_index(archive_path, name=name, ppd=ppd)
+    loc = index.index.get_indexer(times)
+    todo = [i for i, t in enumerate(times) if not (
+        loc[i] >= 0 and index.values[loc[i]] == hashes[i] and
+        _pwv_map_archive_file(archive_path, name, ppd, t).is_file())]
+    if not todo:
+        if verbose:
+            print('{} maps are up to date.'.format(name))
+        return pd.DatetimeIndex([])
+    if verbose:
+        print('computing {} out of {} {} maps.'.format(len(todo), times.size, name))
+    ds = produce_2D_PWV_maps(pwv_ds.isel({time_dim: todo}), geo_df,
+                             time_dim=time_dim, dem_path=dem_path,
+                             H_constant=H_constant, ppd=ppd,
+                             pool_times=False, verbose=False)
+    ds['input_hash'] = xr.DataArray(hashes[todo], dims=[time_dim])
+    ds['input_hash'].attrs['long_name'] = 'hash of the stations inputs of each map'
+    for i, t in enumerate(times[todo]):
+        file = _pwv_map_archive_file(archive_path, name, ppd, t)
+        file.parent.mkdir(exist_ok=True)
+        save_ncfile(ds.isel({time_dim: [i]}), file.parent, file.name,
+                    atomic=True, chunks={time_dim: 1, 'lat': tile, 'lon': tile})
+    # the maps are written first, so a crash only costs recomputing them:
+    index = pd.Series(hashes[todo], index=times[todo]).combine_first(index)
+    index = index.astype('int64').rename('input_hash').rename_axis('time')
+    file = archive_path / '{}_{}_index.csv'.format(name, ppd)
+    tmp = archive_path / '{}.{}.tmp'.format(file.name, os.getpid())
+    index.sort_index().to_csv(tmp, date_format='%Y-%m-%dT%H:%M:%S')
+    os.replace(tmp, file)
+    return times[todo]
+
+
+def open_pwv_map_archive(archive_path, name='PWV_map', ppd=250, times=None,
+                         lat_slice=None, lon_slice=None, time_dim='time'):
+    """lazily open the PWV maps archive (dask chunks follow the files tiles),
+    times, lat_slice and lon_slice are (min, max) tuples to subset with"""
+    import xarray as xr
+    index = read_pwv_map_archive_index(archive_path, name=name, ppd=ppd)
+    if times is not None:
+        index = index.loc[slice(times[0], times[1])]
+    files = [_pwv_map_archive_file(archive_path, name, ppd, t) for t in index.index]
+    files = [x for x in files if x.is_file()]
+    if not files:
+        raise FileNotFoundError('no {} maps found in {}.'.format(name, archive_path))
+    ds = xr.open_mfdataset(files, combine='nested', concat_dim=time_dim,
+                           chunks={time_dim: 1, 'lat': 'auto', 'lon': 'auto'})
+    if lat_slice is not None:
+        ds = ds.sel(lat=slice(*lat_slice))
+    if lon_slice is not None:
+        ds = ds.sel(lon=slice(*lon_slice))
+    return ds
+
+
 def slice_var_ds_at_dt_and_convert_to_dataframe(var_ds, df, dt='2018-04-15T22:00:00'):
     """
     slice the var dataset (PWV) with specific datetime and add lat, lon and alt from df
@@ -259,6 +446,95 @@ def get_pressure_lapse_rate(path=ims_path, model='LR', plot=False):
     return results
 
 
+def batched_linear_fit(x, values):
+    """least squares fit of values (time, station) = slope * x + intercept
+    for every timestep at once, x is (station) or (time, station) and NaNs
+    in values are masked out. returns slope, intercept and the number of
+    valid points per timestep (NaN slope with fewer than 2 points)"""
+    import numpy as np
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), values.shape)
+    valid = ~np.isnan(values) & ~np.isnan(x)
+    n = valid.sum(axis=1)
+    xm = np.where(valid, x, 0.0)
+    ym = np.where(valid, values, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = xm.sum(axis=1) / n
+        y_mean = ym.sum(axis=1) / n
+        dx = np.where(valid, x - x_mean[:, None], 0.0)
+        dy = np.where(valid, values - y_mean[:, None], 0.0)
+        slope = (dx * dy).sum(axis=1) / (dx**2).sum(axis=1)
+        slope[n < 2] = np.nan
+        intercept = y_mean - slope * x_mean
+    return slope, intercept, n
+
+
+def fit_scale_height(values, alts, min_stations=2):
+    """closed form least squares of values (time, station) =
+    a0 * exp(-alt / H) for all the timesteps at once (a linear fit of
+    log(values) vs. alt), NaNs and non-positive values are masked out.
+    returns a dict of (time) arrays: H, a0 (the value at sea level),
+    r2 (of the log fit), rmse (in values units) and n, and the (time, station)
+    residual = values - modeled"""
+    import numpy as np
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    alts = np.asarray(alts, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_values = np.where(values > 0, np.log(values), np.nan)
+    slope, intercept, n = batched_linear_fit(alts, log_values)
+    slope[n < min_stations] = np.nan
+    with np.errstate(invalid='ignore', divide='ignore'):
+        H = -1.0 / slope
+        a0 = np.exp(intercept)
+        log_model = intercept[:, None] + slope[:, None] * alts[None, :]
+        valid = ~np.isnan(log_values)
+        log_mean = np.nanmean(np.where(valid, log_values, np.nan), axis=1)
+        ss_res = np.nansum(np.where(valid, (log_values - log_model)**2, np.nan), axis=1)
+        ss_tot = np.nansum(np.where(valid, (log_values - log_mean[:, None])**2, np.nan), axis=1)
+        r2 = 1 - ss_res / ss_tot
+        residual = np.where(valid, values - np.exp(log_model), np.nan)
+        rmse = np.sqrt(np.nanmean(residual**2, axis=1))
+    r2[np.isnan(slope)] = np.nan
+    rmse[np.isnan(slope)] = np.nan
+    return {'H': H, 'a0': a0, 'r2': r2, 'rmse': rmse, 'n': n,
+            'residual': residual}
+
+
+def get_var_ds_scale_height(var_ds, geo_df, time_dim='time', min_stations=2):
+    """fit the scale height of var_ds (e.g., PWV stations) at all times,
+    geo_df has alt column indexed by var_ds data_vars. returns a dataset
+    with H, a0, r2, rmse, n vs. time and the residual (time, station) that
+    can be used for stations QC"""
+    import xarray as xr
+    stations = [x for x in var_ds.data_vars if x in geo_df.index]
+    values = var_ds[stations].to_array('station').transpose(time_dim, 'station')
+    fit = fit_scale_height(values.values, geo_df.loc[stations, 'alt'].values,
+                           min_stations=min_stations)
+    ds = xr.Dataset()
+    for name in ['H', 'a0', 'r2', 'rmse', 'n']:
+        ds[name] = xr.DataArray(fit[name], dims=[time_dim])
+    ds['residual'] = xr.DataArray(fit['residual'], dims=[time_dim, 'station'])
+    ds[time_dim] = var_ds[time_dim]
+    ds['station'] = stations
+    ds['H'].attrs['long_name'] = 'scale height'
+    ds['H'].attrs['units'] = 'meters'
+    ds['H'].attrs['formula'] = 'a0 * exp(-Height/H)'
+    ds['a0'].attrs['long_name'] = 'value at sea level'
+    ds['r2'].attrs['long_name'] = 'R^2 of the log-linear fit'
+    ds['rmse'].attrs['long_name'] = 'root mean squared error of the fit'
+    ds['n'].attrs['long_name'] = 'number of stations in the fit'
+    ds['residual'].attrs['long_name'] = 'station value minus the fitted profile'
+    return ds
+
+
+def remove_scale_height(values, alts, H):
+    """bring values (time, station) to sea level with the scale height H
+    (time), the batched version of apply_lapse_rate_change"""
+    import numpy as np
+    H = np.atleast_1d(np.asarray(H, dtype=float))
+    return np.atleast_2d(values) * np.exp(np.asarray(alts, dtype=float)[None, :] / H[:, None])
+
+
 def get_var_lapse_rate(hdf, model='LR', plot=False):
     from aux_gps import linear_fit_using_scipy_da_ts
     import matplotlib.pyplot as plt
@@ -269,12 +545,17 @@ def get_var_lapse_rate(hdf, model='LR', plot=False):
     except AttributeError:
         dt = 'no time found'
     hda.name = ''
-    log_hda = np.log(hda)
     # assume pwv = pwv0*exp(-h/H)
     # H is the water vapor scale height
-    _, results = linear_fit_using_scipy_da_ts(log_hda, model=model, slope_factor=1, not_time=True)
-    H = -1.0 / results['slope']
-    a0 = np.exp(results['intercept'])
+    if model == 'LR':
+        fit = fit_scale_height(hda.values[None, :], hda['alt'].values)
+        H = fit['H'][0]
+        a0 = fit['a0'][0]
+    else:
+        log_hda = np.log(hda)
+        _, results = linear_fit_using_scipy_da_ts(log_hda, model=model, slope_factor=1, not_time=True)
+        H = -1.0 / results['slope']
+        a0 = np.exp(results['intercept'])
     modeled_var = a0 * np.exp(-hda['alt'] / H)
     if plot:
         fig, ax = plt.subplots()
@@ -305,48 +586,32 @@ def interpolate_at_one_dt(new_hdf, H, predict_df=None, dem_path=awd_path,
                           ppd=50, verbose=True):
     from aux_gps import coarse_dem
     import numpy as np
-    from pykrige.rk import Krige
     """ interpolate to Israel grid the values in new_hdf (already removed the lapse rate)
     with ppd being the map resolution. if predict_df is not None,
     interpolate only to df's locations and altitudes. predict_df should have lat, lon and alt columns"""
     # create mesh and load DEM:
     da = create_lat_lon_mesh(points_per_degree=ppd)  # 500?
     # populate the empty mesh grid with stations data:
-    for i, row in new_hdf.iterrows():
-        lat = da.sel(lat=row['lat'], method='nearest').lat.values
-        lon = da.sel(lon=row['lon'], method='nearest').lon.values
-        da.loc[{'lat': lat, 'lon': lon}] = row.iloc[0]
-
-    c = np.linspace(min(da.lat.values), max(da.lat.values), da.shape[0])
-    r = np.linspace(min(da.lon.values), max(da.lon.values), da.shape[1])
-    rr, cc = np.meshgrid(r, c)
-    vals = ~np.isnan(da.values)
-    X = np.column_stack([rr[vals], cc[vals]])
-    rr_cc_as_cols = np.column_stack([rr.flatten(), cc.flatten()])
-    # y = da_scaled.values[vals]
-    y = da.values[vals]
-    model = Krige(method='ordinary', variogram_model='spherical',
-                  verbose=verbose, coordinates_type='geographic')
-    model.fit(X, y)
+    grid = get_mesh_station_grid(new_hdf['lat'].values, new_hdf['lon'].values,
+                                 points_per_degree=ppd)
+    y = grid.cell_values(new_hdf.iloc[:, 0].values)
     if predict_df is None:
         # i.e., interpolate to all map coords:
-        interpolated = model.predict(rr_cc_as_cols).reshape(da.values.shape)
-        da_inter = da.copy(data=interpolated)
+        rr, cc = np.meshgrid(da.lon.values, da.lat.values)
+        interpolated = batched_ordinary_kriging(grid.cell_lon, grid.cell_lat,
+                                                y, rr, cc, verbose=verbose)
+        da_inter = da.copy(data=interpolated.reshape(da.values.shape))
         awd = coarse_dem(da, dem_path=dem_path)
         assert H > 0
         da_inter *= np.exp(-1.0 * awd / H)
         return da_inter
     else:
-        predict_lats = np.linspace(predict_df.lat.min(
-        ), predict_df.lat.max(), predict_df.lat.values.shape[0])
-        predict_lons = np.linspace(predict_df.lon.min(
-        ), predict_df.lon.max(), predict_df.lon.values.shape[0])
-        predict_lons_lats_as_cols = np.column_stack(
-            [predict_lons, predict_lats])
-        interpolated = model.predict(
-            predict_lons_lats_as_cols).reshape((predict_lats.shape))
+        interpolated = batched_ordinary_kriging(grid.cell_lon, grid.cell_lat,
+                                                y, predict_df['lon'].values,
+                                                predict_df['lat'].values,
+                                                verbose=verbose)
         df_inter = predict_df.copy()
-        df_inter['interpolated'] = interpolated
+        df_inter['interpolated'] = interpolated[0]
         # fix for lapse rate:
         assert H > 0
         df_inter['interpolated_lr_fixed'] = df_inter['interpolated'] * np.exp(-1.0 * df_inter['alt'] / H)
@@ -357,14 +622,442 @@ def create_lat_lon_mesh(lats=[29.5, 33.5], lons=[34, 36],
                         points_per_degree=1000):
     import xarray as xr
     import numpy as np
-    lat = np.arange(lats[0], lats[1], 1.0 / points_per_degree)
-    lon = np.arange(lons[0], lons[1], 1.0 / points_per_degree)
+    lat, lon = get_lat_lon_mesh_coords(lats, lons, points_per_degree)
     nans = np.nan * np.ones((len(lat), len(lon)))
     da = xr.DataArray(nans, dims=['lat', 'lon'])
     da['lat'] = lat
     da['lon'] = lon
     return da
 
+
+_mesh_coords_cache = {}
+_mesh_station_grid_cache = {}
+
+
+def get_lat_lon_mesh_coords(lats=[29.5, 33.5], lons=[34, 36],
+                            points_per_degree=1000):
+    """return the (cached) lat and lon coords of the mesh"""
+    import numpy as np
+    key = (tuple(lats), tuple(lons), points_per_degree)
+    if key not in _mesh_coords_cache:
+        lat = np.arange(lats[0], lats[1], 1.0 / points_per_degree)
+        lon = np.arange(lons[0], lons[1], 1.0 / points_per_degree)
+        lat.flags.writeable = False
+        lon.flags.writeable = False
+        _mesh_coords_cache[key] = (lat, lon)
+    return _mesh_coords_cache[key]
+
+
+class MeshStationGrid(object):
+    """the grid cells of a set of stations on the lat/lon mesh, computed
+    once so that painting the stations on the mesh (scatter), reading the
+    mesh at the stations (unscatter) and masking are single numpy index
+    operations for all the timesteps. stations are painted in their given
+    order, a valid station overwrites a previous one in the same cell"""
+
+    def __init__(self, lats, lons, mesh_lat, mesh_lon):
+        import numpy as np
+        self.mesh_lat = np.asarray(mesh_lat, dtype=float)
+        self.mesh_lon = np.asarray(mesh_lon, dtype=float)
+        self.shape = (self.mesh_lat.size, self.mesh_lon.size)
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        self.ilat = self.nearest_index(self.mesh_lat, lats)
+        self.ilon = self.nearest_index(self.mesh_lon, lons)
+        # flat cell of each station and the unique cells (in first
+        # appearence order) the stations occupy:
+        self.flat = self.ilat * self.shape[1] + self.ilon
+        cells, first, self.station_cell = np.unique(self.flat,
+                                                    return_index=True,
+                                                    return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        self.station_cell = rank[np.asarray(self.station_cell).ravel()]
+        self.cells = cells[order]
+        self.cell_lat = self.mesh_lat[self.cells // self.shape[1]]
+        self.cell_lon = self.mesh_lon[self.cells % self.shape[1]]
+
+    @staticmethod
+    def nearest_index(coords, points):
+        """index of the nearest coord of each point (the larger on ties, like
+        xarray sel with method=nearest), coords are sorted ascending"""
+        import numpy as np
+        ind = np.clip(np.searchsorted(coords, points), 1, coords.size - 1)
+        left = coords[ind - 1]
+        right = coords[ind]
+        return np.where(points - left < right - points, ind - 1, ind)
+
+    @property
+    def mask(self):
+        """boolean (lat, lon) mask of the cells occupied by stations"""
+        import numpy as np
+        mask = np.zeros(self.shape[0] * self.shape[1], dtype=bool)
+        mask[self.cells] = True
+        return mask.reshape(self.shape)
+
+    def cell_values(self, values):
+        """merge values (time, station) to (time, cell) values, the last
+        valid station in each cell wins"""
+        import numpy as np
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        out = np.full((values.shape[0], self.cells.size), np.nan)
+        # the valid values in (time, station) order, keep only the last
+        # station of each (time, cell) since numpy does not define which of
+        # repeated indices is assigned:
+        t, s = np.nonzero(~np.isnan(values))
+        flat = t * self.cells.size + self.station_cell[s]
+        _, last = np.unique(flat[::-1], return_index=True)
+        last = flat.size - 1 - last
+        out[t[last], self.station_cell[s[last]]] = values[t[last], s[last]]
+        return out
+
+    def scatter(self, values):
+        """paint values (time, station) on the mesh, returns
+        (time, lat, lon) with NaNs outside the stations cells"""
+        import numpy as np
+        cell_values = self.cell_values(values)
+        out = np.full((cell_values.shape[0], self.shape[0] * self.shape[1]),
+                      np.nan)
+        out[:, self.cells] = cell_values
+        return out.reshape((-1, ) + self.shape)
+
+    def unscatter(self, field):
+        """read a (time, lat, lon) or (lat, lon) field at the stations cells,
+        returns (time, station) or (station)"""
+        import numpy as np
+        field = np.asarray(field)
+        return field[..., self.ilat, self.ilon]
+
+
+def get_mesh_station_grid(lats, lons, points_per_degree=50,
+                          lat_range=[29.5, 33.5], lon_range=[34, 36]):
+    """return the (cached) MeshStationGrid of the stations"""
+    import numpy as np
+    key = (tuple(np.round(lats, 8)), tuple(np.round(lons, 8)),
+           points_per_degree, tuple(lat_range), tuple(lon_range))
+    if key not in _mesh_station_grid_cache:
+        mesh_lat, mesh_lon = get_lat_lon_mesh_coords(lat_range, lon_range,
+                                                     points_per_degree)
+        _mesh_station_grid_cache[key] = MeshStationGrid(lats, lons, mesh_lat,
+                                                        mesh_lon)
+    return _mesh_station_grid_cache[key]
+
+
+def great_circle_distance(lon1, lat1, lon2, lat2):
+    """great circle distance in degrees (same as pykrige's geographic
+    coordinates_type), inputs broadcast against each other"""
+    import numpy as np
+    lon1, lat1, lon2, lat2 = [np.radians(x) for x in [lon1, lat1, lon2, lat2]]
+    dlon = lon1 - lon2
+    c1 = np.cos(lat1)
+    s1 = np.sin(lat1)
+    c2 = np.cos(lat2)
+    s2 = np.sin(lat2)
+    cd = np.cos(dlon)
+    sd = np.sin(dlon)
+    w1 = np.sqrt((c2 * sd)**2 + (c1 * s2 - s1 * c2 * cd)**2)
+    w2 = s1 * s2 + c1 * c2 * cd
+    return np.degrees(np.arctan2(w1, w2))
+
+
+def get_points_distance(lon1, lat1, lon2, lat2, coordinates_type='geographic'):
+    """distance between points like pykrige, great circle degrees for
+    geographic and plain lon/lat distance for euclidean"""
+    import numpy as np
+    if coordinates_type == 'geographic':
+        return great_circle_distance(lon1, lat1, lon2, lat2)
+    elif coordinates_type == 'euclidean':
+        return np.sqrt((lon1 - lon2)**2 + (lat1 - lat2)**2)
+    else:
+        raise ValueError('coordinates_type should be geographic or euclidean')
+
+
+def spherical_variogram_model(params, d):
+    """spherical variogram, params are [psill, range, nugget]"""
+    import numpy as np
+    psill, range_, nugget = [float(x) for x in params]
+    d = np.asarray(d, dtype=float)
+    if range_ <= 0:
+        return np.full(d.shape, psill + nugget)
+    h = np.minimum(d / range_, 1.0)
+    return psill * (1.5 * h - 0.5 * h**3) + nugget
+
+
+def linear_variogram_model(params, d):
+    """linear variogram, params are [slope, nugget]"""
+    import numpy as np
+    slope, nugget = [float(x) for x in params]
+    return slope * np.asarray(d, dtype=float) + nugget
+
+
+variogram_models = {'spherical': spherical_variogram_model,
+                    'linear': linear_variogram_model}
+
+
+def fit_pooled_variogram(lons, lats, values, variogram_model='spherical',
+                         nlags=6, coordinates_type='geographic',
+                         verbose=False):
+    """fit one variogram (spherical or linear) to all the timesteps in
+    values (time, station) that share the same stations (lons, lats). the
+    semivariance in each lag bin is pooled over time, so for a single
+    timestep this is the same fit as pykrige's OrdinaryKriging"""
+    import numpy as np
+    from scipy.optimize import least_squares
+    values = np.atleast_2d(values)
+    i, j = np.triu_indices(len(lons), k=1)
+    d = get_points_distance(lons[i], lats[i], lons[j], lats[j],
+                            coordinates_type)
+    # mean semivariance of each pair over time, in chunks of time:
+    g = np.zeros(len(i))
+    chunk = max(1, 5000000 // max(len(i), 1))
+    for start in range(0, values.shape[0], chunk):
+        v = values[start:start + chunk]
+        g += (0.5 * (v[:, i] - v[:, j])**2).sum(axis=0)
+    g /= values.shape[0]
+    dmin = d.min()
+    dmax = d.max()
+    bins = dmin + np.arange(nlags + 1) * (dmax - dmin) / nlags
+    bins[-1] = dmax + 0.001
+    lag_ind = np.digitize(d, bins) - 1
+    counts = np.bincount(lag_ind, minlength=nlags)[:nlags]
+    ok = counts > 0
+    lags = np.bincount(lag_ind, weights=d, minlength=nlags)[:nlags][ok] / counts[ok]
+    semivariance = np.bincount(lag_ind, weights=g,
+                               minlength=nlags)[:nlags][ok] / counts[ok]
+    if variogram_model == 'spherical':
+        x0 = [semivariance.max() - semivariance.min(), 0.25 * lags.max(),
+              semivariance.min()]
+        upper = [10.0 * semivariance.max(), lags.max(), semivariance.max()]
+        if np.any(np.array(upper) <= 0):
+            # all values are identical, any variogram will do:
+            return np.array([1.0, lags.max(), 0.0])
+    elif variogram_model == 'linear':
+        lag_span = lags.max() - lags.min()
+        slope = (semivariance.max() - semivariance.min()) / lag_span if lag_span > 0 else 0.0
+        x0 = [slope, semivariance.min()]
+        upper = [np.inf, semivariance.max()]
+        if semivariance.max() <= 0:
+            return np.array([1.0, 0.0])
+    else:
+        raise ValueError('variogram_model should be one of {}'.format(list(variogram_models)))
+    func = variogram_models[variogram_model]
+
+    def residuals(params):
+        return func(params, lags) - semivariance
+
+    res = least_squares(residuals, np.clip(x0, 0, upper),
+                        bounds=([0] * len(x0), upper), loss='soft_l1')
+    if verbose:
+        print('{} variogram params: {}'.format(variogram_model, np.round(res.x, 4)))
+    return res.x
+
+
+def ordinary_kriging_weights(lons, lats, target_lons, target_lats, params,
+                             variogram_model='spherical',
+                             coordinates_type='geographic', chunk=50000,
+                             eps=1e-10):
+    """factor the ordinary kriging system of the stations once and return
+    the (target, station) weight matrix, so that the kriged field is
+    weights @ values for any values at these stations"""
+    import numpy as np
+    from scipy.linalg import lu_factor, lu_solve
+    func = variogram_models[variogram_model]
+    n = len(lons)
+    d = get_points_distance(lons[:, None], lats[:, None], lons[None, :],
+                            lats[None, :], coordinates_type)
+    a = np.zeros((n + 1, n + 1))
+    a[:n, :n] = -func(params, d)
+    np.fill_diagonal(a, 0.)
+    a[n, :n] = 1.0
+    a[:n, n] = 1.0
+    lu = lu_factor(a)
+    target_lons = np.asarray(target_lons, dtype=float).ravel()
+    target_lats = np.asarray(target_lats, dtype=float).ravel()
+    weights = np.empty((target_lons.size, n))
+    for start in range(0, target_lons.size, chunk):
+        sl = slice(start, start + chunk)
+        bd = get_points_distance(target_lons[sl, None], target_lats[sl, None],
+                                 lons[None, :], lats[None, :],
+                                 coordinates_type)
+        b = np.ones((bd.shape[0], n + 1))
+        b[:, :n] = -func(params, bd)
+        b[:, :n][np.abs(bd) <= eps] = 0.0
+        weights[sl] = lu_solve(lu, b.T).T[:, :n]
+    return weights
+
+
+def knn_idw_weights(lons, lats, target_lons, target_lats, n_neighbors=5):
+    """(target, station) weights of inverse (geodesic) distance weighting of
+    the n_neighbors nearest stations, like KNeighborsRegressor with
+    weights='distance'"""
+    import numpy as np
+    from aux_gps import GeoSpatialIndex
+    index = GeoSpatialIndex(lats, lons)
+    k = min(n_neighbors, len(lons))
+    dist, inds = index.query(np.ravel(target_lats), np.ravel(target_lons), k=k)
+    dist = dist.reshape(-1, k)
+    inds = inds.reshape(-1, k)
+    with np.errstate(divide='ignore'):
+        w = 1.0 / dist
+    # a target on a station takes its value:
+    exact = np.isinf(w)
+    w = np.where(exact.any(axis=1)[:, None], exact.astype(float), w)
+    w /= w.sum(axis=1)[:, None]
+    weights = np.zeros((inds.shape[0], len(lons)))
+    np.add.at(weights, (np.arange(inds.shape[0])[:, None], inds), w)
+    return weights
+
+
+def group_times_by_valid_stations(values):
+    """group the rows of values (time, station) by their set of valid
+    stations, returns a list of (station mask, time indices)"""
+    import numpy as np
+    valid = ~np.isnan(values)
+    # pack each row to bytes so that the rows are unique-d as scalars:
+    packed = np.ascontiguousarray(np.packbits(valid, axis=1))
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    inverse = np.asarray(inverse).ravel()
+    order = np.argsort(inverse, kind='stable')
+    splits = np.cumsum(np.bincount(inverse, minlength=first.size))[:-1]
+    return [(valid[f], inds) for f, inds in zip(first, np.split(order, splits))]
+
+
+def _weights_cache_key(*items):
+    """a short hash of the arrays and settings the weights depend on"""
+    import numpy as np
+    import hashlib
+    h = hashlib.blake2b(digest_size=16)
+    for item in items:
+        if isinstance(item, np.ndarray):
+            h.update(np.ascontiguousarray(item).tobytes())
+        else:
+            h.update(repr(item).encode())
+        h.update(b'|')
+    return h.digest()
+
+
+def apply_weights_by_valid_stations(values, weights_func, min_stations=3,
+                                    weights_cache=None, cache_key=b'',
+                                    verbose=False):
+    """group the timesteps of values (time, station) by their valid
+    stations and produce each group as one matrix product with the
+    (target, valid station) weights returned by
+    weights_func(valid, group_values). weights_cache is an optional dict
+    keyed by cache_key and the valid stations pattern, cache_key must
+    identify everything else the weights depend on (see _weights_cache_key)
+    for the cache to be shared across calls"""
+    import numpy as np
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    groups = group_times_by_valid_stations(values)
+    if verbose:
+        print('interpolating {} timesteps in {} station groups.'.format(values.shape[0], len(groups)))
+    out = None
+    for valid, inds in groups:
+        if valid.sum() < min_stations:
+            continue
+        vals = values[np.ix_(inds, np.flatnonzero(valid))]
+        key = cache_key + valid.tobytes()
+        if weights_cache is not None and key in weights_cache:
+            weights = weights_cache[key]
+        else:
+            weights = weights_func(valid, vals)
+            if weights_cache is not None:
+                weights_cache[key] = weights
+        if out is None:
+            out = np.full((values.shape[0], weights.shape[0]), np.nan)
+        out[inds] = vals @ weights.T
+    return out
+
+
+def batched_ordinary_kriging(lons, lats, values, target_lons, target_lats,
+                             variogram_model='spherical',
+                             coordinates_type='geographic', nlags=6,
+                             min_stations=3, weights_cache=None,
+                             pool_times=True, verbose=False):
+    """ordinary kriging of values (time, station) at stations lons/lats to
+    the target points. timesteps are grouped by their valid stations and
+    each group is solved once and produced as one matrix product. use
+    pool_times=False to fit the variogram of each timestep on its own
+    (slower, but then each timestep only depends on its own values). the
+    weights_cache key includes the values since the variogram is fitted from
+    them. returns (time, target) array, NaN where fewer than min_stations
+    are valid"""
+    import numpy as np
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    target_lons = np.asarray(target_lons, dtype=float).ravel()
+    target_lats = np.asarray(target_lats, dtype=float).ravel()
+
+    def weights_func(valid, vals):
+        params = fit_pooled_variogram(lons[valid], lats[valid], vals,
+                                      variogram_model=variogram_model,
+                                      nlags=nlags,
+                                      coordinates_type=coordinates_type,
+                                      verbose=verbose)
+        return ordinary_kriging_weights(lons[valid], lats[valid], target_lons,
+                                        target_lats, params,
+                                        variogram_model=variogram_model,
+                                        coordinates_type=coordinates_type)
+
+    if pool_times:
+        cache_key = b''
+        if weights_cache is not None:
+            cache_key = _weights_cache_key('okrig', lons, lats, values,
+                                           target_lons, target_lats,
+                                           variogram_model,
+                                           coordinates_type, nlags)
+        out = apply_weights_by_valid_stations(values, weights_func,
+                                              min_stations=min_stations,
+                                              weights_cache=weights_cache,
+                                              cache_key=cache_key,
+                                              verbose=verbose)
+    else:
+        out = np.full((values.shape[0], target_lons.size), np.nan)
+        for i in range(values.shape[0]):
+            row = apply_weights_by_valid_stations(values[[i]], weights_func,
+                                                  min_stations=min_stations)
+            if row is not None:
+                out[i] = row[0]
+    if out is None:
+        out = np.full((values.shape[0], target_lons.size), np.nan)
+    return out
+
+
+def batched_knn_interpolation(lons, lats, values, target_lons, target_lats,
+                              n_neighbors=5, min_stations=1,
+                              weights_cache=None, verbose=False):
+    """inverse distance weighting of the n_neighbors nearest valid stations
+    of values (time, station) to the target points, batched by the valid
+    stations like batched_ordinary_kriging"""
+    import numpy as np
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    target_lons = np.asarray(target_lons, dtype=float).ravel()
+    target_lats = np.asarray(target_lats, dtype=float).ravel()
+
+    def weights_func(valid, vals):
+        return knn_idw_weights(lons[valid], lats[valid], target_lons,
+                               target_lats, n_neighbors=n_neighbors)
+
+    cache_key = b''
+    if weights_cache is not None:
+        cache_key = _weights_cache_key('knn', lons, lats, target_lons,
+                                       target_lats, n_neighbors)
+    out = apply_weights_by_valid_stations(values, weights_func,
+                                          min_stations=min_stations,
+                                          weights_cache=weights_cache,
+                                          cache_key=cache_key,
+                                          verbose=verbose)
+    if out is None:
+        out = np.full((values.shape[0], target_lons.size), np.nan)
+    return out
+
+
 def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
                              gis_path=gis_path, method='okrig',
                              dem_path=work_yuval / 'AW3D30', lapse_rate=5.,
@@ -432,18 +1125,14 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
         ax_lapse.grid()
         ax_lapse.set_title(suptitle, fontsize=14, fontweight='bold')
 #     fig.suptitle(suptitle, fontsize=14, fontweight='bold')
-    alts = []
-    for i, row in geo_snap.iterrows():
-        lat = da.sel(lat=row['lat'], method='nearest').lat.values
-        lon = da.sel(lon=row['lon'], method='nearest').lon.values
-        alt = row['alt']
-        if lapse_rate is not None and var == 'TD':
-            da.loc[{'lat': lat, 'lon': lon}] = row[var] + \
-                lapse_rate * alt / 1000.0
-            alts.append(alt)
-        elif lapse_rate is None or var != 'TD':
-            da.loc[{'lat': lat, 'lon': lon}] = row[var]
-            alts.append(alt)
+    grid = MeshStationGrid(geo_snap['lat'].values, geo_snap['lon'].values,
+                           da['lat'].values, da['lon'].values)
+    if lapse_rate is not None and var == 'TD':
+        da.values = grid.scatter(geo_snap[var].values + lapse_rate *
+                                 geo_snap['alt'].values / 1000.0)[0]
+    else:
+        da.values = grid.scatter(geo_snap[var].values)[0]
+    alts = grid.scatter(geo_snap['alt'].values)[0][grid.mask]
     # da_scaled = scale_xr(da)
     c = np.linspace(min(da.lat.values), max(da.lat.values), da.shape[0])
     r = np.linspace(min(da.lon.values), max(da.lon.values), da.shape[1])
@@ -598,17 +1287,8 @@ def Interpolating_models_ims(time='2013-10-19T22:00:00', var='TD', plot=True,
     if lapse_rate is not None and var == 'TD':
         da_inter -= lapse_rate * awd / 1000.0
     if (rms is not None and cv is None):  # or (rms is not None and not u):
-        predicted = []
-        true_vals = []
-        for i, row in geo_snap.iterrows():
-            lat = da.sel(lat=row['lat'], method='nearest').lat.values
-            lon = da.sel(lon=row['lon'], method='nearest').lon.values
-            pred = da_inter.loc[{'lat': lat, 'lon': lon}].values.item()
-            true = row[var]
-            predicted.append(pred)
-            true_vals.append(true)
-        predicted = np.array(predicted)
-        true_vals = np.array(true_vals)
+        predicted = grid.unscatter(da_inter.values)
+        true_vals = geo_snap[var].values
         ms_error = mean_squared_error(true_vals, predicted)
         print("MSE: {:.5f}".format(ms_error))
     if plot:
@@ -106,9 +106,143 @@ def get_field_from_radiosonde(path=sound_path, field='Tm', data_type='phys',
     return da
 
 
-def calculate_edt_north_east_distance(lat_da, lon_da, method='fast'):
-    """fast mode is 11 times faster than slow mode, however fast distance is
-    larger than slow...solve this mystery"""
+def _geodetic_to_ecef(lat, lon, height):
+    """WGS84 geodetic (deg, deg, m) to earth centered earth fixed (m)"""
+    import numpy as np
+    a = 6378137.0
+    f = 1 / 298.257223563
+    e2 = f * (2 - f)
+    lat = np.deg2rad(lat)
+    lon = np.deg2rad(lon)
+    N = a / np.sqrt(1 - e2 * np.sin(lat)**2)
+    X = (N + height) * np.cos(lat) * np.cos(lon)
+    Y = (N + height) * np.cos(lat) * np.sin(lon)
+    Z = (N * (1 - e2) + height) * np.sin(lat)
+    return X, Y, Z
+
+
+def edt_drift_kernel(lat, lon, height=None, lat0=32.01, lon0=34.81, h0=0.0):
+    """the balloon drift of every (lat, lon, height) sample (plain arrays of
+    any shape, NaNs allowed) from the launch site (lat0, lon0, h0) in m:
+    ground is the WGS84 geodesic distance to the sample, north/east its
+    components along the launch azimuth (azimuthal equidistant, so
+    north**2 + east**2 = ground**2) and slant the straight line (ECEF) range
+    to it if height is given. returns a dict"""
+    import numpy as np
+    from pyproj import Geod
+    geod = Geod(ellps='WGS84')
+    lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float),
+                                   np.asarray(lon, dtype=float))
+    az, _, ground = geod.inv(np.full(lon.shape, float(lon0)),
+                             np.full(lat.shape, float(lat0)), lon, lat)
+    az = np.deg2rad(az)
+    out = {'north': ground * np.cos(az), 'east': ground * np.sin(az),
+           'ground': ground}
+    if height is not None:
+        X0, Y0, Z0 = _geodetic_to_ecef(lat0, lon0, np.asarray(h0, dtype=float))
+        X, Y, Z = _geodetic_to_ecef(lat, lon, np.asarray(height, dtype=float))
+        out['slant'] = np.sqrt((X - X0)**2 + (Y - Y0)**2 + (Z - Z0)**2)
+    return out
+
+
+def _edt_launch_height(H, dim='time'):
+    """the first valid Height of each sounding, broadcasted like H"""
+    h0 = H.isel({dim: H.notnull().argmax(dim)})
+    return h0.broadcast_like(H).transpose(*H.dims).values
+
+
+def calculate_edt_drift(ds, lat0=32.01, lon0=34.81, h0=None, dim='time'):
+    """north, east, ground and slant distance (km) from the launch site of
+    every sample of every sounding in the EDT ds (lat, lon and Height), h0
+    is the launch height in m, the first valid Height of each sounding if
+    None"""
+    import xarray as xr
+    lat, lon, H = xr.broadcast(ds['lat'], ds['lon'], ds['Height'])
+    if h0 is None:
+        h0 = _edt_launch_height(H, dim)
+    out = edt_drift_kernel(lat.values, lon.values, H.values, lat0=lat0,
+                           lon0=lon0, h0=h0)
+    long_names = {'north': 'distance north', 'east': 'distance east',
+                  'ground': 'geodesic distance from launch site',
+                  'slant': 'slant range from launch site'}
+    drift = xr.Dataset()
+    for key, long_name in long_names.items():
+        da = lat.copy(data=out[key] / 1000.0)
+        da.attrs = {'units': 'km', 'long_name': long_name}
+        drift['{}_distance'.format(key)] = da
+    drift.attrs['lat0'] = lat0
+    drift.attrs['lon0'] = lon0
+    return drift
+
+
+def compare_edt_drift_to_geodesic(ds, lat0=32.01, lon0=34.81, h0=None):
+    """report how calculate_edt_drift agrees with pyproj as the reference:
+    the sample positions solved back (direct geodesic problem) from the
+    north/east drift, the slant range against pyproj's WGS84 ECEF (EPSG:4979
+    -> EPSG:4978), and how far the drift is from the north/east distances
+    to the foot points on the launch meridian/parallel (what the slow mode
+    of calculate_edt_north_east_distance measures). returns the max absolute
+    differences in m"""
+    import numpy as np
+    import xarray as xr
+    from pyproj import Geod
+    from pyproj import Transformer
+    geod = Geod(ellps='WGS84')
+    lat, lon, H = xr.broadcast(ds['lat'], ds['lon'], ds['Height'])
+    lat = lat.values
+    lon = lon.values
+    if h0 is None:
+        h0 = _edt_launch_height(H)
+    drift = calculate_edt_drift(ds, lat0=lat0, lon0=lon0, h0=h0)
+    north = drift['north_distance'].values * 1000
+    east = drift['east_distance'].values * 1000
+    slant = drift['slant_distance'].values * 1000
+    fixed_lat = np.full(lat.shape, float(lat0))
+    fixed_lon = np.full(lon.shape, float(lon0))
+    # direct problem back to the samples:
+    lon_back, lat_back, _ = geod.fwd(fixed_lon, fixed_lat,
+                                     np.rad2deg(np.arctan2(east, north)),
+                                     np.hypot(north, east))
+    _, _, position = geod.inv(lon_back, lat_back, lon, lat)
+    # pyproj's ECEF:
+    to_ecef = Transformer.from_crs(4979, 4978, always_xy=True)
+    X0, Y0, Z0 = to_ecef.transform(fixed_lon, fixed_lat,
+                                   np.broadcast_to(h0, lat.shape))
+    X, Y, Z = to_ecef.transform(lon, lat, H.values)
+    ref_slant = np.sqrt((X - X0)**2 + (Y - Y0)**2 + (Z - Z0)**2)
+    # the meridian/parallel foot points:
+    _, _, foot_north = geod.inv(fixed_lon, fixed_lat, fixed_lon, lat)
+    _, _, foot_east = geod.inv(fixed_lon, fixed_lat, lon, fixed_lat)
+    foot_north = np.copysign(foot_north, lat - lat0)
+    foot_east = np.copysign(foot_east, lon - lon0)
+    results = {'samples': int(np.isfinite(north).sum()),
+               'max_ground_km': float(np.nanmax(drift['ground_distance'])),
+               'position_m': float(np.nanmax(position)),
+               'slant_m': float(np.nanmax(np.abs(slant - ref_slant))),
+               'foot_north_m': float(np.nanmax(np.abs(north - foot_north))),
+               'foot_east_m': float(np.nanmax(np.abs(east - foot_east)))}
+    print('{} samples up to {:.1f} km from launch:'.format(
+        results['samples'], results['max_ground_km']))
+    print('position back from drift: {:.1e} m, slant vs pyproj ECEF: {:.1e} m.'.format(
+        results['position_m'], results['slant_m']))
+    print('drift vs meridian/parallel foot points: north {:.1f} m, east {:.1f} m.'.format(
+        results['foot_north_m'], results['foot_east_m']))
+    return results
+
+
+def calculate_edt_north_east_distance(lat_da, lon_da, method='geodesic'):
+    """geodesic mode is edt_drift_kernel on all the samples at once. fast mode
+    is 11 times faster than slow mode, however fast distance is larger than
+    slow: it feeds (lat, lon) to an always_xy transformer"""
+    if method == 'geodesic':
+        drift = edt_drift_kernel(lat_da.values, lon_da.values)
+        north = lat_da.copy(data=drift['north'] / 1000.0)
+        north.attrs['units'] = 'km'
+        north.attrs['long_name'] = 'distance north'
+        east = lon_da.copy(data=drift['east'] / 1000.0)
+        east.attrs['long_name'] = 'distance east'
+        east.attrs['units'] = 'km'
+        return north, east
     from shapely.geometry import Point
     from pyproj import Transformer
     import geopandas as gpd
@@ -339,61 +473,147 @@ def analyse_radiosonde_climatology(path=sound_path, data_type='phys',
     return df_copy
 
 
+def _profiles_to_array(da, dim):
+    """return the (dim, level) values of da and the name of its level dim"""
+    import numpy as np
+    level_dim = [x for x in da.dims if x != dim][0]
+    return np.asarray(da.transpose(dim, level_dim).values, dtype=float), level_dim
+
+
+def batched_pw_from_profiles(P, Dewpt, bottom=None, top=None):
+    """the precipitable water (mm) of all the (sounding, level) profiles of
+    pressure P (hPa) and dew point Dewpt (degC) at once, NaN padded. follows
+    metpy's precipitable_water (Bolton saturation vapor pressure): the layer
+    from bottom to top pressure with the dew point log-interpolated at the
+    bounds. a profile whose bottom/top is outside its pressure range gets the
+    whole column (like the fallback in process_new_field_from_radiosonde_data)"""
+    import numpy as np
+    P = np.atleast_2d(np.asarray(P, dtype=float))
+    Dewpt = np.atleast_2d(np.asarray(Dewpt, dtype=float))
+    valid = ~np.isnan(P) & ~np.isnan(Dewpt)
+    # sort each profile by decreasing pressure, invalid levels go last:
+    order = np.argsort(np.where(valid, -P, np.inf), axis=1, kind='stable')
+    p = np.take_along_axis(np.where(valid, P, np.nan), order, axis=1)
+    d = np.take_along_axis(np.where(valid, Dewpt, np.nan), order, axis=1)
+    with np.errstate(all='ignore'):
+        p_max = np.nanmax(p, axis=1)
+        p_min = np.nanmin(p, axis=1)
+    bot = np.full(p.shape[0], np.nan) if bottom is None else np.full(p.shape[0], float(bottom))
+    tp = np.full(p.shape[0], np.nan) if top is None else np.full(p.shape[0], float(top))
+    out_of_range = ((bot < p_min) | (bot > p_max) | (tp < p_min) | (tp > p_max))
+    bot = np.where(np.isnan(bot) | out_of_range, p_max, bot)[:, None]
+    tp = np.where(np.isnan(tp) | out_of_range, p_min, tp)[:, None]
+    # each segment between consecutive levels, clipped to the layer:
+    p0, p1 = p[:, :-1], p[:, 1:]
+    d0, d1 = d[:, :-1], d[:, 1:]
+    hi = np.minimum(p0, bot)
+    lo = np.maximum(p1, tp)
+
+    def mixing_ratio_at(pres):
+        with np.errstate(all='ignore'):
+            w = (np.log(pres) - np.log(p0)) / (np.log(p1) - np.log(p0))
+            w = np.where(p0 == p1, 0.0, w)
+            dew = d0 + w * (d1 - d0)
+            e = 6.112 * np.exp(17.67 * dew / (dew + 243.5))
+            return 0.6219569100577033 * e / (pres - e)
+
+    with np.errstate(invalid='ignore'):
+        seg = 0.5 * (mixing_ratio_at(hi) + mixing_ratio_at(lo)) * (hi - lo)
+        seg = np.where(hi > lo, seg, 0.0)
+    # hPa -> Pa, divide by g * rho_l and m -> mm:
+    pw = np.nansum(seg, axis=1) * 100.0 / (9.80665 * 999.97495) * 1000.0
+    return np.where(valid.any(axis=1), pw, np.nan)
+
+
+def batched_tm_from_profiles(VP, T, Rho, P, bottom=None, top=None):
+    """the water vapor mean temperature (K) of all the (sounding, level)
+    profiles at once with the pressure sum method of
+    calculate_tm_via_pressure_sum, T in degC. as there, the pairs of levels
+    that touch a NaN are skipped, unless bottom/top is given, then the levels
+    outside it (and those with NaN P) are dropped first"""
+    import numpy as np
+    VP, T, Rho, P = [np.atleast_2d(np.asarray(x, dtype=float))
+                     for x in [VP, T, Rho, P]]
+    kept = np.ones(P.shape, dtype=bool)
+    with np.errstate(invalid='ignore'):
+        if bottom is not None:
+            kept &= P <= bottom
+        if top is not None:
+            kept &= P >= top
+    # move the kept levels to the front (in order) so neighbours are pairs:
+    order = np.argsort(~kept, axis=1, kind='stable')
+    kept = np.take_along_axis(kept, order, axis=1)
+    P, VP, T, Rho = [np.take_along_axis(x, order, axis=1) for x in [P, VP, T, Rho]]
+    T = T + 273.15
+    pair = kept[:, 1:] & kept[:, :-1]
+    with np.errstate(all='ignore'):
+        dp = np.abs(P[:, :-1] - P[:, 1:])
+        num = VP / (T * Rho)
+        denom = VP / (T**2 * Rho)
+        numerator = np.nansum(np.where(pair, (num[:, 1:] + num[:, :-1]) * dp / 2, np.nan), axis=1)
+        denominator = np.nansum(np.where(pair, (denom[:, 1:] + denom[:, :-1]) * dp / 2, np.nan), axis=1)
+        return numerator / denominator
+
+
+def batched_ts_from_profiles(T):
+    """the surface temperature (K) of all the (sounding, level) profiles,
+    i.e., the first valid temperature (degC) of each"""
+    import numpy as np
+    T = np.atleast_2d(np.asarray(T, dtype=float))
+    valid = ~np.isnan(T)
+    first = np.argmax(valid, axis=1)
+    ts = T[np.arange(T.shape[0]), first] + 273.15
+    return np.where(valid.any(axis=1), ts, np.nan)
+
+
 def process_new_field_from_radiosonde_data(phys_ds, dim='sound_time',
                                            field_name='pw', bottom=None,
                                            top=None, verbose=False):
+    """compute the field (pw, tm or ts) of all the soundings at once on the
+    padded (dim, level) arrays of phys_ds"""
     import xarray as xr
     from aux_gps import keep_iqr
-    field_list = []
-    for i in range(phys_ds[dim].size):
-        record = phys_ds[dim].isel({dim: i})
-        if 'time' in dim:
-            record = record.dt.strftime('%Y-%m-%d %H:%M').values.item()
-        if verbose:
-            print('processing {} for {} field.'.format(record, field_name))
-        if field_name == 'pw':
-            long_name = 'Precipatiable water'
-            Dewpt = phys_ds['Dewpt'].isel({dim: i})
-            P = phys_ds['P'].isel({dim: i})
-            try:
-                field, unit = wrap_xr_metpy_pw(Dewpt, P, bottom=bottom, top=top)
-            except ValueError:
-                field, unit = wrap_xr_metpy_pw(Dewpt, P, bottom=None, top=None)
-        elif field_name == 'tm':
-            long_name = 'Water vapor mean air temperature'
-            P = phys_ds['P'].isel({dim: i})
-            T = phys_ds['T'].isel({dim: i})
-            RH = phys_ds['RH'].isel({dim: i})
-            if 'VP' not in phys_ds:
-                if 'MR' not in phys_ds:
-                    MR = wrap_xr_metpy_mixing_ratio(P, T, RH, verbose=False)
-                VP = wrap_xr_metpy_vapor_pressure(P, MR)
-            else:
-                VP = phys_ds['VP'].isel({dim: i})
-            if 'Rho' not in phys_ds:
-                Rho = wrap_xr_metpy_density(P, T, MR, verbose=False)
-            else:
-                Rho = phys_ds['Rho'].isel({dim: i})
-            field, unit = calculate_tm_via_pressure_sum(VP, T, Rho, P,
-                                                        bottom=bottom,
-                                                        top=top)
-        elif field_name == 'ts':
-            long_name = 'Surface temperature'
-            if 'Height' in phys_ds['T'].dims:
-                dropped = phys_ds['T'].isel({dim: i}).dropna('Height')
-            elif 'time' in phys_ds['T'].dims:
-                dropped = phys_ds['T'].isel({dim: i}).dropna('time')
-            field = dropped[0].values.item() + 273.15
-            unit = 'K'
-        field_list.append(field)
-    da = xr.DataArray(field_list, dims=[dim])
+    if verbose:
+        print('processing {} soundings for {} field.'.format(phys_ds[dim].size, field_name))
+    if field_name == 'pw':
+        long_name = 'Precipatiable water'
+        P, _ = _profiles_to_array(phys_ds['P'], dim)
+        Dewpt, _ = _profiles_to_array(phys_ds['Dewpt'], dim)
+        field = batched_pw_from_profiles(P, Dewpt, bottom=bottom, top=top)
+        unit = 'mm'
+    elif field_name == 'tm':
+        long_name = 'Water vapor mean air temperature'
+        P = phys_ds['P']
+        T = phys_ds['T']
+        # the missing fields in one pass:
+        missing = [x for x in ['VP', 'Rho'] if x not in phys_ds]
+        thermo = phys_ds[[x for x in ['VP', 'Rho'] if x in phys_ds]]
+        if missing and 'MR' in phys_ds:
+            thermo.update(calculate_thermodynamics(P, T, MR=phys_ds['MR'],
+                                                   fields=missing))
+        elif missing:
+            thermo.update(calculate_thermodynamics(P, T, RH=phys_ds['RH'],
+                                                   fields=missing))
+        VP = thermo['VP']
+        Rho = thermo['Rho']
+        # check that VP and P have the same units:
+        assert P.attrs['units'] == VP.attrs['units']
+        arrays = [_profiles_to_array(x, dim)[0] for x in [VP, T, Rho, P]]
+        field = batched_tm_from_profiles(*arrays, bottom=bottom, top=top)
+        unit = 'K'
+    elif field_name == 'ts':
+        long_name = 'Surface temperature'
+        T, _ = _profiles_to_array(phys_ds['T'], dim)
+        field = batched_ts_from_profiles(T)
+        unit = 'K'
+    da = xr.DataArray(field, dims=[dim])
     da[dim] = phys_ds[dim]
     da.attrs['units'] = unit
     da.attrs['long_name'] = long_name
     if top is not None:
         da.attrs['top'] = top
     if bottom is not None:
-        da.attrs['bottom'] = top
+        da.attrs['bottom'] = bottom
     da = keep_iqr(da, dim=dim, k=1.5)
     if verbose:
         print('Done!')
@@ -604,20 +824,9 @@ def wrap_xr_metpy_specific_humidity(MR, verbose=False):
 
 
 def calculate_atmospheric_refractivity(P, T, RH, verbose=False):
-    MR = wrap_xr_metpy_mixing_ratio(P, T, RH)
-    VP = wrap_xr_metpy_vapor_pressure(P, MR)
-    try:
-        T_unit = T.attrs['units']
-        assert T_unit == 'degC'
-    except KeyError:
-        T_unit = 'degC'
-        if verbose:
-            print('assuming temperature units are degree celsius...')
-    # convert to Kelvin:
-    T_k = T + 273.15
-    N = 77.6 * P / T_k + 3.73e5 * VP / T_k**2
-    N.attrs['units'] = 'dimensionless'
-    N.attrs['long_name'] = 'Index of Refractivity'
+    N = calculate_thermodynamics(P, T, RH=RH, fields=['N'],
+                                 verbose=verbose)['N']
+    N.name = None
     return N
 
 
@@ -994,45 +1203,212 @@ def categorize_da_ts(da_ts, season=None, add_hours_to_dt=None, resample=True,
 
 
 def prepare_radiosonde_and_solve_MLH(ds, method='T', max_height=300):
-    import xarray as xr
+    """solve the MLH of all the soundings of ds at once, method=T for the
+    surface inversion, WW for Wang & Wang 2014, rib/rig for the bulk/gradient
+    richardson number. returns only the soundings where an MLH was found"""
     import pandas as pd
     ds = ds.drop_sel(time=pd.to_timedelta(0, unit='s'))
     # nullify the first Height:
     ds['Height'] -= ds['Height'].isel(time=0)
-    pbls = []
-    stimes = []
-    for i in range(ds['sound_time'].size):
-        if method == 'T':
-            mlh = find_surface_inversion_height(
-                    ds.isel(
-                            sound_time=i).reset_coords(
-                                    drop=True), max_height=max_height)
-        elif method == 'rig':
-            mlh = find_MLH_from_2s_richardson(
-                    ds.isel(
-                            sound_time=i).reset_coords(
-                                    drop=True), method='grad')
-        elif method == 'WW':
-            mlh = find_MLH_from_2s_WW2014(
-                ds.isel(
-                    sound_time=i), alt_cutoff=max_height)
-        elif method == 'rib':
-            mlh = find_MLH_from_2s_richardson(
-                ds.isel(
-                    sound_time=i), method='bulk')
-        if mlh is not None:
-            pbls.append(mlh)
-            stimes.append(ds.isel(sound_time=i)['sound_time'])
-    sound_time = xr.concat(stimes, 'sound_time')
-    pbl = xr.DataArray([x.values for x in pbls], dims=['sound_time'])
-    pbl['sound_time'] = sound_time
-    pbl = pbl.sortby('sound_time')
+    if method == 'T':
+        pbl = batched_surface_inversion_height(ds, max_height=max_height)
+    elif method == 'rig':
+        pbl = batched_MLH_from_2s_richardson(ds, method='grad')
+    elif method == 'WW':
+        pbl = batched_MLH_from_2s_WW2014(ds, alt_cutoff=max_height)
+    elif method == 'rib':
+        pbl = batched_MLH_from_2s_richardson(ds, method='bulk')
+    pbl = pbl.dropna('sound_time').sortby('sound_time')
+    pbl.name = None
+    pbl.attrs = {}
     pbl.attrs['method'] = method
     if max_height is not None:
         pbl.attrs['max_height'] = max_height
     return pbl
 
 
+def _compact_rows(mask, *arrays):
+    """move the masked values of each row to its start (keeping their order)
+    and pad with NaNs, returns the compacted arrays and the row lengths"""
+    import numpy as np
+    order = np.argsort(~mask, axis=1, kind='stable')
+    n = mask.sum(axis=1)
+    valid = np.arange(mask.shape[1])[None, :] < n[:, None]
+    out = []
+    for arr in arrays:
+        arr = np.take_along_axis(np.asarray(arr, dtype=float), order, axis=1)
+        out.append(np.where(valid, arr, np.nan))
+    return out, n
+
+
+def _rows_gradient(f, x, n):
+    """np.gradient (edge_order=1) of each row of f with its own coordinate x,
+    rows are compacted and n long"""
+    import numpy as np
+    d = np.full(f.shape, np.nan)
+    rows = np.arange(f.shape[0])[n >= 2]
+    m = n[n >= 2]
+    with np.errstate(all='ignore'):
+        dx1 = x[:, 1:-1] - x[:, :-2]
+        dx2 = x[:, 2:] - x[:, 1:-1]
+        a = -dx2 / (dx1 * (dx1 + dx2))
+        b = (dx2 - dx1) / (dx1 * dx2)
+        c = dx1 / (dx2 * (dx1 + dx2))
+        d[:, 1:-1] = a * f[:, :-2] + b * f[:, 1:-1] + c * f[:, 2:]
+        d[rows, 0] = (f[rows, 1] - f[rows, 0]) / (x[rows, 1] - x[rows, 0])
+        d[rows, m - 1] = ((f[rows, m - 1] - f[rows, m - 2]) /
+                          (x[rows, m - 1] - x[rows, m - 2]))
+    d[np.arange(f.shape[1])[None, :] >= n[:, None]] = np.nan
+    return d
+
+
+def _rows_smooth(d, weights=[0.25, 0.5, 0.25]):
+    """the centered weighted rolling mean of smooth_xr along each row"""
+    import numpy as np
+    s = np.full(d.shape, np.nan)
+    s[:, 1:-1] = (weights[0] * d[:, :-2] + weights[1] * d[:, 1:-1] +
+                  weights[2] * d[:, 2:])
+    return s
+
+
+def _rows_searchsorted(a, n, v, side='left'):
+    """np.searchsorted(a[i, :n[i]], v, side) for every row i at once. like the
+    per-profile calls, rows need not be sorted: this is the same binary search
+    (NaNs compare as the largest values) so the same index comes out"""
+    import numpy as np
+    a = np.where(np.isnan(a), np.inf, a)
+    rows = np.arange(a.shape[0])
+    lo = np.zeros(a.shape[0], dtype=int)
+    hi = np.asarray(n, dtype=int).copy()
+    active = lo < hi
+    while active.any():
+        mid = lo + ((hi - lo) >> 1)
+        val = a[rows, np.minimum(mid, a.shape[1] - 1)]
+        if side == 'left':
+            right = val < v
+        else:
+            right = val <= v
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+
+def _mlh_to_da(ds, mlh):
+    import xarray as xr
+    da = xr.DataArray(mlh, dims=['sound_time'])
+    da['sound_time'] = ds['sound_time'].values
+    da.name = 'MLH'
+    da.attrs['long_name'] = 'Mixing Layer Height'
+    da.attrs['units'] = 'm'
+    return da
+
+
+def batched_surface_inversion_height(ds, min_height=None, max_height=300):
+    """find_surface_inversion_height for all the (sound_time, time) soundings
+    of ds at once, NaN where no surface inversion was found"""
+    import numpy as np
+    T = ds['T'].transpose('sound_time', 'time').values
+    H = ds['Height'].transpose('sound_time', 'time').values
+    with np.errstate(invalid='ignore'):
+        mask = H <= max_height
+        if min_height is not None:
+            mask &= H >= min_height
+    (T, H), n = _compact_rows(mask, T, H)
+    dT = _rows_smooth(_rows_gradient(T, H, n))
+    (dT,), m = _compact_rows(~np.isnan(dT), dT)
+    left = _rows_searchsorted(-dT, m, 0, side='left')
+    right = _rows_searchsorted(-dT, m, 0, side='right')
+    rows = np.arange(H.shape[0])
+    ind = left
+    prev = np.maximum(ind - 1, 0)
+    mlh = np.where(left == right, (H[rows, prev] + H[rows, ind]) / 2,
+                   H[rows, ind])
+    # condition for SBL i.e., the temp increases with height until reveres
+    with np.errstate(invalid='ignore'):
+        positive_dT = (dT[:, 0] - dT[rows, prev]) > 0
+    found = (ind < m - 1) & (ind > 0) & positive_dT
+    return _mlh_to_da(ds, np.where(found, mlh, np.nan))
+
+
+def batched_MLH_from_2s_WW2014(ds, alt_cutoff=None, eps=50, ncand=10):
+    """find_MLH_from_2s_WW2014 for all the (sound_time, time) soundings of ds
+    at once: the ncand heights of the largest PT and smallest N, RH and MR
+    smoothed gradients are ranked and the MLH is the mean of the first rank
+    where 3 or 4 of them agree within eps meters, NaN where none do"""
+    import numpy as np
+    ds = ds.copy()
+    missing = [x for x in ['PT', 'N'] if x not in ds]
+    if missing:
+        ds.update(calculate_thermodynamics(ds['P'], ds['T'], RH=ds['RH'],
+                                           fields=missing))
+    fields = ['PT', 'N', 'RH', 'MR']
+    values = [ds[x].transpose('sound_time', 'time').values for x in fields]
+    H = ds['Height'].transpose('sound_time', 'time').values
+    with np.errstate(invalid='ignore'):
+        if alt_cutoff is not None:
+            mask = H <= alt_cutoff
+        else:
+            mask = ~np.isnan(H)
+    compacted, n = _compact_rows(mask, H, *values)
+    H = compacted[0]
+    grads = [_rows_smooth(_rows_gradient(x, H, n)) for x in compacted[1:]]
+    valid = np.all([~np.isnan(x) for x in grads], axis=0)
+    count = valid.sum(axis=1)
+    cands = []
+    for field, grad in zip(fields, grads):
+        # largest PT gradients, smallest for the rest (ties keep the first):
+        key = -grad if field == 'PT' else grad
+        order = np.argsort(np.where(valid, key, np.nan), axis=1,
+                           kind='stable')[:, :ncand]
+        cand = np.take_along_axis(H, order, axis=1)
+        cand[np.arange(order.shape[1])[None, :] >= count[:, None]] = np.nan
+        cands.append(cand)
+    cands = np.sort(np.stack(cands, axis=-1), axis=-1)
+    with np.errstate(invalid='ignore'):
+        agree_3_1 = (cands[..., 3] - cands[..., 1]) <= eps
+        agree_2_0 = (cands[..., 2] - cands[..., 0]) <= eps
+    mlh = np.where(agree_3_1 & agree_2_0, cands.mean(axis=-1),
+                   np.where(agree_3_1, cands[..., 1:4].mean(axis=-1),
+                            cands[..., 0:3].mean(axis=-1)))
+    agree = agree_3_1 | agree_2_0
+    first = agree.argmax(axis=1)
+    rows = np.arange(mlh.shape[0])
+    mlh = np.where(agree.any(axis=1), mlh[rows, first], np.nan)
+    not_found = np.isnan(mlh).sum()
+    if not_found > 0:
+        print('MLH Not found for {} out of {} soundings using W&W!'.format(
+            not_found, mlh.size))
+    return _mlh_to_da(ds, mlh)
+
+
+def batched_MLH_from_2s_richardson(ds, crit=0.25, method='bulk'):
+    """find_MLH_from_2s_richardson for all the (sound_time, time) soundings of
+    ds at once, NaN where the richardson number does not cross crit"""
+    import numpy as np
+    ri_dict = {'bulk': 'rib', 'grad': 'rig'}
+    ri_name = ri_dict.get(method)
+    ds = ds.transpose('sound_time', 'time', ...)
+    if ri_name in ds:
+        ri = ds[ri_name]
+    else:
+        ri = calculate_richardson_from_2s_radiosonde(ds, method=method)
+    ri = np.asarray(ri.transpose('sound_time', 'time').values, dtype=float)
+    H = ds['Height'].transpose('sound_time', 'time').values
+    n = np.full(ri.shape[0], ri.shape[1])
+    left = _rows_searchsorted(ri, n, crit, side='left')
+    right = _rows_searchsorted(ri, n, crit, side='right')
+    rows = np.arange(ri.shape[0])
+    ind = left
+    prev = np.maximum(ind - 1, 0)
+    pair = np.stack([H[rows, prev], H[rows, ind]])
+    with np.errstate(invalid='ignore'):
+        pair_mean = np.nansum(pair, axis=0) / (~np.isnan(pair)).sum(axis=0)
+    mlh = np.where(left == right, pair_mean, H[rows, ind])
+    found = (ind < ri.shape[1] - 1) & (ind > 0)
+    return _mlh_to_da(ds, np.where(found, mlh, np.nan))
+
+
 def classify_bet_dagan_pblh(path=sound_path, savepath=None):
     import xarray as xr
     from aux_gps import save_ncfile
@@ -1244,10 +1620,8 @@ def plot_2s_radiosonde_single_profile(ds, max_height=1000, rib_lims=None,
     mlh_t = find_surface_inversion_height(ds, max_time=None, max_height=300)
     ds['rib'] = calculate_richardson_from_2s_radiosonde(ds, method='bulk')
     ds['rig'] = calculate_richardson_from_2s_radiosonde(ds, method='grad')
-    ds['N'] = calculate_atmospheric_refractivity(ds['P'], ds['T'], ds['RH'])
-    T_k = ds['T'] + 273.15
-    T_k.attrs['units'] = 'K'
-    ds['PT'] = wrap_xr_metpy_potential_temperature(ds['P'], T_k)  # in degC
+    ds.update(calculate_thermodynamics(ds['P'], ds['T'], RH=ds['RH'],
+                                       fields=['N', 'PT']))
     ds = ds.assign_coords(time=ds['Height'].values)
     ds = ds.drop('Height')
     ds = ds.rename(time='Height')
@@ -1359,15 +1733,6 @@ def plot_2s_radiosonde_single_profile(ds, max_height=1000, rib_lims=None,
 
 def calculate_richardson_from_2s_radiosonde(ds, g=9.79474, method='bulk'):
     import numpy as np
-    dsize = len(ds.dims)
-    if dsize == 2:
-        axis=1
-    else:
-        axis=0
-    T_k = ds['T'] + 273.15
-    T_k.attrs['units'] = 'K'
-    PT = wrap_xr_metpy_potential_temperature(ds['P'], T_k)
-    VPT = wrap_xr_metpy_virtual_potential_temperature(ds['P'], ds['T'], ds['MR'])
     U = ds['u']
     V = ds['v']
     H = ds['Height']
@@ -1375,6 +1740,8 @@ def calculate_richardson_from_2s_radiosonde(ds, g=9.79474, method='bulk'):
 #    VPT = PT * (1 +ds['MR']*1000/0.622)/(1+ds['MR']*1000) - 273.15
 #    VPT_mean = VPT.cumsum('time') / (np.arange(H.size) + 1)
     if method == 'bulk':
+        VPT = calculate_thermodynamics(ds['P'], ds['T'], MR=ds['MR'],
+                                       fields=['VPT'])['VPT']
         H0 = H.isel(time=0)
 #        H0 = 0
         U0 = U.isel(time=0)
@@ -1392,7 +1759,8 @@ def calculate_richardson_from_2s_radiosonde(ds, g=9.79474, method='bulk'):
         Ri.attrs.update(units='dimensionless')
     elif method == 'grad':
 #        PT -= 273.15
-        BVF2 = wrap_xr_metpy_brunt_vaisala_f2(H, PT, verbose=False, axis=axis)
+        BVF2 = calculate_thermodynamics(ds['P'], ds['T'], Height=H,
+                                        fields=['BVF2'], dim='time')['BVF2']
 #        U.assign_coords(time=H)
 #        V.assign_coords(time=H)
 #        U = U.rename(time='Height')
@@ -1451,12 +1819,10 @@ def find_MLH_from_2s_WW2014(ds, alt_cutoff=None, eps=50,
     dsize = len(ds.dims)
     if dsize != 1:
         raise('ds has to be 1D!')
-    if 'PT' not in ds:
-        T_k = ds['T'] + 273.15
-        T_k.attrs['units'] = 'K'
-        ds['PT'] = wrap_xr_metpy_potential_temperature(ds['P'], T_k)
-    if 'N' not in ds:
-        ds['N'] = calculate_atmospheric_refractivity(ds['P'], ds['T'], ds['RH'])
+    missing = [x for x in ['PT', 'N'] if x not in ds]
+    if missing:
+        ds.update(calculate_thermodynamics(ds['P'], ds['T'], RH=ds['RH'],
+                                           fields=missing))
     dt = pd.to_datetime(ds['sound_time'].item())
     dss = ds[['PT', 'RH', 'MR', 'N']].reset_coords(drop=True)
     df_plot = dss.to_dataframe()
@@ -1972,6 +2338,314 @@ def wrap_xr_metpy_dewpoint(T, RH, verbose=False):
     return da
 
 
+def _first_derivative(f, x, axis=-1):
+    """metpy's first_derivative (second order, also at the edges) of f along
+    axis with the (same shaped) coordinate x"""
+    import numpy as np
+    f = np.moveaxis(f, axis, -1)
+    x = np.moveaxis(x, axis, -1)
+    d = np.full(f.shape, np.nan)
+    if f.shape[-1] < 3:
+        return np.moveaxis(d, -1, axis)
+    dx = np.diff(x, axis=-1)
+    with np.errstate(all='ignore'):
+        d0 = dx[..., :-1]
+        d1 = dx[..., 1:]
+        comb = d0 + d1
+        d[..., 1:-1] = (-d1 / (comb * d0) * f[..., :-2] +
+                        (d1 - d0) / (d0 * d1) * f[..., 1:-1] +
+                        d0 / (comb * d1) * f[..., 2:])
+        d0, d1 = dx[..., 0], dx[..., 1]
+        comb = d0 + d1
+        d[..., 0] = (-(2 * d0 + d1) / (d0 * comb) * f[..., 0] +
+                     comb / (d0 * d1) * f[..., 1] -
+                     d0 / (comb * d1) * f[..., 2])
+        d0, d1 = dx[..., -2], dx[..., -1]
+        comb = d0 + d1
+        d[..., -1] = (d1 / (comb * d0) * f[..., -3] -
+                      comb / (d0 * d1) * f[..., -2] +
+                      (2 * d1 + d0) / (d1 * comb) * f[..., -1])
+    return np.moveaxis(d, -1, axis)
+
+
+def thermodynamics_kernel(P, T, RH=None, MR=None, Height=None,
+                          fields=['MR', 'VP', 'Rho', 'VPT'], axis=-1,
+                          saturation='bolton'):
+    """compute the thermodynamic fields from plain arrays of P (hPa), T (degC)
+    and RH (fraction) or MR (kg/kg) in one pass, each shared term (vapor
+    pressure, mixing ratio, virtual factor, potential temperature) only once
+    and in place. fields can be MR (kg/kg), VP (hPa), Dewpt (degC), Rho
+    (g/m^3), Tv (K), PT (K), VPT (K), N and BVF2 (1/sec**2, needs Height in m
+    along axis). follows metpy, saturation is the saturation vapor pressure
+    of metpy<1.6 (bolton) or of later versions (ambaum), returns a dict"""
+    import numpy as np
+    # metpy's constants:
+    epsilon = 0.6219569100577033
+    Rd = 287.04749097718457
+    Rv = 461.52311572606084
+    Lv = 2500840.0
+    Cp_l = 4219.400000000001
+    Cp_v = 1860.078011865639
+    T0 = 273.16
+    kappa = 2 / 7
+    g = 9.80665
+    unknown = set(fields).difference(
+        ['MR', 'VP', 'Dewpt', 'Rho', 'Tv', 'PT', 'VPT', 'N', 'BVF2'])
+    if unknown:
+        raise KeyError('{} not supported by thermodynamics_kernel.'.format(
+            ', '.join(sorted(unknown))))
+    P = np.asarray(P, dtype=float)
+    T = np.asarray(T, dtype=float)
+    T_k = T + 273.15
+    humid = set(fields).intersection(
+        ['MR', 'VP', 'Dewpt', 'Rho', 'Tv', 'VPT', 'N'])
+    with np.errstate(all='ignore'):
+        if not humid:
+            pass
+        elif MR is not None:
+            w = np.asarray(MR, dtype=float)
+            e = w + epsilon
+            np.divide(w, e, out=e)
+            e *= P
+        elif RH is not None:
+            if saturation == 'bolton':
+                # Bolton (1980):
+                e = T + 243.5
+                np.divide(T, e, out=e)
+                e *= 17.67
+                np.exp(e, out=e)
+                e *= 6.112
+            elif saturation == 'ambaum':
+                # Ambaum (2020) eq. 13, in hPa:
+                e = (Lv - (Cp_l - Cp_v) * (T_k - T0)) / T_k
+                e -= Lv / T0
+                e /= -Rv
+                np.exp(e, out=e)
+                e *= 6.112 * (T0 / T_k)**((Cp_l - Cp_v) / Rv)
+            else:
+                raise KeyError('saturation should be bolton or ambaum')
+            e *= RH
+            w = P - e
+            np.divide(e, w, out=w)
+            w *= epsilon
+        else:
+            raise ValueError('either RH or MR is needed.')
+        out = {}
+        if 'MR' in fields:
+            out['MR'] = w
+        if 'VP' in fields:
+            out['VP'] = e
+        if 'Dewpt' in fields:
+            dew = e / 6.112
+            np.log(dew, out=dew)
+            out['Dewpt'] = 243.5 * dew / (17.67 - dew)
+        if set(fields).intersection(['Rho', 'Tv', 'VPT']):
+            # Tv / T = (w + epsilon) / (epsilon * (1 + w)):
+            virtual = w + epsilon
+            virtual /= w + 1
+            virtual /= epsilon
+        if 'Tv' in fields:
+            out['Tv'] = T_k * virtual
+        if 'Rho' in fields:
+            # P in Pa over Rd * Tv in kg/m^3, to g/m^3:
+            rho = P * (1e5 / Rd)
+            rho /= T_k
+            rho /= virtual
+            out['Rho'] = rho
+        if set(fields).intersection(['PT', 'VPT', 'BVF2']):
+            PT = 1000.0 / P
+            PT **= kappa
+            PT *= T_k
+            if 'PT' in fields:
+                out['PT'] = PT
+            if 'VPT' in fields:
+                out['VPT'] = PT * virtual
+            if 'BVF2' in fields:
+                if Height is None:
+                    raise ValueError('Height is needed for BVF2.')
+                H = np.broadcast_to(np.asarray(Height, dtype=float), PT.shape)
+                bvf2 = _first_derivative(PT, H, axis=axis)
+                bvf2 /= PT
+                bvf2 *= g
+                out['BVF2'] = bvf2
+        if 'N' in fields:
+            # 77.6 * P / T + 3.73e5 * e / T**2:
+            n = e * 3.73e5
+            n /= T_k
+            n += 77.6 * P
+            n /= T_k
+            out['N'] = n
+    return out
+
+
+def _values_in_units(da, name, to_unit, verbose=False):
+    """the values of da converted to to_unit by its units attr (assumed to_unit
+    if missing)"""
+    import numpy as np
+    factors = {'hPa': {'hPa': 1.0, 'mbar': 1.0, 'millibar': 1.0,
+                       'Pa': 0.01, 'kPa': 10.0},
+               'degC': {'degC': 0.0, 'K': -273.15, 'kelvin': -273.15},
+               'kg/kg': {'kg/kg': 1.0, 'g/kg': 0.001},
+               'm': {'m': 1.0, 'km': 1000.0}}
+    unit = da.attrs.get('units')
+    values = np.asarray(da.values, dtype=float)
+    if unit is None:
+        if verbose:
+            print('assuming {} units are {}...'.format(name, to_unit))
+        return values
+    if unit not in factors[to_unit]:
+        raise ValueError('{} units {} are not convertible to {}.'.format(
+            name, unit, to_unit))
+    factor = factors[to_unit][unit]
+    if to_unit == 'degC':
+        return values + factor if factor != 0.0 else values
+    return values * factor if factor != 1.0 else values
+
+
+def calculate_thermodynamics(P, T, RH=None, MR=None, Height=None,
+                             fields=['MR', 'VP', 'Rho', 'VPT'], dim='time',
+                             saturation='bolton', verbose=False):
+    """the xarray front of thermodynamics_kernel: checks and converts the
+    units of P, T, RH/MR and Height, and returns a dataset with the fields
+    named and attributed like the wrap_xr_metpy_* results. dim is the
+    vertical dim (only used for BVF2)"""
+    import numpy as np
+    import xarray as xr
+    das = [x for x in [P, T, RH, MR, Height] if x is not None]
+    das = xr.broadcast(*das)
+    dims = das[0].dims
+    if 'BVF2' in fields:
+        das = [x.transpose(*[y for y in dims if y != dim], dim) for x in das]
+    das = iter(das)
+    P = next(das)
+    T = next(das)
+    kwargs = {}
+    if RH is not None:
+        RH = next(das)
+        unit = RH.attrs.get('units')
+        if unit in ['%', 'percent']:
+            kwargs['RH'] = RH.values / 100.0
+        elif unit in ['dimensionless', '', 'fraction']:
+            kwargs['RH'] = RH.values
+        elif unit is None:
+            if verbose:
+                print('guessing relative humidity units from its maximum...')
+            if np.nanmax(RH.values) > 1.2:
+                kwargs['RH'] = RH.values / 100.0
+            else:
+                kwargs['RH'] = RH.values
+        else:
+            raise ValueError('RH units {} are not supported.'.format(unit))
+    if MR is not None:
+        kwargs['MR'] = _values_in_units(next(das), 'mixing ratio', 'kg/kg',
+                                        verbose)
+    if Height is not None:
+        kwargs['Height'] = _values_in_units(next(das), 'Height', 'm', verbose)
+    out = thermodynamics_kernel(_values_in_units(P, 'pressure', 'hPa', verbose),
+                                _values_in_units(T, 'temperature', 'degC',
+                                                 verbose),
+                                fields=fields, axis=-1,
+                                saturation=saturation, **kwargs)
+    attrs = {'MR': ('kg/kg', 'Water vapor mass mixing ratio'),
+             'VP': ('hPa', 'Water vapor partial pressure'),
+             'Dewpt': ('degC', 'Dew point'),
+             'Rho': ('g/m^3', 'Air density'),
+             'Tv': ('K', 'Virtual Temperature'),
+             'PT': ('K', 'Potential Temperature'),
+             'VPT': ('K', 'Virtual Potential Temperature'),
+             'N': ('dimensionless', 'Index of Refractivity'),
+             'BVF2': ('1/sec**2', 'Brunt-Vaisala Frequency squared')}
+    ds = xr.Dataset()
+    for field in fields:
+        da = P.copy(data=out[field])
+        da.name = field
+        da.attrs = {'units': attrs[field][0], 'long_name': attrs[field][1]}
+        ds[field] = da
+    return ds.transpose(*dims)
+
+
+def benchmark_thermodynamics_kernel(ds=None, path=sound_path, repeat=3):
+    """time and trace the memory of calculate_thermodynamics against the
+    chained metpy calls (units, pint and xarray per field, like the
+    wrap_xr_metpy_* functions) for MR, VP, Rho, VPT, PT, Dewpt and N of the
+    2-second radiosonde archive (ds or the saved file in path), and report
+    the max relative difference of each field"""
+    import time
+    import tracemalloc
+    import numpy as np
+    import xarray as xr
+    import metpy.calc as mpcalc
+    from metpy.units import units
+    from aux_gps import path_glob
+    if ds is None:
+        file = path_glob(path, 'bet_dagan_2s_sounding_*.nc')[-1]
+        ds = xr.load_dataset(file)
+    P = ds['P'].assign_attrs(units='hPa')
+    T = ds['T'].assign_attrs(units='degC')
+    RH = ds['RH'].assign_attrs(units='%')
+    fields = ['MR', 'VP', 'Rho', 'VPT', 'PT', 'Dewpt', 'N']
+
+    def chained():
+        p = P.values * units('hPa')
+        t = (T.values + 273.15) * units('K')
+        rh = RH.values / 100.0 * units('dimensionless')
+        dss = xr.Dataset()
+        mr = mpcalc.mixing_ratio_from_relative_humidity(
+            pressure=p, temperature=t, relative_humidity=rh).to('kg/kg')
+        dss['MR'] = P.copy(data=mr.magnitude)
+        mr = dss['MR'].values * units('kg/kg')
+        vp = mpcalc.vapor_pressure(p, mr).to('hPa')
+        dss['VP'] = P.copy(data=vp.magnitude)
+        rho = mpcalc.density(p, t, mr).to('g/m^3')
+        dss['Rho'] = P.copy(data=rho.magnitude)
+        vpt = mpcalc.virtual_potential_temperature(p, t, mr).to('K')
+        dss['VPT'] = P.copy(data=vpt.magnitude)
+        pt = mpcalc.potential_temperature(p, t).to('K')
+        dss['PT'] = P.copy(data=pt.magnitude)
+        dew = mpcalc.dewpoint_from_relative_humidity(t, rh).to('degC')
+        dss['Dewpt'] = P.copy(data=dew.magnitude)
+        t_k = T + 273.15
+        dss['N'] = 77.6 * P / t_k + 3.73e5 * dss['VP'] / t_k**2
+        return dss
+
+    # the saturation vapor pressure of the installed metpy:
+    es = mpcalc.saturation_vapor_pressure(233.15 * units('K')).m_as('hPa')
+    bolton = 6.112 * np.exp(17.67 * -40.0 / (-40.0 + 243.5))
+    saturation = 'bolton' if abs(es - bolton) < 1e-6 else 'ambaum'
+
+    def fused():
+        return calculate_thermodynamics(P, T, RH=RH, fields=fields,
+                                        saturation=saturation)
+
+    results = {'size': P.size}
+    for name, func in [('metpy', chained), ('fused', fused)]:
+        func()  # warm up (imports) before timing
+        tic = time.perf_counter()
+        for i in range(repeat):
+            func()
+        results['{}_seconds'.format(name)] = (time.perf_counter() - tic) / repeat
+        tracemalloc.start()
+        out = func()
+        results['{}_peak_MB'.format(name)] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        results[name] = out
+    ref = results.pop('metpy')
+    new = results.pop('fused')
+    # dew point relative to kelvin:
+    new['Dewpt'] += 273.15
+    ref['Dewpt'] += 273.15
+    for field in fields:
+        with np.errstate(all='ignore'):
+            rel = np.abs(new[field] - ref[field]) / np.abs(ref[field])
+        results['{}_max_rel_diff'.format(field)] = float(rel.max())
+    print('{} values: metpy {:.2f} s ({:.0f} MB), fused {:.2f} s ({:.0f} MB).'.format(
+        results['size'], results['metpy_seconds'], results['metpy_peak_MB'],
+        results['fused_seconds'], results['fused_peak_MB']))
+    print('max relative difference: ' + ', '.join(
+        '{} {:.1e}'.format(x, results['{}_max_rel_diff'.format(x)]) for x in fields))
+    return results
+
+
 class Constants:
     def __init__(self):
         import astropy.units as u
@@ -2299,112 +2973,85 @@ def read_one_deserve_record(filepath):
     return ds
 
 
+def _parse_EDT_header(lines):
+    """parse the meta data and the units table out of the first lines of an
+    EDT record"""
+    import pandas as pd
+    import numpy as np
+    meta = {}
+    # the labels are matched on the stripped lines, the raw lines are only
+    # kept for the fixed width units table:
+    for line in [x.strip() for x in lines[:44]]:
+        if line.startswith('Station:'):
+            meta['station'] = line.split()[1]
+        elif line.startswith('Launch time:'):
+            meta['launch_time'] = pd.to_datetime('T'.join(line.split()[2:4]))
+        elif line.startswith('RS type:'):
+            meta['RS_type'] = line.split()[-1]
+        elif line.startswith('RS number:'):
+            meta['RS_number'] = line.split()[-1]
+        elif line.startswith('Reason for termination:'):
+            meta['termination_reason'] = line.split()[-1]
+    # the units table is fixed width (16, 16, 23, 9, 9) from line 22, the
+    # last 3 rows are not records:
+    table = [x for x in lines[22:] if x.strip()][:19][:-3]
+    units_dict = {}
+    for row in table:
+        name = row[:16].strip()
+        unit = row[16:32].strip()
+        units_dict[name] = unit if unit else np.nan
+    units_dict.pop('Pscl')
+    return meta, units_dict
+
+
 def read_one_EDT_record(filepath, year=None):
+    """read one 2-second EDT record, the file is read once, the header is
+    parsed from its lines and the data table in one vectorized read. all the
+    variables are interpolated to 1 second together (cubic)"""
     import pandas as pd
     import numpy as np
     import xarray as xr
-#    from aux_gps import get_unique_index
-    from aux_gps import remove_duplicate_spaces_in_string
-    from scipy.integrate import cumtrapz
+    import io
+    from scipy.interpolate import interp1d
     with open(filepath) as f:
-        content = f.readlines()
-    content = [x.strip() for x in content]
-    meta = {}
-    for i, line in enumerate(content):
-        if line.startswith('Station:'):
-            line = remove_duplicate_spaces_in_string(line)
-            meta['station'] = line.split(' ')[1]
-        if line.startswith('Launch time:'):
-            line = remove_duplicate_spaces_in_string(line)
-            dt = 'T'.join(line.split(' ')[2:4])
-            meta['launch_time'] = pd.to_datetime(dt)
-        if line.startswith('RS type:'):
-            line = remove_duplicate_spaces_in_string(line)
-            rs_type = line.split(' ' )[-1]
-            meta['RS_type'] = rs_type
-        if line.startswith('RS number:'):
-            line = remove_duplicate_spaces_in_string(line)
-            rs_num = line.split(' ' )[-1]
-            meta['RS_number'] = rs_num
-        if line.startswith('Reason for termination:'):
-            line = remove_duplicate_spaces_in_string(line)
-            termination = line.split(' ' )[-1]
-            meta['termination_reason'] = termination
-        if line.startswith('Record name:'):
-            meta_header = remove_duplicate_spaces_in_string(line)
-            meta_header = meta_header.split(': ')
-            meta_header[-1] = meta_header[-1].split(':')[0]
-        if i >42:
-            break
+        lines = f.read().splitlines()
+    meta, units_dict = _parse_EDT_header(lines)
     sound_time = check_sound_time_datetime(meta['launch_time'])
     # select only one year:
     if year is not None:
         if sound_time.year != year:
             return None
-    # read units table:        global mixratio, rho, rho_wv, height, press, g
-
-    table = pd.read_fwf(
-        filepath,
-        skiprows=22,
-        nrows=19,
-        header=None,
-        widths=[16, 16, 23, 9, 9])
-    table.columns = meta_header
-    # drop 3 last rows:
-    table = table.iloc[:-3, :]
-    # units dict:
-    units_dict = dict(zip(table['Record name'], table['Unit']))
-    units_dict.pop('Pscl')
     # read all data:
-    data = pd.read_csv(
-        filepath,
-        delim_whitespace=True,
-        skiprows=44,
-        na_values=-32768)
+    data = pd.read_csv(io.StringIO('\n'.join(lines[44:])), sep=r'\s+',
+                       na_values=-32768)
     # drop 3 last cols:
     data = data.iloc[:, :-3]
     data = data.drop('Pscl', axis=1)
-    # datetime index:
-    # Time = data['time'].copy(deep=True)
-    data['time'] = pd.to_timedelta(data['time'], errors='coerce', unit='sec')
-#    data['time'] += meta['launch_time']
-    data['time'] = data['time'].dt.total_seconds()
-    data.set_index('time', inplace=True)
-#    sound_time = check_sound_time(data)
-#    # now index as height:
-#    data.set_index('Height', inplace=True)
-    # data['Time'] = Time
-    data = data.astype('float')
-    data.index = data.index.astype('float')
-    # to xarray:
-    ds = data.to_xarray()
-#    return ds
-#    ds = ds.dropna('Height')
-    ds = ds.sortby('time')
-#    ds = get_unique_index(ds, 'Height')
-    # interpolate:
-    new_time = np.arange(0, float(int(ds.time.max())))
-#    ds = ds.interpolate_na(
-#        'time',
-#        method='linear',
-#        max_gap=3,
-#        fill_value='extrapolate')
-#    ds = ds.interp(coords={'time': new_time}, method='cubic')
-    ds_list = []
-    for da in ds.data_vars.values():
-        # dropna in all vars:
-        dropped = da.dropna('time')
-        # if some data remain, interpolate:
-        if dropped.size > 0:
-            interpolated = dropped.interp(coords={'time': new_time}, method='cubic',
-                                          kwargs={'fill_value': np.nan})
-            ds_list.append(interpolated)
-        # if nothing left, create new ones with nans:
-        else:
-            nan_da = np.nan * ds['time']
-            nan_da.name = dropped.name
-            ds_list.append(dropped)
-    ds = xr.merge(ds_list)
+    time = pd.to_timedelta(data.pop('time'), errors='coerce', unit='sec')
+    time = time.dt.total_seconds().values.astype(float)
+    values = data.values.astype(float)
+    # sort by time:
+    order = np.argsort(time, kind='stable')
+    time = time[order]
+    values = values[order]
+    new_time = np.arange(0, float(int(np.nanmax(time))))
+    interpolated = np.full((new_time.size, values.shape[1]), np.nan)
+    # interpolate all the columns that share the same valid rows at once:
+    valid = ~np.isnan(values) & ~np.isnan(time)[:, None]
+    groups = {}
+    for j in range(valid.shape[1]):
+        groups.setdefault(valid[:, j].tobytes(), []).append(j)
+    for cols in groups.values():
+        rows = valid[:, cols[0]]
+        if rows.sum() == 0:
+            continue
+        f = interp1d(time[rows], values[np.ix_(rows, cols)], axis=0,
+                     kind='cubic', fill_value=np.nan, bounds_error=False,
+                     assume_sorted=True, copy=False)
+        interpolated[:, cols] = f(new_time)
+    ds = xr.Dataset({name: ('time', interpolated[:, j])
+                     for j, name in enumerate(data.columns)},
+                    coords={'time': new_time})
     ds['Height'].attrs['units'] = 'm'
 #    ds['time'].attrs['units'] = 'sec'
     ds.attrs['station'] = meta['station']
@@ -2473,123 +3120,253 @@ def read_one_EDT_record(filepath, year=None):
     return ds
 
 
-def transform_model_levels_to_pressure(path, field_da, plevel=85.0, mm=True):
-    """takes a field_da (like t, u) that uses era5 L137 model levels and
-    interpolates it using pf(only monthly means) to desired plevel"""
-    # TODO: do scipy.interpolate instead of np.interp (linear)
-    # TODO: add multiple plevel support
+def interpolate_columns_to_pressure(values, pressures, plevels, log=False):
+    """interpolate values (..., level) at pressures (..., level, or just
+    level) to the plevels in one vectorized pass over all the columns,
+    log=True interpolates linearly in log-pressure. outside the columns the
+    edge values are used (like np.interp). returns (..., plevel)"""
+    import numpy as np
+    values = np.asarray(values, dtype=float)
+    pressures = np.broadcast_to(np.asarray(pressures, dtype=float), values.shape)
+    plevels = np.atleast_1d(np.asarray(plevels, dtype=float))
+    shape = values.shape[:-1]
+    nlev = values.shape[-1]
+    vals = values.reshape(-1, nlev)
+    p = pressures.reshape(-1, nlev)
+    # make the pressure increase along the level axis:
+    if p.size and p[0, 0] > p[0, -1]:
+        vals = vals[:, ::-1]
+        p = p[:, ::-1]
+    if log:
+        p = np.log(p)
+        plevels = np.log(plevels)
+    rows = np.arange(vals.shape[0])
+    out = np.empty((vals.shape[0], plevels.size), dtype=float)
+    for i, plevel in enumerate(plevels):
+        # upper bracketing level of each column:
+        k = np.clip((p < plevel).sum(axis=1), 1, nlev - 1)
+        p0 = p[rows, k - 1]
+        p1 = p[rows, k]
+        w = np.clip((plevel - p0) / (p1 - p0), 0, 1)
+        out[:, i] = vals[rows, k - 1] + w * (vals[rows, k] - vals[rows, k - 1])
+    return out.reshape(shape + (plevels.size, ))
+
+
+def interpolate_da_to_pressure_levels(field_da, pf_da, plevels,
+                                      method='linear', level_dim='level'):
+    """interpolate field_da on model levels to the plevels (same units as
+    pf_da) with method 'linear' or 'log' (pressure), works chunk by chunk
+    if field_da and/or pf_da are dask backed. returns the field with a
+    plevel dim"""
     import xarray as xr
+    import numpy as np
+    plevels = np.atleast_1d(np.asarray(plevels, dtype=float))
+    if field_da.chunks is not None:
+        field_da = field_da.chunk({level_dim: -1})
+    if pf_da.chunks is not None:
+        pf_da = pf_da.chunk({level_dim: -1})
+    da = xr.apply_ufunc(interpolate_columns_to_pressure, field_da, pf_da,
+                        input_core_dims=[[level_dim], [level_dim]],
+                        output_core_dims=[['plevel']],
+                        kwargs=dict(plevels=plevels, log=method == 'log'),
+                        dask='parallelized', output_dtypes=[field_da.dtype],
+                        dask_gufunc_kwargs={'output_sizes': {'plevel': plevels.size}})
+    da['plevel'] = plevels
+    da.name = field_da.name
+    da.attrs = field_da.attrs
+    return da
+
+
+def transform_model_levels_to_pressure(path, field_da, plevel=85.0, mm=True,
+                                       method='linear', pf=None):
+    """takes a field_da (like t, u) that uses era5 L137 model levels and
+    interpolates it using pf(only monthly means) to desired plevel(s), method
+    is 'linear' or 'log' (pressure). open field_da with dask chunks to work
+    out of core"""
     from aux_functions_strat import dim_intersection
     import numpy as np
-    if mm:
-        pf = xr.open_dataset(path / 'era5_full_pressure_mm_1979-2018.nc')
-    pf = pf.pf
+    if pf is None and mm:
+        # pf is made per chunk from the surface pressure, no need for a file:
+        pf = open_era5_model_levels_pressure(path, kind='pf', units='hPa')
     levels = dim_intersection([pf, field_da], dropna=False, dim='level')
     pf = pf.sel(level=levels)
     field_da = field_da.sel(level=levels)
-    field_da = field_da.transpose('time', 'latitude', 'longitude', 'level')
-    field = field_da.values
-    da = np.zeros((pf.time.size, pf.latitude.size, pf.longitude.size, 1),
-                  'float32')
-    pf = pf.values
-    for t in range(pf.shape[0]):
-        print(t)
-        for lat in range(pf.shape[1]):
-            for lon in range(pf.shape[2]):
-                pressures = pf[t, lat, lon, :]
-                vals = field[t, lat, lon, :]
-                da[t, lat, lon, 0] = np.interp(plevel, pressures, vals)
-    da = xr.DataArray(da, dims=['time', 'lat', 'lon', 'level'])
-    da['level'] = [plevel]
-    da['time'] = field_da['time']
+    plevels = np.atleast_1d(plevel).astype(float)
+    da = interpolate_da_to_pressure_levels(field_da, pf, plevels,
+                                           method=method)
+    da = da.drop_vars('level', errors='ignore').rename({'plevel': 'level'})
+    da = da.rename({'latitude': 'lat', 'longitude': 'lon'})
+    da = da.transpose('time', 'lat', 'lon', 'level').astype('float32')
     da['level'].attrs['long_name'] = 'pressure_level'
     da['level'].attrs['units'] = 'hPa'
-    da['lat'] = field_da['latitude'].values
-    da['lat'].attrs = field_da['latitude'].attrs
-    da['lon'] = field_da['longitude'].values
-    da['lon'].attrs = field_da['longitude'].attrs
     da.name = field_da.name
     da.attrs = field_da.attrs
     da = da.sortby('lat')
     comp = dict(zlib=True, complevel=9)  # best compression
     encoding = {var: comp for var in da.to_dataset(name=da.name).data_vars}
-    filename = 'era5_' + da.name + '_' + str(int(plevel)) + 'hPa.nc'
+    plevel_str = '_'.join([str(int(x)) for x in plevels])
+    filename = 'era5_' + da.name + '_' + plevel_str + 'hPa.nc'
     da.to_netcdf(path / filename, encoding=encoding)
     return da
 
 
-def create_model_levels_map_from_surface_pressure(work_path):
+def create_model_levels_map_from_surface_pressure(work_path, save=True):
+    """build the full pressure (hPa) on the L137 model levels from the
+    monthly mean surface pressure. the pressure is computed lazily by
+    open_era5_model_levels_pressure, so consumers can use that directly and
+    skip saving the (~2.9GB) file"""
+    pf_ds = open_era5_model_levels_pressure(work_path, kind='pf',
+                                            units='hPa').to_dataset(name='pf')
+    pf_ds = pf_ds.transpose('time', 'latitude', 'longitude', 'level')
+    if save:
+        comp = dict(zlib=True, complevel=9)  # best compression
+        encoding = {var: comp for var in pf_ds.data_vars}
+        pf_ds.to_netcdf(work_path / 'era5_full_pressure_mm_1979-2018.nc',
+                        encoding=encoding)
+    return pf_ds
+
+
+def era5_column_integrals_kernel(p, q=None, t=None, g=9.79,
+                                 fields=('PW', 'Tm')):
+    """the fused numpy kernel of calculate_era5_column_integrals, p (Pa), q
+    (kg/kg) and t (K) are (..., level) arrays of a chunk, all the fields are
+    summed over the level pairs in one pass. returns (..., field)"""
     import numpy as np
+    dp = np.abs(p[..., 1:] - p[..., :-1])
+    out = []
+    for field in fields:
+        if field == 'PW':
+            qsum = q[..., 1:] + q[..., :-1]
+            out.append(np.nansum(qsum * dp, axis=-1) / (g * 2 * 1000) * 1000.0)
+        elif field == 'Tm':
+            wv = VaporPressure(t - 273.15, method='Buck', units='Pa')
+            rho = DensHumid(t - 273.15, p / 100.0, wv / 100.0, out='both')
+            w = (wv[..., 1:] + wv[..., :-1]) * dp / ((rho[..., 1:] + rho[..., :-1]) * g * 2)
+            nume = np.nansum(w / (t[..., 1:] + t[..., :-1]), axis=-1)
+            denom = np.nansum(w / (t[..., 1:]**2.0 + t[..., :-1]**2.0), axis=-1)
+            out.append(nume / denom)
+        else:
+            raise KeyError('{} is not a supported column integral.'.format(field))
+    return np.stack(out, axis=-1)
+
+
+def calculate_era5_column_integrals(pf_ml, q_ml=None, t_ml=None, g=9.79,
+                                    fields=['PW', 'Tm'], level_dim='level'):
+    """compute the PW (mm) and/or Tm (K) column integrals from era5 model
+    levels pressure (pf_ml), specific humidity (q_ml) and temperature (t_ml)
+    in one fused pass, chunk by chunk if the inputs are dask backed so that
+    the peak memory is about one chunk. returns a dataset of the fields"""
     import xarray as xr
-    """takes ~24 mins for monthly mean with 1.25x1.25 degree for full 137
-    levels,~=2.9GB file. Don't try with higher sample rate"""
-    ds = read_L137_to_ds(work_path)
-    a = ds.a.values
-    b = ds.b.values
-    n = ds.n.values
-    sp = xr.open_dataset(work_path / 'era5_SP_mm_1979-2018.nc')
-    sp = sp.sp / 100.0
-    pf = np.zeros((sp.time.size, sp.latitude.size, sp.longitude.size, len(a)),
-                  'float32')
-    sp_np = sp.values
-    for t in range(sp.time.size):
-        print(t)
-        for lat in range(sp.latitude.size):
-            for lon in range(sp.longitude.size):
-                ps = sp_np[t, lat, lon]
-                pf[t, lat, lon, :] = pressure_from_ab(ps, a, b, n)
-    pf_da = xr.DataArray(pf, dims=['time', 'latitude', 'longitude', 'level'])
-    pf_da.attrs['units'] = 'hPa'
-    pf_da.attrs['long_name'] = 'full_pressure_level'
-    pf_ds = pf_da.to_dataset(name='pf')
-    pf_ds['level'] = n
-    pf_ds['level'].attrs['long_name'] = 'model_level_number'
-    pf_ds['latitude'] = sp.latitude
-    pf_ds['latitude'].attrs = sp.latitude.attrs
-    pf_ds['longitude'] = sp.longitude
-    pf_ds['longitude'].attrs = sp.longitude.attrs
-    pf_ds['time'] = sp.time
-    comp = dict(zlib=True, complevel=9)  # best compression
-    encoding = {var: comp for var in pf_ds.data_vars}
-    pf_ds.to_netcdf(work_path / 'era5_full_pressure_mm_1979-2018.nc',
-                    encoding=encoding)
-    return pf_ds
+    assert pf_ml.attrs['units'] == 'Pa'
+    if 'PW' in fields:
+        assert q_ml.attrs['units'] == 'kg kg**-1'
+    if 'Tm' in fields:
+        assert t_ml.attrs['units'] == 'K'
+    inputs = [(n, x) for n, x in zip(['p', 'q', 't'], [pf_ml, q_ml, t_ml])
+              if x is not None]
+    names = [n for n, x in inputs]
+    das = [x.chunk({level_dim: -1}) if x.chunks is not None else x
+           for n, x in inputs]
+
+    def kernel(*arrays):
+        return era5_column_integrals_kernel(g=g, fields=fields,
+                                            **dict(zip(names, arrays)))
+
+    da = xr.apply_ufunc(kernel, *das,
+                        input_core_dims=[[level_dim]] * len(das),
+                        output_core_dims=[['field']],
+                        dask='parallelized', output_dtypes=[float],
+                        dask_gufunc_kwargs={'output_sizes': {'field': len(fields)}})
+    da['field'] = fields
+    ds = da.to_dataset('field')
+    ds.attrs = {}
+    if 'PW' in fields:
+        ds['PW'].attrs['units'] = 'mm'
+    if 'Tm' in fields:
+        ds['Tm'].attrs['units'] = 'K'
+    return ds
 
 
 def calculate_era5_tm(q_ml, t_ml, pf_ml, g=9.79):
     """given pressure in model levels(ps_ml) and specific humidity(q_ml)
     in era5 model levels and temperature, compute the tm for each lat/lon grid point."""
-    assert t_ml.attrs['units'] == 'K'
     assert q_ml.attrs['units'] == 'kg kg**-1'
-    assert pf_ml.attrs['units'] == 'Pa'
-    factor = g * 2   # g in mks
-    WVpress = VaporPressure(t_ml - 273.15, method='Buck', units='Pa')
-    wvpress = WVpress + WVpress.shift(level=1)
-    t = t_ml + t_ml.shift(level=1)
-    t2 = t_ml**2.0 + t_ml.shift(level=1)**2.0
-    Rho = DensHumid(t_ml - 273.15, pf_ml / 100.0, WVpress / 100.0, out='both')
-    rho = Rho + Rho.shift(level=1)
-    nume = ((wvpress * pf_ml.diff('level')) / (t * rho * factor)).sum('level')
-    denom = ((wvpress * pf_ml.diff('level')) / (t2 * rho * factor)).sum('level')
-    tm = nume / denom
+    tm = calculate_era5_column_integrals(pf_ml, t_ml=t_ml, g=g,
+                                         fields=['Tm'])['Tm']
     tm.name = 'Tm'
-    tm.attrs['units'] = 'K'
     return tm
 
 
 def calculate_era5_pw(q_ml, pf_ml, g=9.79):
     """given pressure in model levels(ps_ml) and specific humidity(q_ml)
     in era5 model levels, compute the IWV for each lat/lon grid point."""
-    assert q_ml.attrs['units'] == 'kg kg**-1'
-    assert pf_ml.attrs['units'] == 'Pa'
-    factor = g * 2 * 1000  # density of water in mks, g in mks
-    pw = (((q_ml + q_ml.shift(level=1)) * pf_ml.diff('level')) / factor).sum('level')
-    pw = pw * 1000.0
+    pw = calculate_era5_column_integrals(pf_ml, q_ml=q_ml, g=g,
+                                         fields=['PW'])['PW']
     pw.name = 'PW'
-    pw.attrs['units'] = 'mm'
     return pw
 
 
+def get_L137_coeffs(ds_l137, kind='pf'):
+    """return the a (Pa) and b coeffs of the L137 half levels (kind='ph',
+    n=0..137) or of the full levels (kind='pf', level=1..137), so that
+    p = a + b * ps"""
+    import xarray as xr
+    a = ds_l137['a'].values
+    b = ds_l137['b'].values
+    n = ds_l137['n'].values
+    if kind == 'ph':
+        dim = 'n'
+    elif kind == 'pf':
+        # pf(k) = 1/2*(ph(k-1/2) + ph(k+1/2)) is also linear in ps:
+        a = 0.5 * (a[1:] + a[:-1])
+        b = 0.5 * (b[1:] + b[:-1])
+        n = n[1:]
+        dim = 'level'
+    else:
+        raise KeyError('kind should be pf or ph')
+    a = xr.DataArray(a, dims=[dim], coords={dim: n})
+    b = xr.DataArray(b, dims=[dim], coords={dim: n})
+    return a, b
+
+
+def pressure_from_surface_pressure(ps_da, ds_l137, kind='pf', levels=None,
+                                   units='Pa'):
+    """the L137 full (pf) or half (ph) level pressure from the surface
+    pressure ps_da (Pa or hPa by its units attr, Pa if missing). only the
+    requested levels are made and, if ps_da is dask backed, nothing is
+    computed until the consumer asks for a chunk"""
+    a, b = get_L137_coeffs(ds_l137, kind=kind)
+    dim = a.dims[0]
+    if levels is not None:
+        a = a.sel({dim: levels})
+        b = b.sel({dim: levels})
+    ps_unit = ps_da.attrs.get('units', 'Pa')
+    ps = ps_da * 100.0 if ps_unit == 'hPa' else ps_da
+    p = a + b * ps
+    if units == 'hPa':
+        p = p / 100.0
+    p.name = 'pressure'
+    p.attrs['units'] = units
+    if kind == 'pf':
+        p.attrs['long_name'] = 'full_pressure_level'
+    else:
+        p.attrs['long_name'] = 'half_pressure_level'
+    p[dim].attrs['long_name'] = 'model_level_number'
+    return p
+
+
+def open_era5_model_levels_pressure(path, sp_file='era5_SP_mm_1979-2018.nc',
+                                    kind='pf', levels=None, units='hPa',
+                                    chunks={'time': 12}):
+    """a lazy provider of the era5 L137 pf/ph pressure from the surface
+    pressure file and the L137 table (both in path), computed per chunk"""
+    import xarray as xr
+    ds_l137 = read_L137_to_ds(path)
+    sp = xr.open_dataset(path / sp_file, chunks=chunks)['sp']
+    return pressure_from_surface_pressure(sp, ds_l137, kind=kind,
+                                          levels=levels, units=units)
+
+
 def pressure_from_ab(ps_da, ds_l137):
     """takes the surface pressure(hPa) and  a, b coeffs from L137(n) era5
     table and produces the pressure level point in hPa"""
@@ -2598,15 +3375,8 @@ def pressure_from_ab(ps_da, ds_l137):
     except AttributeError:
         # assume Pascals in ps
         unit = 'Pa'
-    a = ds_l137.a
-    b = ds_l137.b
-    if unit == 'Pa':
-        ph = a + b * ps_da
-    pf_da = 0.5 * (ph + ph.shift(n=1))
-    pf_da.name = 'pressure'
-    pf_da.attrs['units'] = unit
-    pf_da = pf_da.dropna('n')
-    pf_da = pf_da.rename({'n': 'level'})
+    pf_da = pressure_from_surface_pressure(ps_da, ds_l137, kind='pf',
+                                           units=unit)
     return pf_da
 
 
@@ -2699,24 +3469,35 @@ def merge_concat_era5_field(path=era5_path, field='Q', savepath=None):
     return ds
 
 
+def _pairs_trapz(f, x):
+    """trapezoid sum of f over the last axis at x, NaN pairs are skipped"""
+    import numpy as np
+    dx = x[..., 1:] - x[..., :-1]
+    return np.nansum(0.5 * (f[..., 1:] + f[..., :-1]) * dx, axis=-1)
+
+
 def calculate_PW_from_era5(path=era5_path, glob_str='era5_Q_israel*.nc',
-                           water_density=1000.0, savepath=None):
+                           water_density=1000.0, savepath=None,
+                           chunks={'time': 24}):
+    """PW from era5 Q on pressure levels, integrated chunk by chunk"""
     import xarray as xr
     from aux_gps import path_glob
     from aux_gps import calculate_g
     import numpy as np
     file = path_glob(path, glob_str)[0]
-    Q = xr.open_dataset(file)['q']
+    Q = xr.open_dataset(file, chunks=chunks)['q'].chunk({'level': -1})
     g = calculate_g(Q.lat)
     g.name = 'g'
-    g = g.mean('lat')
-    plevel_in_pa = Q.level * 100.0
-    # P_{i+1} - P_i:
-    plevel_diff = np.abs(plevel_in_pa.diff('level'))
-    # Q_i + Q_{i+1}:
-    Q_sum = Q.shift(level=-1) + Q
-    pw_in_mm = ((Q_sum * plevel_diff) /
-                (2.0 * water_density * g)).sum('level') * 1000.0
+    g = g.mean('lat').item()
+    plevel_in_pa = Q.level.values * 100.0
+
+    def kernel(q):
+        # sum_i |P_{i+1} - P_i| * (Q_i + Q_{i+1}) / 2:
+        return np.abs(_pairs_trapz(q, plevel_in_pa))
+
+    pw_in_mm = xr.apply_ufunc(kernel, Q, input_core_dims=[['level']],
+                              dask='parallelized', output_dtypes=[float])
+    pw_in_mm = pw_in_mm / (water_density * g) * 1000.0
     pw_in_mm.name = 'pw'
     pw_in_mm.attrs['units'] = 'mm'
     if savepath is not None:
@@ -2732,20 +3513,27 @@ def calculate_PW_from_era5(path=era5_path, glob_str='era5_Q_israel*.nc',
 
 
 def calculate_Tm_from_era5(path=era5_path, Tfile='era5_T_israel*.nc',
-                           RHfile='era5_RH_israel*.nc', savepath=None):
+                           RHfile='era5_RH_israel*.nc', savepath=None,
+                           chunks={'time': 24}):
+    """Tm from era5 T and RH on pressure levels, both integrals are fused
+    and done chunk by chunk"""
     import xarray as xr
     from aux_gps import path_glob
-    tfile = path_glob(path, Tfile)
-    rhfile = path_glob(path, RHfile)
-    T = xr.open_dataarray(tfile)
-    RH = xr.open_dataarray(rhfile)
-    Dewpt = dewpoint_rh(T, RH)
-    WVpress = VaporPressure(Dewpt, units='hPa', method='Buck')
-    nom = WVpress / T
-    nom = nom.integrate('level')
-    denom = WVpress / T ** 2.0
-    denom = denom.integrate('level')
-    Tm = nom / denom
+    tfile = path_glob(path, Tfile)[0]
+    rhfile = path_glob(path, RHfile)[0]
+    T = xr.open_dataarray(tfile, chunks=chunks).chunk({'level': -1})
+    RH = xr.open_dataarray(rhfile, chunks=chunks).chunk({'level': -1})
+    levels = T.level.values
+
+    def kernel(t, rh):
+        Dewpt = dewpoint_rh(t, rh)
+        WVpress = VaporPressure(Dewpt, units='hPa', method='Buck')
+        nom = _pairs_trapz(WVpress / t, levels)
+        denom = _pairs_trapz(WVpress / t ** 2.0, levels)
+        return nom / denom
+
+    Tm = xr.apply_ufunc(kernel, T, RH, input_core_dims=[['level'], ['level']],
+                        dask='parallelized', output_dtypes=[float])
     Tm.name = 'Tm'
     Tm.attrs['units'] = 'K'
     if savepath is not None:
@@ -2942,17 +3730,59 @@ def move_bet_dagan_physical_to_main_path(bet_dagan_path):
     return year_dirs
 
 
+def _radiosonde_filename_date(path_file, data_type):
+    """the sounding time from the report filename"""
+    import pandas as pd
+    name = path_file.as_posix().split('/')[-1]
+    if data_type == 'phys':
+        date_ff = name.split('_')[-1]
+    else:
+        date_ff = name.split('_')[0]
+    return pd.to_datetime(date_ff, format='%Y%m%d%H')
+
+
+def _parse_one_radiosonde_report(path_file, data_type):
+    """parse one report, returns (ds, None) or (None, reason) so that a bad
+    report can be quarantined instead of aborting the whole run"""
+    import pandas as pd
+    try:
+        date_ff = _radiosonde_filename_date(path_file, data_type)
+        if data_type == 'phys':
+            ds = read_one_physical_radiosonde_report(path_file)
+        elif data_type == 'edt':
+            ds = read_one_EDT_record(path_file)
+        elif data_type == 'PTU' or data_type == 'Wind':
+            ds = read_one_PTU_Wind_levels_radiosonde_report(path_file)
+    except Exception as e:
+        return None, 'failed to parse: {}'.format(e)
+    if ds is None:
+        return None, 'corrupted'
+    date = pd.to_datetime(ds['sound_time'].item())
+    if date != date_ff:
+        return None, 'date from filename : {}, date from report: {}'.format(date_ff, date)
+    return ds, None
+
+
 def read_all_radiosonde_data(path, savepath=None, data_type='phys',
-                             verbose=True, year=None):
-    """use year for edt,then concat, otherwise it collapses"""
+                             verbose=True, year=None, n_jobs=4,
+                             cache_path=None):
+    """use year for edt,then concat, otherwise it collapses.
+    year selects the reports by the date in their filename before parsing.
+    reports are parsed with n_jobs processes and each one is cached (in
+    cache_path, default path/radiosonde_cache/data_type) by its mtime and
+    size, so only new or modified reports are parsed, whatever the year.
+    bad reports are quarantined (see quarantine.csv in cache_path) and
+    skipped, and the yearly concatenations are only redone for years that
+    changed"""
     from aux_gps import path_glob
 #    from aux_gps import get_unique_index
     from aux_gps import keep_iqr
+    from concurrent.futures import ProcessPoolExecutor
     import xarray as xr
     import pandas as pd
+    import joblib
+    import os
     from aux_gps import save_ncfile
-    ds_list = []
-    cnt = 0
     if data_type == 'phys':
         glob = '*/'
     elif data_type == 'edt':
@@ -2961,34 +3791,95 @@ def read_all_radiosonde_data(path, savepath=None, data_type='phys',
         glob = '*PTULevels'
     elif data_type == 'Wind':
         glob = '*WindLevels'
-    for path_file in sorted(path_glob(path, glob)):
-        cnt += 1
-        if path_file.is_file():
-            if data_type == 'phys':
-                date_ff = path_file.as_posix().split('/')[-1].split('_')[-1]
-                date_ff = pd.to_datetime(date_ff, format='%Y%m%d%H')
-                ds = read_one_physical_radiosonde_report(path_file)
-            elif data_type == 'edt':
-                date_ff = path_file.as_posix().split('/')[-1].split('_')[0]
-                date_ff = pd.to_datetime(date_ff, format='%Y%m%d%H')
-                ds = read_one_EDT_record(path_file, year=year)
-            elif data_type == 'PTU' or data_type == 'Wind':
-                date_ff = path_file.as_posix().split('/')[-1].split('_')[0]
-                date_ff = pd.to_datetime(date_ff, format='%Y%m%d%H')
-                ds = read_one_PTU_Wind_levels_radiosonde_report(path_file)
-            if ds is None:
-                print('{} is corrupted or skipped...'.format(
-                    path_file.as_posix().split('/')[-1]))
-                continue
+    if cache_path is None:
+        cache_path = path / 'radiosonde_cache' / data_type
+    cache_path.mkdir(parents=True, exist_ok=True)
+    index_file = cache_path / 'index.pkl'
+    index = joblib.load(index_file) if index_file.is_file() else {}
+    files = [x for x in sorted(path_glob(path, glob)) if x.is_file()]
+    # find the reports that are new or modified (or gone):
+    current = {}
+    to_parse = []
+    changed_years = set()
+    for path_file in files:
+        name = path_file.as_posix().split('/')[-1]
+        st = os.stat(path_file)
+        key = (st.st_mtime_ns, st.st_size)
+        entry = index.get(name)
+        if entry is not None and entry['key'] == key:
+            current[name] = entry
+            continue
+        try:
+            yr = _radiosonde_filename_date(path_file, data_type).year
+        except ValueError as e:
+            current[name] = dict(key=key, year=None, status='quarantined',
+                                 reason='bad filename: {}'.format(e))
+            continue
+        # other years are left as they are until they are asked for:
+        if year is not None and yr != year:
+            if entry is not None:
+                current[name] = entry
+            continue
+        current[name] = dict(key=key, year=yr, status='pending', reason='')
+        to_parse.append(path_file)
+        changed_years.add(yr)
+        if entry is not None and entry['year'] is not None:
+            changed_years.add(entry['year'])
+    for name in set(index) - set(current):
+        if index[name]['year'] is not None:
+            changed_years.add(index[name]['year'])
+        (cache_path / '{}.pkl'.format(name)).unlink(missing_ok=True)
+    print('{} {} reports, parsing {} new or modified.'.format(len(files), data_type, len(to_parse)))
+
+    def store(path_file, result):
+        name = path_file.as_posix().split('/')[-1]
+        ds, reason = result
+        if ds is None:
+            current[name].update(status='quarantined', reason=reason)
+            print('{} quarantined: {}'.format(name, reason))
+            (cache_path / '{}.pkl'.format(name)).unlink(missing_ok=True)
+            return
+        if verbose:
             date = pd.to_datetime(ds['sound_time'].item())
-            if verbose:
-                print('reading {} {} radiosonde report'.format(date.strftime('%Y-%m-%d %H:%M'), data_type))
-            try:
-                assert date == date_ff
-            except AssertionError:
-                print('date from filename : {}, date from report: {}'.format(date_ff, date))
-                return -1
-            ds_list.append(ds)
+            print('reading {} {} radiosonde report'.format(date.strftime('%Y-%m-%d %H:%M'), data_type))
+        joblib.dump(ds, cache_path / '{}.pkl'.format(name))
+        current[name].update(status='ok', reason='')
+
+    if n_jobs > 1 and len(to_parse) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = executor.map(_parse_one_radiosonde_report, to_parse,
+                                   [data_type] * len(to_parse), chunksize=8)
+            for path_file, result in zip(to_parse, results):
+                store(path_file, result)
+    else:
+        for path_file in to_parse:
+            store(path_file, _parse_one_radiosonde_report(path_file, data_type))
+    joblib.dump(current, index_file)
+    quarantined = {k: v for k, v in current.items() if v['status'] == 'quarantined'}
+    qdf = pd.DataFrame([(k, v['reason']) for k, v in sorted(quarantined.items())],
+                       columns=['report', 'reason'])
+    qdf.to_csv(cache_path / 'quarantine.csv', index=False)
+    if quarantined:
+        print('{} reports are quarantined, see {}.'.format(len(quarantined), cache_path / 'quarantine.csv'))
+    # concat the reports by year, only the changed years are redone:
+    years = sorted(set([v['year'] for v in current.values() if v['status'] == 'ok']))
+    if year is not None:
+        years = [x for x in years if x == year]
+    ds_list = []
+    for yr in years:
+        year_file = cache_path / 'year_{}.pkl'.format(yr)
+        if yr not in changed_years and year_file.is_file():
+            ds_list.append(joblib.load(year_file))
+            continue
+        names = sorted([k for k, v in current.items() if v['status'] == 'ok'
+                        and v['year'] == yr])
+        yds = xr.concat([joblib.load(cache_path / '{}.pkl'.format(x))
+                         for x in names], 'sound_time')
+        print('concatenated {} reports of {}.'.format(len(names), yr))
+        joblib.dump(yds, year_file)
+        ds_list.append(yds)
+    for yr in changed_years - set(years):
+        (cache_path / 'year_{}.pkl'.format(yr)).unlink(missing_ok=True)
     dss = xr.concat(ds_list, 'sound_time')
     print('concatenating...')
     dss = dss.sortby('sound_time')
@@ -3582,58 +4473,124 @@ def run_pyigra_save_xarray(station, path=sound_path):
     return
 
 
-def pyigra_to_xarray(station, path=sound_path):
+def igra_df_to_ragged(df, station=None):
+    """convert an IGRA (PyIGRA) levels dataframe into a contiguous ragged
+    dataset: one flat obs table of all the levels ordered by launch and a
+    row_size per launch (time), levels order within a launch is kept"""
     import pandas as pd
+    import numpy as np
     import xarray as xr
-    # import numpy as np
+    codes, dates = pd.factorize(df['NOMINAL'])
+    order = np.argsort(codes, kind='stable')
+    row_size = np.bincount(codes, minlength=len(dates))
+    dff = df.drop(['NOMINAL', 'RELEASE'], axis=1).iloc[order]
+    ds = xr.Dataset({x: ('obs', dff[x].values) for x in dff.columns})
+    ds['row_size'] = xr.DataArray(row_size, dims=['time'])
+    ds['row_size'].attrs['sample_dimension'] = 'obs'
+    ds['row_size'].attrs['long_name'] = 'number of levels of each launch'
+    ds['time'] = pd.to_datetime(np.asarray(dates), format='%Y%m%d%H')
+    if station is not None:
+        ds['station'] = xr.DataArray(np.full(len(dates), station), dims=['time'])
+    ds.attrs['featureType'] = 'profile'
+    return ds
+
+
+def igra_ragged_to_padded(ds, variables=None, times=None):
+    """pad the ragged IGRA dataset (or only some variables/times of it) to
+    the (time, point) layout. times is a slice (inclusive, partial date
+    strings allowed) or a list of datetimes, the time of several stations
+    is neither unique nor sorted so they are selected with a mask"""
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    def bound(x, end):
+        if isinstance(x, str):
+            period = pd.Period(x)
+            return period.end_time if end else period.start_time
+        return pd.Timestamp(x)
+
+    row_size = ds['row_size'].values
+    offsets = np.concatenate([[0], np.cumsum(row_size)[:-1]])
+    time_inds = np.arange(row_size.size)
+    if isinstance(times, slice):
+        values = pd.DatetimeIndex(ds['time'].values)
+        mask = np.ones(values.size, dtype=bool)
+        if times.start is not None:
+            mask &= values >= bound(times.start, False)
+        if times.stop is not None:
+            mask &= values <= bound(times.stop, True)
+        time_inds = time_inds[mask]
+    elif times is not None:
+        mask = np.isin(ds['time'].values, pd.DatetimeIndex(times).values)
+        time_inds = time_inds[mask]
+    sizes = row_size[time_inds]
+    rows = np.repeat(np.arange(time_inds.size), sizes)
+    # the point of each level within its launch and its obs index:
+    points = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    obs = np.repeat(offsets[time_inds], sizes) + points
+    if variables is None:
+        variables = [x for x in ds.data_vars if ds[x].dims == ('obs', )]
+    npoints = sizes.max() if sizes.size else 0
+    padded = xr.Dataset()
+    for var in variables:
+        arr = np.full((time_inds.size, npoints), np.nan)
+        arr[rows, points] = ds[var].values[obs]
+        padded[var] = xr.DataArray(arr, dims=['time', 'point'])
+        padded[var].attrs = ds[var].attrs
+    # per launch variables (e.g., station):
+    for var in [x for x in ds.data_vars if ds[x].dims == ('time', ) and x != 'row_size']:
+        padded[var] = xr.DataArray(ds[var].values[time_inds], dims=['time'])
+    padded['time'] = ds['time'].values[time_inds]
+    padded['point'] = np.arange(npoints)
+    padded.attrs = {k: v for k, v in ds.attrs.items() if k != 'featureType'}
+    return padded
+
+
+def pyigra_to_xarray(station, path=sound_path, ragged=False):
+    """read the PyIGRA text dump of station into a ragged dataset, save it
+    (igra_station_ragged.nc) and return it (ragged=True) or pad it to the
+    (time, point) layout"""
+    import pandas as pd
     filepath = path / 'igra_{}_raw.txt'.format(station)
-    df = pd.read_csv(filepath, delim_whitespace=True, na_values=[-9999.0, 9999])
-    dates = df['NOMINAL'].unique().tolist()
-    print('splicing dataframe and converting to xarray dataset...')
-    ds_list = []
-    for date in dates:
-        dff = df.loc[df.NOMINAL == date]
-        # release = dff.iloc[0, 1]
-        dff = dff.drop(['NOMINAL', 'RELEASE'], axis=1)
-        dss = dff.to_xarray()
-        dss = dss.drop('index')
-        dss = dss.rename({'index': 'point'})
-        dss['point'] = range(dss.point.size)
-        # dss.attrs['release'] = release
-        ds_list.append(dss)
-    print('concatenating to time-series dataset')
-    datetimes = pd.to_datetime(dates, format='%Y%m%d%H')
-    # max_ind = np.max([ds.index.size for ds in ds_list])
-    # T = np.nan * np.ones((len(dates), max_ind))
-    # P = np.nan * np.ones((len(dates), max_ind))
-    # for i, ds in enumerate(ds_list):
-    #     tsize = ds['TEMPERATURE'].size
-    #     T[i, 0:tsize] = ds['TEMPERATURE'].values
-    #     P[i, 0:tsize] = ds['PRESSURE'].values
-    # Tda = xr.DataArray(T, dims=['time', 'point'])
-    # Tda.name = 'Temperature'
-    # Tda.attrs['units'] = 'deg C'
-    # Tda['time'] = datetimes
-    # Pda = xr.DataArray(P, dims=['time', 'point'])
-    # Pda.name = 'Pressure'
-    # Pda.attrs['units'] = 'hPa'
-    # Pda['time'] = datetimes
-    # ds = Tda.to_dataset(name='Temperature')
-    # ds['Pressure'] = Pda
+    df = pd.read_csv(filepath, sep=r'\s+', na_values=[-9999.0, 9999])
+    print('splitting dataframe into ragged launches...')
+    ds = igra_df_to_ragged(df, station=station)
     units = {'PRESSURE': 'hPa', 'TEMPERATURE': 'deg_C', 'RELHUMIDITY': '%',
              'DEWPOINT': 'deg_C', 'WINDSPEED': 'm/sec',
              'WINDDIRECTION': 'azimuth'}
-    ds = xr.concat(ds_list, 'time')
-    ds['time'] = datetimes
     for da, unit in units.items():
         ds[da].attrs['unit'] = unit
     ds.attrs['name'] = 'radiosonde soundings from IGRA'
     ds.attrs['station'] = station
-    filename = 'igra_{}.nc'.format(station)
+    filename = 'igra_{}_ragged.nc'.format(station)
     comp = dict(zlib=True, complevel=9)  # best compression
-    encoding = {var: comp for var in ds.data_vars}
+    encoding = {var: comp for var in ds.data_vars if ds[var].dtype.kind != 'U'}
     ds.to_netcdf(path / filename, 'w', encoding=encoding)
     print('saved {} to {}.'.format(filename, path))
+    if ragged:
+        return ds
+    return igra_ragged_to_padded(ds)
+
+
+def load_igra_stations(stations, path=sound_path, times=None, variables=None,
+                       padded=True):
+    """load the ragged IGRA stores of stations (one ragged dataset) and pad
+    only the requested times/variables if padded"""
+    import xarray as xr
+    if isinstance(stations, str):
+        stations = [stations]
+    dsl = [xr.load_dataset(path / 'igra_{}_ragged.nc'.format(x))
+           for x in stations]
+    obs = xr.concat([x[[v for v in x.data_vars if x[v].dims == ('obs', )]]
+                     for x in dsl], 'obs')
+    prof = xr.concat([x[[v for v in x.data_vars if x[v].dims == ('time', )]]
+                      for x in dsl], 'time')
+    ds = xr.merge([obs, prof])
+    ds.attrs = dsl[0].attrs
+    ds.attrs['station'] = ', '.join(stations)
+    if padded:
+        return igra_ragged_to_padded(ds, variables=variables, times=times)
     return ds
 
 